@@ -0,0 +1,111 @@
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime
+
+from analytics import ACTIVE_USERS, day_bucket
+
+logger = logging.getLogger(__name__)
+
+
+class ActivityBuffer:
+    """Write-behind buffer for user upserts (new users, usernames, last-seen times).
+
+    ``touch`` only updates a dict, so recording activity costs nothing per
+    update; every ``interval`` seconds, or as soon as ``max_pending`` users
+    are waiting, the latest fields of each user are written in one bulk
+    write. Repeated updates of one user between flushes coalesce into a
+    single operation. ``stop`` flushes whatever is left. Deleted users must
+    be passed to ``forget``, or the next flush creates them again. With
+    ``analytics``, users active for the first time on a day count as active
+    users of that day.
+    """
+
+    def __init__(self, users, interval: float = 5.0, max_pending: int = 5000, clock=datetime.utcnow,
+                 analytics=None):
+        self.users = users
+        self.analytics = analytics
+        self.interval = interval
+        self.max_pending = max_pending
+        self.clock = clock
+        self._pending = {}
+        self._forgotten = set()
+        self._full = asyncio.Event()
+        self._task = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def touch(self, user_id: int, username: str = None):
+        self._pending[user_id] = {"username": username, "last_seen": self.clock()}
+        if len(self._pending) >= self.max_pending:
+            self._full.set()
+
+    def forget(self, user_ids=None):
+        """Drop pending writes of deleted users, of everyone when ``user_ids`` is None"""
+        if user_ids is None:
+            user_ids = list(self._pending)
+        for user_id in user_ids:
+            self._pending.pop(user_id, None)
+            self._forgotten.add(user_id)
+
+    async def flush(self) -> int:
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        self._forgotten = set()
+        try:
+            await self.users.touch_many(pending)
+            if self.analytics is not None:
+                await self._count_active(pending)
+        except BaseException:
+            # Retry with the next flush (also when cancelled by stop, which flushes again),
+            # unless the user has been touched again or deleted meanwhile
+            for user_id, fields in pending.items():
+                if user_id not in self._forgotten:
+                    self._pending.setdefault(user_id, fields)
+            raise
+        return len(pending)
+
+    async def _count_active(self, pending: dict):
+        # The day is stored on the user, so a retried flush or a restart does not count anyone twice
+        days = defaultdict(list)
+        for user_id, fields in pending.items():
+            days[day_bucket(fields["last_seen"])].append(user_id)
+        for day, user_ids in days.items():
+            first_today = await self.users.mark_active(user_ids, day)
+            if first_today:
+                self.analytics.record(ACTIVE_USERS, first_today, day=day)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"User activity flush failed: {e}")
+                await asyncio.sleep(self.interval)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            flushed = await self.flush()
+            if flushed:
+                logger.info(f"Flushed activity of {flushed} users on shutdown")
+        except Exception as e:
+            logger.error(f"Final user activity flush failed: {e}")
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_USERS = "active_users"
+VERIFY_PROMPTS = "verify_prompts"
+VERIFICATIONS = "verifications"
+FORCE_SUB_PROMPTS = "force_sub_prompts"
+FORCE_SUB_JOINS = "force_sub_joins"
+MEDIA_PREFIX = "media_"
+
+
+def day_bucket(when: datetime = None) -> str:
+    return (when or datetime.utcnow()).strftime("%Y-%m-%d")
+
+
+class Analytics:
+    """Usage counters kept in memory and flushed to the daily documents every ``interval`` seconds.
+
+    Recording an event is a dict increment on the hot path; a flush turns
+    everything gathered since the last one into a single bulk write. Active
+    users are counted by the activity buffer, which dedupes them per day in
+    the user documents, so restarts and several workers count each user once.
+    """
+
+    def __init__(self, repository, interval: float = 10.0, clock=datetime.utcnow):
+        self.repository = repository
+        self.interval = interval
+        self.clock = clock
+        self._pending = defaultdict(Counter)
+        self._task = None
+
+    def record(self, counter: str, amount: int = 1, day: str = None):
+        self._pending[day or day_bucket(self.clock())][counter] += amount
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, defaultdict(Counter)
+        try:
+            await self.repository.increment({bucket: dict(counters) for bucket, counters in pending.items()})
+        except BaseException:
+            # Keep the counts for the next flush (also when cancelled by stop, which flushes again)
+            for bucket, counters in pending.items():
+                self._pending[bucket].update(counters)
+            raise
+
+    async def days(self, count: int) -> list:
+        """(date, counters) for the last ``count`` days, newest first, unflushed counts included"""
+        today = self.clock()
+        buckets = [day_bucket(today - timedelta(days=offset)) for offset in range(count)]
+        stored = await self.repository.days(buckets)
+        result = []
+        for bucket in buckets:
+            counters = Counter(stored.get(bucket, {}))
+            counters.update(self._pending.get(bucket, {}))
+            result.append((bucket, counters))
+        return result
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Analytics flush failed: {e}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Final analytics flush failed: {e}")
@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import time
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from cache import MISSING, TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Telegram accepts at most 100 message ids per forwardMessages call
+FORWARD_CHUNK_SIZE = 100
+
+ADDED = "added"
+LIMIT_REACHED = "limit_reached"
+# Over the limit again after the user was already told, nothing to reply
+IGNORED = "ignored"
+
+
+class PendingBatch:
+    def __init__(self, chat_id: int, target: str):
+        self.chat_id = chat_id
+        self.target = target
+        self.message_ids = []
+        self.media_group_ids = set()
+        # Files claimed in the delivery ledger, released again if the forward fails
+        self.claims = []
+        # Media already sent to the target recently, only reported in the summary
+        self.skipped = 0
+        self.last_message_id = None
+        self.deadline = 0.0
+
+
+class MediaBatcher:
+    """Buffers media per user and delivers each batch with bulk forwards and one summary reply.
+
+    Albums (one media_group_id) are always delivered together; /batchsave opens
+    a session that keeps collecting media, up to the user's tier limit. With
+    a ``ledger`` the claims of a batch that failed to forward are released.
+    """
+
+    def __init__(self, debounce: float = 2.0, free_limit: int = 10, premium_limit: int = 100,
+                 session_ttl: float = 600, ledger=None):
+        self.debounce = debounce
+        self.free_limit = free_limit
+        self.premium_limit = premium_limit
+        self.ledger = ledger
+        self._pending = {}
+        # Flush and delivery tasks, referenced until done so they are not garbage collected
+        self._tasks = set()
+        self._sessions = TTLCache(maxsize=10000, ttl=session_ttl)
+        # Delivered batches, so "Send to me" on a summary can forward the whole batch again
+        self.deliveries = TTLCache(maxsize=10000, ttl=86400)
+
+    def limit_for(self, premium: bool) -> int:
+        return self.premium_limit if premium else self.free_limit
+
+    def start_session(self, user_id: int, premium: bool) -> int:
+        limit = self.limit_for(premium)
+        self._sessions.set(user_id, {"limit": limit, "saved": 0, "limit_notified": False})
+        return limit
+
+    async def end_session(self, user_id: int) -> bool:
+        """Close the user's batch session and drop media that was not delivered yet"""
+        batch = self._pending.pop(user_id, None)
+        if batch is not None:
+            await self._release_claims(batch)
+        return self._sessions.pop(user_id) is not None
+
+    def in_session(self, user_id: int) -> bool:
+        return self._sessions.peek(user_id) is not MISSING
+
+    def joins_batch(self, user_id: int, media_group_id: str = None) -> bool:
+        """True if media goes into a batch already started: an open session, or an album being collected"""
+        if self.in_session(user_id):
+            return True
+        batch = self._pending.get(user_id)
+        return media_group_id is not None and batch is not None and media_group_id in batch.media_group_ids
+
+    def add(self, bot, user_id: int, chat_id: int, message_id: int, target: str, media_group_id: str = None,
+            file_unique_id: str = None, duplicate: bool = False) -> str:
+        """Queue a message for the user's batch.
+
+        ``file_unique_id`` is the file claimed in the ledger for ``target``;
+        a ``duplicate`` was sent there recently and is only counted as skipped.
+        """
+        session = self._sessions.peek(user_id)
+        batch = self._pending.get(user_id)
+
+        if batch is not None and batch.target != target:
+            # Target changed mid-batch, deliver what we have to the old target first
+            del self._pending[user_id]
+            self._spawn(self._deliver(bot, user_id, batch))
+            batch = None
+
+        if session is not MISSING:
+            queued = len(batch.message_ids) if batch else 0
+            if session["saved"] + queued >= session["limit"]:
+                if session["limit_notified"]:
+                    return IGNORED
+                session["limit_notified"] = True
+                return LIMIT_REACHED
+
+        if batch is None:
+            batch = PendingBatch(chat_id, target)
+            self._pending[user_id] = batch
+            self._spawn(self._flush_later(bot, user_id, batch))
+
+        if duplicate:
+            batch.skipped += 1
+        else:
+            batch.message_ids.append(message_id)
+            if file_unique_id is not None:
+                batch.claims.append(file_unique_id)
+        batch.last_message_id = message_id
+        if media_group_id is not None:
+            batch.media_group_ids.add(media_group_id)
+        batch.deadline = time.monotonic() + self.debounce
+        return ADDED
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush_later(self, bot, user_id: int, batch: PendingBatch):
+        # Each new item pushes the deadline back, so the batch goes out once the user pauses
+        while True:
+            delay = batch.deadline - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+
+        if self._pending.get(user_id) is not batch:
+            return
+        del self._pending[user_id]
+        await self._deliver(bot, user_id, batch)
+
+    async def _deliver(self, bot, user_id: int, batch: PendingBatch):
+        message_ids = sorted(batch.message_ids)
+        skipped = f"♻️ {batch.skipped} media already forwarded to {batch.target} recently, skipped"
+        if not message_ids:
+            await self._reply(bot, batch, skipped)
+            return
+        try:
+            for i in range(0, len(message_ids), FORWARD_CHUNK_SIZE):
+                await bot.forward_messages(
+                    chat_id=batch.target,
+                    from_chat_id=batch.chat_id,
+                    message_ids=message_ids[i:i + FORWARD_CHUNK_SIZE]
+                )
+        except Exception as e:
+            logger.error(f"Batch forwarding error: {e}")
+            await self._release_claims(batch)
+            await self._reply(bot, batch, "❌ Failed to forward media. Make sure I'm admin in target channel!")
+            return
+
+        session = self._sessions.peek(user_id)
+        if session is not MISSING:
+            session["saved"] += len(message_ids)
+
+        delivery_key = f"{batch.chat_id}:{message_ids[0]}"
+        self.deliveries.set(delivery_key, (batch.chat_id, message_ids))
+        text = f"✅ {len(message_ids)} media forwarded successfully to {batch.target}\n"
+        if batch.skipped:
+            text += skipped + "\n"
+        await self._reply(
+            bot, batch, text + "Want them in your DM?",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("📩 Send to me", callback_data=f"send_batch:{delivery_key}")]
+            ])
+        )
+
+    async def _release_claims(self, batch: PendingBatch):
+        # The files never reached the target, so sending them again is not a duplicate
+        if self.ledger is not None:
+            for file_unique_id in batch.claims:
+                await self.ledger.release(file_unique_id, batch.target)
+
+    async def _reply(self, bot, batch: PendingBatch, text: str, **kwargs):
+        # Runs outside any update, so nothing else would report a failed reply
+        try:
+            await bot.send_message(
+                chat_id=batch.chat_id, text=text, reply_to_message_id=batch.last_message_id, **kwargs
+            )
+        except Exception as e:
+            logger.error(f"Batch reply error: {e}")
+
+    async def send_to_user(self, bot, user_id: int, delivery_key: str) -> bool:
+        delivery = self.deliveries.get(delivery_key)
+        if delivery is MISSING:
+            return False
+        chat_id, message_ids = delivery
+        for i in range(0, len(message_ids), FORWARD_CHUNK_SIZE):
+            await bot.forward_messages(
+                chat_id=user_id,
+                from_chat_id=chat_id,
+                message_ids=message_ids[i:i + FORWARD_CHUNK_SIZE]
+            )
+        return True
@@ -0,0 +1,138 @@
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+
+import tornado.httpserver
+import tornado.web
+
+BOT_USER = {
+    "id": 777000001,
+    "is_bot": True,
+    "first_name": "Bench",
+    "username": "bench_bot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False
+}
+
+
+def _chat(chat_id):
+    if isinstance(chat_id, str) and not chat_id.lstrip("-").isdigit():
+        return {"id": -1000000000000 - hash(chat_id) % 1000000, "type": "channel", "title": chat_id}
+    chat_id = int(chat_id)
+    return {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup", "first_name": "user"}
+
+
+class FakeBotApi:
+    """Local stand-in for the Telegram Bot API with a fixed response latency.
+
+    Answers the methods the bot uses with well-formed results and counts every
+    call. ``left_every`` makes get_chat_member report "left" for every n-th
+    user id so the force-sub join path gets exercised. Updates queued with
+    ``push_update`` are served to a polling bot through getUpdates.
+    """
+
+    def __init__(self, port: int = 8081, latency: float = 0.02, left_every: int = 0):
+        self.port = port
+        self.latency = latency
+        self.left_every = left_every
+        self.calls = Counter()
+        self._message_ids = itertools.count(1000000)
+        self._server = None
+        self.updates = []
+        self._new_updates = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    def _message(self, data: dict, **extra) -> dict:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": _chat(data.get("chat_id", 1)),
+            "from": BOT_USER
+        }
+        message.update(extra)
+        return message
+
+    def push_update(self, update: dict):
+        self.updates.append(update)
+        if self._new_updates is not None:
+            self._new_updates.set()
+
+    async def get_updates(self, data: dict) -> list:
+        # Everything below the offset has been confirmed by the bot
+        offset = int(data.get("offset") or 0)
+        self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        timeout = float(data.get("timeout") or 0)
+        if not self.updates and timeout:
+            self._new_updates = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._new_updates = None
+        return self.updates[:int(data.get("limit") or 100)]
+
+    def respond(self, method: str, data: dict):
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "editMessageText"):
+            return self._message(data, text=data.get("text", ""))
+        if method in ("forwardMessage", "copyMessage"):
+            return self._message(data, text="forwarded")
+        if method in ("sendPhoto", "sendVideo", "sendDocument"):
+            return self._message(data, text="sent")
+        if method in ("forwardMessages", "copyMessages"):
+            message_ids = data.get("message_ids") or []
+            if isinstance(message_ids, str):
+                message_ids = json.loads(message_ids)
+            return [{"message_id": next(self._message_ids)} for _ in message_ids]
+        if method == "getChatMember":
+            user_id = int(data["user_id"])
+            left = self.left_every and user_id % self.left_every == 0
+            return {
+                "status": "left" if left else "member",
+                "user": {"id": user_id, "is_bot": False, "first_name": "user"}
+            }
+        if method == "getChat":
+            chat = _chat(data.get("chat_id"))
+            chat["username"] = str(data.get("chat_id")).lstrip("@")
+            return chat
+        return True
+
+    def make_app(self) -> tornado.web.Application:
+        api = self
+
+        class Handler(tornado.web.RequestHandler):
+            async def post(self, token, method):
+                api.calls[method] += 1
+                if api.latency:
+                    await asyncio.sleep(api.latency)
+                data = {}
+                if self.request.body:
+                    content_type = self.request.headers.get("Content-Type", "")
+                    if content_type.startswith("application/json"):
+                        data = json.loads(self.request.body)
+                    else:
+                        data = {key: values[-1].decode() for key, values in self.request.body_arguments.items()}
+                if method == "getUpdates":
+                    result = await api.get_updates(data)
+                else:
+                    result = api.respond(method, data)
+                self.write({"ok": True, "result": result})
+
+            get = post
+
+        return tornado.web.Application([(r"/bot([^/]+)/(\w+)", Handler)])
+
+    def start(self):
+        self._server = tornado.httpserver.HTTPServer(self.make_app())
+        self._server.listen(self.port, address="127.0.0.1")
+
+    def stop(self):
+        if self._server:
+            self._server.stop()
@@ -0,0 +1,274 @@
+"""Replay a synthetic update stream against the bot's real Application.
+
+The bot runs exactly as built by bot.build_application(), but talks to a
+local fake Bot API server and the in-memory database backend, so nothing
+leaves the machine. Example:
+
+    python -m bench.loadtest --rate 200 --duration 30 --users 5000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+OWNER_ID = 900000001
+TOKEN = "123456:BENCH"
+
+# Scenario weights for the default mix
+DEFAULT_MIX = "start=15,media=55,callback=15,expired=10,broadcast=0.1,premium=4.9"
+
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    # Nearest rank: the smallest value with at least pct% of the samples at or below it
+    index = min(len(values) - 1, max(0, math.ceil(pct * len(values) / 100) - 1))
+    return values[index]
+
+
+class UpdateFactory:
+    def __init__(self, users: int, expired_users: int):
+        self.users = users
+        self.expired_users = expired_users
+        self._update_ids = iter(range(1, 1 << 62))
+        self._message_ids = iter(range(1, 1 << 62))
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+    def _message(self, user_id: int, **extra) -> dict:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": f"user{user_id}"},
+            "from": self._user(user_id)
+        }
+        message.update(extra)
+        return message
+
+    def _command(self, user_id: int, text: str) -> dict:
+        command = text.split()[0]
+        return self._message(user_id, text=text, entities=[
+            {"type": "bot_command", "offset": 0, "length": len(command)}
+        ])
+
+    def _photo(self, user_id: int) -> dict:
+        file_id = f"photo{random.randrange(1 << 30)}"
+        return self._message(user_id, photo=[
+            {"file_id": file_id, "file_unique_id": file_id, "width": 90, "height": 90}
+        ])
+
+    def verified_user(self) -> int:
+        return random.randint(self.expired_users + 1, self.users)
+
+    def expired_user(self) -> int:
+        return random.randint(1, max(self.expired_users, 1))
+
+    def build(self, scenario: str) -> dict:
+        update = {"update_id": next(self._update_ids)}
+        if scenario == "start":
+            update["message"] = self._command(self.verified_user(), "/start")
+        elif scenario == "media":
+            update["message"] = self._photo(self.verified_user())
+        elif scenario == "expired":
+            update["message"] = self._photo(self.expired_user())
+        elif scenario == "premium":
+            update["message"] = self._command(self.verified_user(), "/premium")
+        elif scenario == "callback":
+            user_id = self.verified_user()
+            update["callback_query"] = {
+                "id": str(update["update_id"]),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": "send_to_me",
+                "message": self._message(
+                    user_id,
+                    text="✅ Media forwarded successfully",
+                    reply_to_message=self._photo(user_id)
+                )
+            }
+        elif scenario == "broadcast":
+            update["message"] = self._command(OWNER_ID, "/broadcast benchmark run")
+        else:
+            raise ValueError(f"Unknown scenario: {scenario}")
+        return update
+
+
+async def seed_users(db, users: int, expired_users: int):
+    now = datetime.utcnow()
+    for user_id in range(1, users + 1):
+        expired = user_id <= expired_users
+        await db.users.col.insert_one({
+            "_id": user_id,
+            "username": f"user{user_id}",
+            "channel": f"bench_channel_{user_id}",
+            "premium": False,
+            "last_verified": now - timedelta(days=30) if expired else now,
+            "verified_until": now - timedelta(days=29) if expired else now + timedelta(days=1)
+        })
+
+
+async def run(args):
+    import bot
+    from ratelimit import KeyedRateLimiter
+    from shortener import ShortenerClient, fake_transport
+    from telegram import Update
+
+    from bench.fake_bot_api import FakeBotApi
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    fake_api = FakeBotApi(port=args.api_port, latency=args.api_latency, left_every=args.left_every)
+    fake_api.start()
+
+    # Route verification links through an in-process shortener with realistic latency
+    bot.shortener = ShortenerClient(transport=fake_transport(latency=args.shortener_latency))
+    bot.shortener.configure("https://shortener.invalid/api", "bench")
+    if not args.real_limits:
+        # Measure the bot itself rather than Telegram's per-chat message limits
+        bot.outbound_limiter.private_chats = KeyedRateLimiter(1000000, 1000000)
+        bot.outbound_limiter.group_chats = KeyedRateLimiter(1000000, 1000000)
+
+    factory = UpdateFactory(args.users, int(args.users * args.expired_ratio))
+    await seed_users(bot.db, args.users, factory.expired_users)
+
+    application = bot.build_application(TOKEN, base_url=fake_api.base_url)
+
+    enqueued = {}
+    latencies = []
+    finished = asyncio.Event()
+    expected = {"count": None}
+
+    def record_done(update):
+        started = enqueued.pop(update.update_id, None)
+        if started is not None:
+            latencies.append(time.perf_counter() - started)
+        if expected["count"] is not None and len(latencies) >= expected["count"]:
+            finished.set()
+
+    # Wrap the update processor so updates stopped early (e.g. throttled) are counted as well
+    processor = application.update_processor
+    do_process_update = processor.do_process_update
+
+    async def process_and_record(update, coroutine):
+        try:
+            await do_process_update(update, coroutine)
+        finally:
+            record_done(update)
+
+    processor.do_process_update = process_and_record
+
+    await application.initialize()
+    await application.post_init(application)
+    await bot.settings_store.set(force_sub_channels=[f"bench_fsub_{i}" for i in range(args.force_sub_chats)])
+    if args.polling:
+        await application.updater.start_polling(timeout=bot.POLL_TIMEOUT, poll_interval=bot.POLL_INTERVAL)
+    await application.start()
+
+    weights = parse_mix(args.mix)
+    scenarios = list(weights)
+    scenario_weights = [weights[name] for name in scenarios]
+    total = int(args.rate * args.duration)
+
+    started_at = time.perf_counter()
+    for i in range(total):
+        # Open-loop arrivals: updates keep coming at the target rate however slow the bot is
+        delay = started_at + i / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        scenario = random.choices(scenarios, scenario_weights)[0]
+        data = factory.build(scenario)
+        enqueued[data["update_id"]] = time.perf_counter()
+        if args.polling:
+            fake_api.push_update(data)
+        else:
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    sent_at = time.perf_counter()
+
+    expected["count"] = total
+    if len(latencies) < total:
+        try:
+            await asyncio.wait_for(finished.wait(), timeout=args.drain_timeout)
+        except asyncio.TimeoutError:
+            pass
+    elapsed = time.perf_counter() - started_at
+
+    if application.updater.running:
+        await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    await application.post_shutdown(application)
+    fake_api.stop()
+
+    report = {
+        "offered_rate": args.rate,
+        "updates_sent": total,
+        "updates_completed": len(latencies),
+        "send_seconds": round(sent_at - started_at, 3),
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_per_second": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p95": round(percentile(latencies, 95) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "max": round(max(latencies) * 1000, 2) if latencies else 0.0,
+            "mean": round(statistics.fmean(latencies) * 1000, 2) if latencies else 0.0
+        },
+        "bot_api_calls": dict(sorted(fake_api.calls.items()))
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=100, help="updates per second offered")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of traffic")
+    parser.add_argument("--users", type=int, default=2000, help="distinct users in the stream")
+    parser.add_argument("--expired-ratio", type=float, default=0.1, help="share of users whose verification expired")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="scenario weights, e.g. start=20,media=80")
+    parser.add_argument("--force-sub-chats", type=int, default=2, help="force-sub channels to check")
+    parser.add_argument("--left-every", type=int, default=50, help="every n-th user has not joined")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="fake Bot API latency in seconds")
+    parser.add_argument("--shortener-latency", type=float, default=0.2, help="fake shortener latency in seconds")
+    parser.add_argument("--api-port", type=int, default=18081, help="port for the fake Bot API")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="seconds to wait for stragglers")
+    parser.add_argument("--real-limits", action="store_true",
+                        help="keep Telegram's outbound rate limits instead of lifting them")
+    parser.add_argument("--polling", action="store_true",
+                        help="deliver updates through getUpdates long polling instead of the update queue")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    # bot.py reads its configuration at import time
+    os.environ["MONGO_URI"] = "memory://"
+    os.environ["OWNER_ID"] = str(OWNER_ID)
+    os.environ.setdefault("TELEGRAM_TOKEN", TOKEN)
+    if not args.real_limits:
+        os.environ["OUTBOUND_GLOBAL_RATE"] = "1000000"
+        os.environ["BROADCAST_RATE"] = "1000"
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,10 @@
 import os
+import asyncio
 import logging
+import tempfile
 import time
-import secrets
-import requests
+from collections import Counter
 from datetime import datetime, timedelta
-from pymongo import MongoClient
 from telegram import (
     Update,
     InlineKeyboardButton,
@@ -16,10 +16,45 @@ from telegram.ext import (
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
     ContextTypes,
     filters
 )
-from telegram.error import BadRequest
+from telegram.error import BadRequest, Forbidden
+
+import database
+from cache import TTLCache, MISSING
+from forcesub import ForceSubChecker
+from broadcast import Broadcaster
+from shortener import ShortenerClient, VERIFY_START_PREFIX
+from batch import MediaBatcher, ADDED, LIMIT_REACHED
+from delivery import DeliveryLedger, media_file, send_file
+from scheduler import PriorityUpdateProcessor, OWNER, PREMIUM, FREE, TIERS, update_user_id
+from pipeline import Request, RequestContext, requires
+from outbound import OutboundRateLimiter, is_outage as is_bot_api_outage
+from resilience import Dependency, DependencyUnavailable
+from ratelimit import UserThrottle
+from settings import Config, SettingsStore
+from startup import StartupTracker
+from jobs import AdminJobRunner, EXPORT_SUFFIX
+import jobs
+import housekeeping
+from activity import ActivityBuffer
+from ingest import IngestQueue
+from analytics import (
+    Analytics,
+    VERIFY_PROMPTS,
+    VERIFICATIONS,
+    FORCE_SUB_PROMPTS,
+    FORCE_SUB_JOINS,
+    MEDIA_PREFIX,
+    ACTIVE_USERS
+)
+import metrics
+import server
+import cluster
+from metrics import timed, THROTTLED_UPDATES, DUPLICATE_DELIVERIES
 
 # Configure logging
 logging.basicConfig(
@@ -28,21 +63,176 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Startup phases are timed from here, /readyz reports them once warmup is done
+startup = StartupTracker()
+WARMUP_USERS = int(os.environ.get("WARMUP_USERS", 1000))
+
+# Dependency health: calls time out, and after BREAKER_FAILURES failures in a row (slow calls count)
+# a dependency is skipped for BREAKER_RESET seconds while fallbacks answer instead
+MONGO_TIMEOUT = float(os.environ.get("MONGO_TIMEOUT", 3))  # in seconds
+BOT_API_LOOKUP_TIMEOUT = float(os.environ.get("BOT_API_LOOKUP_TIMEOUT", 3))  # in seconds
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", 5))
+BREAKER_RESET = float(os.environ.get("BREAKER_RESET", 30))  # in seconds
+mongo = Dependency(
+    "mongodb", MONGO_TIMEOUT, is_failure=database.is_outage,
+    failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET
+)
+# Migrations, admin jobs, broadcasts and housekeeping scan whole collections, they get a longer
+# timeout and a breaker of their own so a slow scan does not open the circuit updates rely on
+MONGO_MAINTENANCE_TIMEOUT = float(os.environ.get("MONGO_MAINTENANCE_TIMEOUT", 60))  # in seconds
+mongo_maintenance = Dependency(
+    "mongodb_maintenance", MONGO_MAINTENANCE_TIMEOUT, is_failure=database.is_outage,
+    failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET
+)
+# Only the lookups force-sub checks wait on, sends have their own retries in the outbound limiter
+bot_api_lookups = Dependency(
+    "bot_api", BOT_API_LOOKUP_TIMEOUT, is_failure=is_bot_api_outage,
+    failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET
+)
+
 # MongoDB setup
 MONGO_URI = os.environ.get("MONGO_URI")
 DB_NAME = "telegram_forwarder"
-client = MongoClient(MONGO_URI)
-db = client[DB_NAME]
-users_col = db["users"]
-channels_col = db["channels"]
-force_sub_col = db["force_sub"]
+MONGO_POOL_SIZE = int(os.environ.get("MONGO_POOL_SIZE", 10))
+
+# User profile cache (write-through, so verified users hit the database at most once per TTL);
+# expired profiles are still served for USER_CACHE_STALE_TTL seconds while MongoDB is unavailable
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", 300))  # in seconds
+USER_CACHE_STALE_TTL = int(os.environ.get("USER_CACHE_STALE_TTL", 3600))  # in seconds
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL, stale_ttl=USER_CACHE_STALE_TTL)
+
+db = database.connect(
+    MONGO_URI, DB_NAME, pool_size=MONGO_POOL_SIZE, user_cache=user_cache,
+    dependency=mongo, maintenance_dependency=mongo_maintenance
+)
 
 # Environment variables
 OWNER_ID = int(os.environ.get("OWNER_ID"))
+
+# Defaults for settings owner commands can change, stored values in the database take precedence
 SHORTENER_API_KEY = os.environ.get("SHORTENER_API_KEY", "")
 SHORTENER_API_URL = os.environ.get("SHORTENER_API_URL", "")
 VERIFICATION_INTERVAL = int(os.environ.get("VERIFICATION_INTERVAL", 24))  # in hours
 
+# Verification links stop working after this long, expired tokens are removed by MongoDB
+VERIFY_TOKEN_TTL = int(os.environ.get("VERIFY_TOKEN_TTL", 86400))  # in seconds
+
+# A user asking again within this window gets the same link, without a new token or shortener call
+VERIFY_LINK_REUSE = int(os.environ.get("VERIFY_LINK_REUSE", 600))  # in seconds
+verify_links = TTLCache(maxsize=USER_CACHE_SIZE, ttl=min(VERIFY_LINK_REUSE, VERIFY_TOKEN_TTL))
+
+# Scheduled jobs: renewal links are prepared RENEWAL_LEAD seconds before a verification lapses,
+# with an optional reminder; users that blocked the bot are deleted after PRUNE_BLOCKED_AFTER days
+RENEWAL_LEAD = int(os.environ.get("RENEWAL_LEAD", 3600))  # in seconds
+RENEWAL_SCAN_INTERVAL = int(os.environ.get("RENEWAL_SCAN_INTERVAL", 300))  # in seconds
+RENEWAL_REMINDERS = int(os.environ.get("RENEWAL_REMINDERS", 0))
+REMINDER_RATE = float(os.environ.get("REMINDER_RATE", 5))  # messages per second
+PRUNE_BLOCKED_AFTER = int(os.environ.get("PRUNE_BLOCKED_AFTER", 30))  # in days, 0 disables
+PRUNE_INTERVAL = int(os.environ.get("PRUNE_INTERVAL", 86400))  # in seconds
+
+# Settings snapshot read by handlers, reloaded in the background when another worker changes it
+SETTINGS_POLL_INTERVAL = float(os.environ.get("SETTINGS_POLL_INTERVAL", 5))  # in seconds
+settings_store = SettingsStore(
+    db.settings,
+    defaults=Config(
+        verification_interval=VERIFICATION_INTERVAL,
+        shortener_api_url=SHORTENER_API_URL,
+        shortener_api_key=SHORTENER_API_KEY
+    ),
+    interval=SETTINGS_POLL_INTERVAL
+)
+
+# Shortener client: one pooled HTTP client, plus ready-made verification links for instant replies
+SHORTENER_TIMEOUT = float(os.environ.get("SHORTENER_TIMEOUT", 5))  # in seconds
+SHORTENER_MAX_CONNECTIONS = int(os.environ.get("SHORTENER_MAX_CONNECTIONS", 10))
+SHORTENER_LINK_POOL_SIZE = int(os.environ.get("SHORTENER_LINK_POOL_SIZE", 20))
+shortener = ShortenerClient(
+    timeout=SHORTENER_TIMEOUT,
+    max_connections=SHORTENER_MAX_CONNECTIONS,
+    link_pool_size=SHORTENER_LINK_POOL_SIZE
+)
+shortener.configure(SHORTENER_API_URL, SHORTENER_API_KEY)
+
+# Broadcast tuning: messages/s across all chats, concurrent senders, users per persisted batch
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 20))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", 10))
+BROADCAST_BATCH_SIZE = int(os.environ.get("BROADCAST_BATCH_SIZE", 500))
+broadcaster = Broadcaster(
+    db,
+    rate=BROADCAST_RATE,
+    concurrency=BROADCAST_CONCURRENCY,
+    batch_size=BROADCAST_BATCH_SIZE
+)
+
+# Batch saving: albums and /batchsave sessions are delivered after a quiet period, capped per tier
+BATCH_DEBOUNCE = float(os.environ.get("BATCH_DEBOUNCE", 2))  # in seconds
+BATCH_LIMIT_FREE = int(os.environ.get("BATCH_LIMIT_FREE", 10))
+BATCH_LIMIT_PREMIUM = int(os.environ.get("BATCH_LIMIT_PREMIUM", 100))
+# The same file is not sent to the same chat twice within this window (0 disables)
+DELIVERY_DEDUP_WINDOW = int(os.environ.get("DELIVERY_DEDUP_WINDOW", 3600))  # in seconds
+delivery_ledger = DeliveryLedger(db.deliveries, window=DELIVERY_DEDUP_WINDOW, maxsize=USER_CACHE_SIZE)
+
+media_batcher = MediaBatcher(
+    debounce=BATCH_DEBOUNCE,
+    free_limit=BATCH_LIMIT_FREE,
+    premium_limit=BATCH_LIMIT_PREMIUM,
+    ledger=delivery_ledger
+)
+
+# Owner maintenance jobs (reset, export, import) run in the background, this many users per batch
+ADMIN_JOB_BATCH_SIZE = int(os.environ.get("ADMIN_JOB_BATCH_SIZE", 1000))
+admin_jobs = AdminJobRunner()
+
+# Update scheduling: handlers running at once, and updates admitted before new ones wait,
+# overall and from a single user
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", 8))
+UPDATE_MAX_PENDING = int(os.environ.get("UPDATE_MAX_PENDING", 1000))
+UPDATE_MAX_PENDING_PER_USER = int(os.environ.get("UPDATE_MAX_PENDING_PER_USER", 20))
+
+# Polling mode (no WEBHOOK_URL): long-poll duration and pause between polls
+POLL_TIMEOUT = int(os.environ.get("POLL_TIMEOUT", 30))  # in seconds
+POLL_INTERVAL = float(os.environ.get("POLL_INTERVAL", 0))  # in seconds
+# On shutdown, updates already received get this long to finish
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", 25))  # in seconds
+
+# HTTP client for Bot API calls: pooled connections shared by all handlers, and its timeouts
+BOT_API_POOL_SIZE = int(os.environ.get("BOT_API_POOL_SIZE", 256))
+BOT_API_POOL_TIMEOUT = float(os.environ.get("BOT_API_POOL_TIMEOUT", 5))
+BOT_API_CONNECT_TIMEOUT = float(os.environ.get("BOT_API_CONNECT_TIMEOUT", 5))
+BOT_API_READ_TIMEOUT = float(os.environ.get("BOT_API_READ_TIMEOUT", 10))
+BOT_API_WRITE_TIMEOUT = float(os.environ.get("BOT_API_WRITE_TIMEOUT", 20))
+
+# Per-user limits (updates/s and burst) checked before any handler runs, the owner is never limited
+USER_RATE_FREE = float(os.environ.get("USER_RATE_FREE", 1))
+USER_BURST_FREE = int(os.environ.get("USER_BURST_FREE", 10))
+USER_RATE_PREMIUM = float(os.environ.get("USER_RATE_PREMIUM", 5))
+USER_BURST_PREMIUM = int(os.environ.get("USER_BURST_PREMIUM", 50))
+user_throttle = UserThrottle({
+    FREE: (USER_RATE_FREE, USER_BURST_FREE),
+    PREMIUM: (USER_RATE_PREMIUM, USER_BURST_PREMIUM),
+})
+
+# Outbound Bot API calls: requests/s across the bot and attempts for transient failures
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", 30))
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", 3))
+outbound_limiter = OutboundRateLimiter(
+    global_rate=OUTBOUND_GLOBAL_RATE,
+    max_retries=OUTBOUND_MAX_RETRIES
+)
+
+# Usage counters are batched in memory and written every ANALYTICS_FLUSH_INTERVAL seconds
+ANALYTICS_FLUSH_INTERVAL = int(os.environ.get("ANALYTICS_FLUSH_INTERVAL", 10))
+analytics = Analytics(db.analytics, interval=ANALYTICS_FLUSH_INTERVAL)
+
+# New users, usernames and last-seen times are written behind, in bulk
+ACTIVITY_FLUSH_INTERVAL = int(os.environ.get("ACTIVITY_FLUSH_INTERVAL", 5))
+ACTIVITY_MAX_PENDING = int(os.environ.get("ACTIVITY_MAX_PENDING", 5000))
+user_activity = ActivityBuffer(
+    db.users, interval=ACTIVITY_FLUSH_INTERVAL, max_pending=ACTIVITY_MAX_PENDING, analytics=analytics
+)
+db.users.on_delete(user_activity.forget)
+
 # Bot commands setup
 COMMANDS = [
     BotCommand("start", "Start the bot"),
@@ -53,69 +243,165 @@ COMMANDS = [
     BotCommand("logout", "Logout from service"),
     BotCommand("resetall", "Reset all data (Owner only)"),
     BotCommand("broadcast", "Broadcast message (Owner only)"),
+    BotCommand("broadcaststatus", "Show broadcast progress (Owner only)"),
     BotCommand("addfchannel", "Add force-sub channel (Owner only)"),
     BotCommand("addfgroup", "Add force-sub group (Owner only)"),
     BotCommand("removefchannel", "Remove force-sub channel (Owner only)"),
     BotCommand("removefgroup", "Remove force-sub group (Owner only)"),
     BotCommand("setverifyinterval", "Set verification interval (Owner only)"),
     BotCommand("setshortener", "Set shortener API (Owner only)"),
+    BotCommand("cachestats", "Show cache statistics (Owner only)"),
+    BotCommand("queuestats", "Show update queue statistics (Owner only)"),
+    BotCommand("apistats", "Show Bot API call statistics (Owner only)"),
+    BotCommand("stats", "Show usage statistics (Owner only)"),
+    BotCommand("exportusers", "Export all users to a file (Owner only)"),
+    BotCommand("importusers", "Import users from an export file (Owner only)"),
+    BotCommand("jobstatus", "Show maintenance job progress (Owner only)"),
+    BotCommand("canceljob", "Cancel the running maintenance job (Owner only)"),
 ]
 
-# Force subscription status
-FORCE_SUB_CHANNELS = []
-FORCE_SUB_GROUPS = []
+# Membership results are cached per (user, chat); "not joined" expires quickly so joins show up fast.
+# While the Bot API is unavailable, results up to FORCE_SUB_STALE_TTL seconds past their TTL are used,
+# and users without one are let through when FORCE_SUB_FAIL_OPEN is set
+FORCE_SUB_POSITIVE_TTL = int(os.environ.get("FORCE_SUB_POSITIVE_TTL", 600))  # in seconds
+FORCE_SUB_NEGATIVE_TTL = int(os.environ.get("FORCE_SUB_NEGATIVE_TTL", 30))  # in seconds
+FORCE_SUB_STALE_TTL = int(os.environ.get("FORCE_SUB_STALE_TTL", 3600))  # in seconds
+FORCE_SUB_FAIL_OPEN = int(os.environ.get("FORCE_SUB_FAIL_OPEN", 1))
+force_sub_checker = ForceSubChecker(
+    positive_ttl=FORCE_SUB_POSITIVE_TTL,
+    negative_ttl=FORCE_SUB_NEGATIVE_TTL,
+    dependency=bot_api_lookups,
+    stale_ttl=FORCE_SUB_STALE_TTL,
+    fail_open=bool(FORCE_SUB_FAIL_OPEN)
+)
 
-async def load_force_sub_data():
-    global FORCE_SUB_CHANNELS, FORCE_SUB_GROUPS
-    force_sub_data = force_sub_col.find_one({"_id": "force_sub_data"})
-    if force_sub_data:
-        FORCE_SUB_CHANNELS = force_sub_data.get("channels", [])
-        FORCE_SUB_GROUPS = force_sub_data.get("groups", [])
-    else:
-        force_sub_col.insert_one({
-            "_id": "force_sub_data",
-            "channels": [],
-            "groups": []
-        })
-
-async def generate_short_url(long_url: str) -> str:
-    """Generate short URL using the shortener API"""
-    if not SHORTENER_API_URL or not SHORTENER_API_KEY:
-        logger.warning("Shortener API not configured")
-        return long_url
-    
+# Scale-out: WORKERS > 1 runs a webhook ingress that shards updates by user over worker processes
+WORKERS = int(os.environ.get("WORKERS", 1))
+WORKER_BASE_PORT = int(os.environ.get("WORKER_BASE_PORT", 9000))
+INGRESS_MAX_PENDING = int(os.environ.get("INGRESS_MAX_PENDING", 1000))
+WORKER_INDEX = None  # set in worker processes
+
+# Durable ingestion: with a path set, webhook updates are acknowledged once stored in this
+# SQLite file (one per worker) and processed from there, so restarts lose nothing
+INGEST_QUEUE_PATH = os.environ.get("INGEST_QUEUE_PATH", "")
+INGEST_MAX_INFLIGHT = int(os.environ.get("INGEST_MAX_INFLIGHT", 100))
+INGEST_RETENTION = int(os.environ.get("INGEST_RETENTION", 3600))  # in seconds
+
+# Metrics: cache statistics are read at scrape time, event-loop lag is sampled continuously
+metrics.register_caches({
+    "user": user_cache,
+    "force_sub_membership": force_sub_checker.memberships,
+    "force_sub_chat": force_sub_checker.chats,
+})
+metrics.register_breakers({
+    "mongodb": mongo.breaker,
+    "mongodb_maintenance": mongo_maintenance.breaker,
+    "bot_api": bot_api_lookups.breaker,
+    "shortener": shortener.breaker,
+})
+loop_lag_monitor = metrics.LoopLagMonitor()
+
+def apply_settings(old: Config, new: Config):
+    """Bring dependent components in line with a new settings snapshot"""
+    if (old.shortener_api_url, old.shortener_api_key) != (new.shortener_api_url, new.shortener_api_key):
+        shortener.configure(new.shortener_api_url, new.shortener_api_key)
+    # Added or removed force-sub chats must not be answered from cached lookups
+    old_chats = set(old.force_sub_channels + old.force_sub_groups)
+    new_chats = set(new.force_sub_channels + new.force_sub_groups)
+    for chat in old_chats ^ new_chats:
+        force_sub_checker.invalidate_chat(chat)
+    if old.user_cache_generation != new.user_cache_generation:
+        db.users.forget_all()
+
+settings_store.on_change(apply_settings)
+
+async def invalidate_user_caches():
+    """Make every worker drop its cached profiles, after users were deleted or overwritten in bulk"""
     try:
-        params = {
-            "api": SHORTENER_API_KEY,
-            "url": long_url,
-            "format": "text"  # Get plain text response
-        }
-        
-        response = requests.get(SHORTENER_API_URL, params=params, timeout=10)
-        response.raise_for_status()
-        
-        return response.text.strip()
+        await settings_store.bump("user_cache_generation")
     except Exception as e:
-        logger.error(f"Shortener API error: {e}")
-        return long_url
+        logger.error(f"User cache invalidation failed: {e}")
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    user_data = users_col.find_one({"_id": user_id})
-    
-    if not user_data:
-        users_col.insert_one({
-            "_id": user_id,
-            "username": update.effective_user.username,
-            "channel": None,
-            "premium": False,
-            "last_verified": None
-        })
-    
-    # Check force subscription
-    if not await check_force_sub(update, context, user_id):
+# Facts the guards and handlers of an update share, each resolved at most once per update
+async def resolve_profile(request: Request):
+    return await db.users.get(request.user_id)
+
+async def resolve_premium(request: Request) -> bool:
+    # Owner and cached premium users are known from the tier without a lookup
+    if request.tier != FREE:
+        return True
+    return bool((await request.resolve("profile") or {}).get("premium"))
+
+async def resolve_verified(request: Request) -> bool:
+    if request.tier != FREE:
+        return True
+    return database.profile_verified(await request.resolve("profile"))
+
+async def resolve_missing_chats(request: Request) -> tuple:
+    """(channels, groups) the user still has to join"""
+    settings = settings_store.current
+    if request.is_owner or (not settings.force_sub_channels and not settings.force_sub_groups):
+        return [], []
+    # Check channel and group subscriptions concurrently
+    return tuple(await asyncio.gather(
+        force_sub_checker.missing(request.bot, request.user_id, settings.force_sub_channels),
+        force_sub_checker.missing(request.bot, request.user_id, settings.force_sub_groups)
+    ))
+
+REQUEST_RESOLVERS = {
+    "profile": resolve_profile,
+    "premium": resolve_premium,
+    "verified": resolve_verified,
+    "missing_chats": resolve_missing_chats,
+}
+
+# Guards handlers declare with @requires, each one replies to the user when it fails
+async def owner_only(update: Update, context: RequestContext) -> bool:
+    if context.request.is_owner:
+        return True
+    await update.effective_message.reply_text("❌ Owner only command!")
+    return False
+
+@timed("check_force_sub")
+async def force_subscribed(update: Update, context: RequestContext) -> bool:
+    missing_channels, missing_groups = await context.request.resolve("missing_chats")
+    if not missing_channels and not missing_groups:
+        return True
+    
+    # Create join buttons
+    channel_links, group_links = await asyncio.gather(
+        force_sub_checker.join_links(context.bot, missing_channels, "Join Channel"),
+        force_sub_checker.join_links(context.bot, missing_groups, "Join Group")
+    )
+    buttons = [[InlineKeyboardButton(label, url=url)] for label, url in channel_links + group_links]
+    buttons.append([InlineKeyboardButton("✅ I've Joined", callback_data="force_sub_verify")])
+    
+    analytics.record(FORCE_SUB_PROMPTS)
+    await update.effective_message.reply_text(
+        "📢 To use Save Restricted Content Bot, please join our channels and groups:",
+        reply_markup=InlineKeyboardMarkup(buttons)
+    )
+    return False
+
+@timed("check_verification")
+async def verified(update: Update, context: RequestContext) -> bool:
+    # Premium users don't need verification, everyone else until verified_until
+    if await context.request.resolve("verified"):
+        return True
+    await require_verification(update, context)
+    return False
+
+@timed("start")
+async def start(update: Update, context: RequestContext):
+    # Verification links open the bot with /start verify_<token>
+    if context.args and context.args[0].startswith(VERIFY_START_PREFIX):
+        await complete_verification(update, context.args[0][len(VERIFY_START_PREFIX):])
         return
     
+    if await force_subscribed(update, context):
+        await send_welcome(update.message)
+
+async def send_welcome(message):
     welcome_msg = (
         "🔓 *Save Restricted Content Bot*\n"
         "I can bypass forwarding restrictions!\n\n"
@@ -129,119 +415,48 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "💎 Use /premium for exclusive features"
     )
     
-    await update.message.reply_text(
+    await message.reply_text(
         welcome_msg,
         parse_mode="MarkdownV2"
     )
 
-async def check_force_sub(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
-    if user_id == OWNER_ID:
-        return True
-        
-    if not FORCE_SUB_CHANNELS and not FORCE_SUB_GROUPS:
-        return True
-        
-    missing_channels = []
-    missing_groups = []
-    
-    # Check channel subscriptions
-    for channel in FORCE_SUB_CHANNELS:
-        try:
-            member = await context.bot.get_chat_member(chat_id=channel, user_id=user_id)
-            if member.status in ['left', 'kicked']:
-                missing_channels.append(channel)
-        except Exception as e:
-            logger.error(f"Force sub check error: {e}")
-            missing_channels.append(channel)
-    
-    # Check group subscriptions
-    for group in FORCE_SUB_GROUPS:
-        try:
-            member = await context.bot.get_chat_member(chat_id=group, user_id=user_id)
-            if member.status in ['left', 'kicked']:
-                missing_groups.append(group)
-        except Exception as e:
-            logger.error(f"Force sub check error: {e}")
-            missing_groups.append(group)
-    
-    if not missing_channels and not missing_groups:
-        return True
-    
-    # Create join buttons
-    buttons = []
-    for channel in missing_channels:
-        try:
-            chat = await context.bot.get_chat(channel)
-            buttons.append([InlineKeyboardButton(f"Join {chat.title}", url=f"https://t.me/{chat.username}")])
-        except:
-            buttons.append([InlineKeyboardButton(f"Join Channel", url=f"https://t.me/{channel}")])
-    
-    for group in missing_groups:
-        try:
-            chat = await context.bot.get_chat(group)
-            buttons.append([InlineKeyboardButton(f"Join {chat.title}", url=f"https://t.me/{chat.username}")])
-        except:
-            buttons.append([InlineKeyboardButton(f"Join Group", url=f"https://t.me/{group}")])
-    
-    buttons.append([InlineKeyboardButton("✅ I've Joined", callback_data="force_sub_verify")])
-    
-    await update.message.reply_text(
-        "📢 To use Save Restricted Content Bot, please join our channels and groups:",
-        reply_markup=InlineKeyboardMarkup(buttons)
-    )
-    return False
-
-async def force_sub_verify(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed("force_sub_verify")
+async def force_sub_verify(update: Update, context: RequestContext):
     query = update.callback_query
-    await query.answer()
     
-    user_id = query.from_user.id
-    if await check_force_sub(query, context, user_id):
+    # Drop cached results so the user's fresh joins are picked up immediately
+    settings = settings_store.current
+    force_sub_checker.invalidate_user(query.from_user.id, settings.force_sub_channels + settings.force_sub_groups)
+    context.request.forget("missing_chats")
+    missing_channels, missing_groups = await context.request.resolve("missing_chats")
+    if not missing_channels and not missing_groups:
+        await query.answer()
+        analytics.record(FORCE_SUB_JOINS)
         await query.edit_message_text("✅ Thanks for joining! You can now use the bot.")
-        await start(query, context)
+        await send_welcome(query.message)
     else:
         await query.answer("Please join all required channels and groups first!", show_alert=True)
 
-async def check_verification(user_id: int) -> bool:
-    if user_id == OWNER_ID:
-        return True
-        
-    user_data = users_col.find_one({"_id": user_id})
-    if not user_data:
-        return False
-    
-    # Premium users don't need verification
-    if user_data.get("premium", False):
-        return True
-    
-    # Check verification status
-    last_verified = user_data.get("last_verified")
-    if not last_verified:
-        return False
-    
-    # Check if verification has expired
-    verification_expiry = last_verified + timedelta(hours=VERIFICATION_INTERVAL)
-    return datetime.utcnow() < verification_expiry
-
-async def require_verification(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed("require_verification")
+async def require_verification(update: Update, context: RequestContext):
     user_id = update.effective_user.id
-    if await check_verification(user_id):
-        return True
-    
-    # Generate unique verification token
-    token = secrets.token_urlsafe(16)
-    users_col.update_one(
-        {"_id": user_id},
-        {"$set": {"verify_token": token}}
-    )
     
-    # Create verification URL
-    verification_url = f"https://t.me/{context.bot.username}?start=verify_{token}"
-    
-    # Generate short URL using API
-    short_url = await generate_short_url(verification_url)
-    
-    await update.message.reply_text(
+    # Repeated requests reuse the link sent a moment ago instead of minting another one
+    short_url = verify_links.get(user_id)
+    if short_url is MISSING:
+        # The renewal job usually prepared a link before the verification lapsed
+        user_data = await context.request.resolve("profile")
+        renewal = (user_data or {}).get("renewal_link")
+        if renewal and renewal["expires_at"] > datetime.utcnow():
+            short_url = renewal["url"]
+        else:
+            # Take a pre-shortened verification link (or shorten one now) and bind its token to the user
+            token, short_url = await shortener.verification_link(context.bot.username)
+            await db.verify_tokens.issue(token, user_id, timedelta(seconds=VERIFY_TOKEN_TTL))
+        verify_links.set(user_id, short_url)
+    
+    analytics.record(VERIFY_PROMPTS)
+    await update.effective_message.reply_text(
         "⏳ Your session has expired. Please verify to continue using Save Restricted Content Bot:\n\n"
         f"🔗 [Click here to verify]({short_url})",
         parse_mode="Markdown",
@@ -251,36 +466,30 @@ async def require_verification(update: Update, context: ContextTypes.DEFAULT_TYP
     )
     return False
 
+@timed("verify_user")
 async def verify_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
     args = context.args
     
     if not args:
         await update.message.reply_text("Please provide a verification token")
         return
     
-    token = args[0]
-    user_data = users_col.find_one({"_id": user_id})
-    
-    if user_data and user_data.get("verify_token") == token:
-        users_col.update_one(
-            {"_id": user_id},
-            {"$set": {"last_verified": datetime.utcnow()}, "$unset": {"verify_token": ""}}
-        )
+    await complete_verification(update, args[0])
+
+async def complete_verification(update: Update, token: str):
+    user_id = update.effective_user.id
+    if await db.verify_tokens.redeem(token, user_id):
+        interval = timedelta(hours=settings_store.current.verification_interval)
+        await db.users.mark_verified(user_id, interval)
+        verify_links.pop(user_id)
+        analytics.record(VERIFICATIONS)
         await update.message.reply_text("✅ Verification successful! You can now use the bot.")
     else:
-        await update.message.reply_text("❌ Invalid verification token")
+        await update.message.reply_text("❌ Invalid or expired verification token")
 
-async def set_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Check force subscription
-    if not await check_force_sub(update, context, update.effective_user.id):
-        return
-    
-    # Check verification for non-owner
-    if update.effective_user.id != OWNER_ID and not await check_verification(update.effective_user.id):
-        await require_verification(update, context)
-        return
-    
+@timed("set_channel")
+@requires(force_subscribed, verified)
+async def set_channel(update: Update, context: RequestContext):
     user_id = update.effective_user.id
     args = context.args
     
@@ -289,36 +498,68 @@ async def set_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     channel_username = args[0].lstrip('@')
-    users_col.update_one(
-        {"_id": user_id},
-        {"$set": {"channel": channel_username}}
-    )
+    await db.users.set_channel(user_id, channel_username)
     
     await update.message.reply_text(f"✅ Channel set: @{channel_username}\nNow send restricted content!")
 
-async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Check force subscription
-    if not await check_force_sub(update, context, update.effective_user.id):
-        return
-    
-    # Check verification for non-owner
-    if update.effective_user.id != OWNER_ID and not await check_verification(update.effective_user.id):
-        await require_verification(update, context)
-        return
-    
+@timed("handle_media")
+@requires(force_subscribed, verified)
+async def handle_media(update: Update, context: RequestContext):
     user_id = update.effective_user.id
-    user_data = users_col.find_one({"_id": user_id})
+    # Already loaded by the verification check, unless the tier let it skip the lookup
+    user_data = await context.request.resolve("profile")
     
     if not user_data or not user_data.get("channel"):
         await update.message.reply_text("❌ Please set a channel first using /setchannel")
         return
     
     target_channel = f"@{user_data['channel']}"
+    media = media_file(update.message)
+    media_counter = MEDIA_PREFIX + (media[0] if media else "other")
+    
+    # Albums and batch sessions are buffered and delivered together
+    if update.message.media_group_id or media_batcher.in_session(user_id):
+        file_unique_id = media[2] if media else None
+        duplicate = False
+        if media and not await delivery_ledger.claim(
+            file_unique_id, target_channel, user_id=user_id, kind=media[0], file_id=media[1]
+        ):
+            DUPLICATE_DELIVERIES.labels("channel").inc()
+            duplicate = True
+        result = media_batcher.add(
+            context.bot, user_id, update.message.chat_id, update.message.message_id, target_channel,
+            media_group_id=update.message.media_group_id, file_unique_id=file_unique_id, duplicate=duplicate
+        )
+        if result != ADDED and media and not duplicate:
+            # Not going out with the batch, the file may be sent again
+            await delivery_ledger.release(file_unique_id, target_channel)
+        if result == LIMIT_REACHED:
+            await update.message.reply_text(
+                "📦 Batch limit reached. Use /batchsave to start a new batch\n"
+                "💎 Premium users get larger batches, see /premium"
+            )
+        elif result == ADDED and not duplicate:
+            analytics.record(media_counter)
+        return
+    
+    # The file id lets "Send to me" resend the file even when this message is gone
+    callback_data = f"send_to_me:{media[2]}" if media else "send_to_me"
     keyboard = [
-        [InlineKeyboardButton("📩 Send to me", callback_data="send_to_me")]
+        [InlineKeyboardButton("📩 Send to me", callback_data=callback_data)]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
+    if media:
+        kind, file_id, file_unique_id = media
+        delivery_ledger.remember(update.message)
+        if not await delivery_ledger.claim(file_unique_id, target_channel, user_id=user_id, kind=kind, file_id=file_id):
+            DUPLICATE_DELIVERIES.labels("channel").inc()
+            await update.message.reply_text(
+                f"♻️ This media was already forwarded to {target_channel} recently, skipped\nWant it in your DM?",
+                reply_markup=reply_markup
+            )
+            return
+    
     try:
         # Forward media to target channel
         await context.bot.forward_message(
@@ -326,202 +567,438 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
             from_chat_id=update.message.chat_id,
             message_id=update.message.message_id
         )
-        
-        # Confirmation message with button
-        await update.message.reply_text(
-            f"✅ Media forwarded successfully to {target_channel}\nWant it in your DM?",
-            reply_markup=reply_markup
-        )
     except Exception as e:
         logger.error(f"Forwarding error: {e}")
+        if media:
+            await delivery_ledger.release(media[2], target_channel)
         await update.message.reply_text("❌ Failed to forward media. Make sure I'm admin in target channel!")
+        return
+    
+    analytics.record(media_counter)
+    # Confirmation message with button
+    await update.message.reply_text(
+        f"✅ Media forwarded successfully to {target_channel}\nWant it in your DM?",
+        reply_markup=reply_markup
+    )
 
+@timed("button_handler")
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
+    if query.data == "force_sub_verify":
+        # Answered there, with an alert while chats are still missing
+        await force_sub_verify(update, context)
+        return
     await query.answer()
     
-    if query.data == "send_to_me":
+    if query.data == "send_to_me" or query.data.startswith("send_to_me:"):
+        await send_to_me(query, context)
+    
+    elif query.data.startswith("send_batch:"):
+        user_id = query.from_user.id
+        item = f"batch:{query.data.split(':', 1)[1]}"
+        if not await delivery_ledger.claim(item, user_id):
+            DUPLICATE_DELIVERIES.labels("dm").inc()
+            await query.edit_message_text("✅ Already sent to your personal messages!")
+            return
         try:
-            # Forward to user privately
-            await context.bot.forward_message(
-                chat_id=query.from_user.id,
-                from_chat_id=query.message.chat_id,
-                message_id=query.message.reply_to_message.message_id
-            )
-            await query.edit_message_text("✅ Sent to your personal messages!")
+            if await media_batcher.send_to_user(context.bot, user_id, query.data.split(":", 1)[1]):
+                await query.edit_message_text("✅ Sent to your personal messages!")
+            else:
+                await delivery_ledger.release(item, user_id)
+                await query.edit_message_text("⌛ This batch is too old, please send the media again")
         except Exception as e:
-            logger.error(f"Personal forward error: {e}")
+            logger.error(f"Personal batch forward error: {e}")
+            await delivery_ledger.release(item, user_id)
             await query.edit_message_text("❌ Failed to send. Please start a DM with me first!")
-    
-    elif query.data == "force_sub_verify":
-        await force_sub_verify(update, context)
 
-# Owner commands
-async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != OWNER_ID:
-        await update.message.reply_text("❌ Owner only command!")
+async def send_to_me(query, context: ContextTypes.DEFAULT_TYPE):
+    """Forward the media a confirmation replies to privately, by cached file_id once the original is gone"""
+    user_id = query.from_user.id
+    original = query.message.reply_to_message
+    file_unique_id = query.data.partition(":")[2]
+    media = delivery_ledger.remember(original)
+    if media:
+        file_unique_id = media[2]
+    file = None
+    if original is None and file_unique_id:
+        file = delivery_ledger.lookup(file_unique_id)
+    
+    if file is None and original is None:
+        await query.edit_message_text("⌛ This media is too old, please send it again")
+        return
+    
+    if file_unique_id and not await delivery_ledger.claim(file_unique_id, user_id):
+        DUPLICATE_DELIVERIES.labels("dm").inc()
+        await query.edit_message_text("✅ Already sent to your personal messages!")
         return
     
+    try:
+        if file is not None:
+            await send_file(context.bot, user_id, *file)
+        else:
+            # Forward to user privately, the original keeps its caption and formatting
+            await context.bot.forward_message(
+                chat_id=user_id,
+                from_chat_id=query.message.chat_id,
+                message_id=original.message_id
+            )
+        await query.edit_message_text("✅ Sent to your personal messages!")
+    except Exception as e:
+        logger.error(f"Personal forward error: {e}")
+        if file_unique_id:
+            await delivery_ledger.release(file_unique_id, user_id)
+        await query.edit_message_text("❌ Failed to send. Please start a DM with me first!")
+
+# Owner commands
+@timed("broadcast")
+@requires(owner_only)
+async def broadcast(update: Update, context: RequestContext):
     if not context.args:
         await update.message.reply_text("Usage: /broadcast <message>")
         return
     
+    if broadcaster.running:
+        await update.message.reply_text("⚠️ A broadcast is already running, check /broadcaststatus")
+        return
+    
     message = " ".join(context.args)
-    users = users_col.find()
-    count = 0
+    with database.maintenance():
+        job = await broadcaster.start(context.bot, message)
+    await update.message.reply_text(
+        f"✅ Broadcast started for {job['total']} users\n"
+        "Use /broadcaststatus to follow its progress"
+    )
+
+@timed("broadcast_status")
+@requires(owner_only)
+async def broadcast_status(update: Update, context: RequestContext):
+    status = await broadcaster.status()
+    if not status:
+        await update.message.reply_text("ℹ️ No broadcasts yet")
+        return
     
-    for user in users:
-        try:
-            await context.bot.send_message(
-                chat_id=user["_id"],
-                text=f"📢 Broadcast from Save Restricted Content Bot:\n\n{message}"
-            )
-            count += 1
-        except Exception as e:
-            logger.error(f"Broadcast error to {user['_id']}: {e}")
+    total = status["total"]
+    percent = status["processed"] / total if total else 1.0
+    lines = [
+        f"📢 Broadcast {status['_id']} ({status['status']})",
+        f"Progress: {status['processed']}/{total} ({percent:.1%})",
+        f"Sent: {status['sent']}",
+        f"Failed: {status['failed']}",
+        f"Blocked: {status['blocked']}",
+    ]
+    if status["eta"] is not None:
+        lines.append(f"ETA: {timedelta(seconds=int(status['eta']))}")
+    await update.message.reply_text("\n".join(lines))
+
+@timed("resetall")
+@requires(owner_only)
+async def resetall(update: Update, context: RequestContext):
+    if admin_jobs.running:
+        await update.message.reply_text("⚠️ A maintenance job is already running, check /jobstatus")
+        return
     
-    await update.message.reply_text(f"✅ Broadcast sent to {count} users")
+    async def on_finish(job):
+        await invalidate_user_caches()
+        if job.status == jobs.DONE:
+            await context.bot.send_message(OWNER_ID, f"✅ All data has been reset ({job.result} records deleted)")
+        else:
+            await context.bot.send_message(OWNER_ID, f"⚠️ Reset {job.status}: {job.processed} records deleted")
+    
+    with database.maintenance():
+        total = await db.count_for_reset()
+        admin_jobs.start(
+            "resetall",
+            lambda job: jobs.reset_all(db, job, ADMIN_JOB_BATCH_SIZE),
+            total=total,
+            on_finish=on_finish
+        )
+    await update.message.reply_text(f"🧹 Reset started for {total} records, use /jobstatus to follow it")
 
-async def resetall(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != OWNER_ID:
-        await update.message.reply_text("❌ Owner only command!")
+@timed("export_users")
+@requires(owner_only)
+async def export_users(update: Update, context: RequestContext):
+    if admin_jobs.running:
+        await update.message.reply_text("⚠️ A maintenance job is already running, check /jobstatus")
         return
     
-    users_col.delete_many({})
-    channels_col.delete_many({})
-    await update.message.reply_text("✅ All data has been reset")
+    fd, path = tempfile.mkstemp(prefix="users-", suffix=EXPORT_SUFFIX)
+    os.close(fd)
+    
+    async def on_finish(job):
+        try:
+            if job.status == jobs.DONE:
+                with open(path, "rb") as f:
+                    await context.bot.send_document(
+                        OWNER_ID, f, filename=f"users{EXPORT_SUFFIX}",
+                        caption=f"✅ Exported {job.result} users, restore with /importusers"
+                    )
+            else:
+                await context.bot.send_message(OWNER_ID, f"⚠️ Export {job.status}")
+        finally:
+            os.remove(path)
+    
+    with database.maintenance():
+        admin_jobs.start(
+            "exportusers",
+            lambda job: jobs.export_users(db, job, path, ADMIN_JOB_BATCH_SIZE),
+            total=await db.users.count(),
+            on_finish=on_finish
+        )
+    await update.message.reply_text("📤 Export started, the file will be sent here when it is ready")
 
-async def add_fchannel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != OWNER_ID:
-        await update.message.reply_text("❌ Owner only command!")
+@timed("import_users")
+@requires(owner_only)
+async def import_users(update: Update, context: RequestContext):
+    reply = update.message.reply_to_message
+    document = reply.document if reply else None
+    if not document or not (document.file_name or "").endswith(EXPORT_SUFFIX):
+        await update.message.reply_text(f"Reply to a {EXPORT_SUFFIX} file from /exportusers with /importusers")
+        return
+    
+    if admin_jobs.running:
+        await update.message.reply_text("⚠️ A maintenance job is already running, check /jobstatus")
         return
     
+    fd, path = tempfile.mkstemp(prefix="import-", suffix=EXPORT_SUFFIX)
+    os.close(fd)
+    file = await context.bot.get_file(document.file_id)
+    await file.download_to_drive(path)
+    
+    async def on_finish(job):
+        await invalidate_user_caches()
+        try:
+            if job.status == jobs.DONE:
+                await context.bot.send_message(
+                    OWNER_ID,
+                    f"✅ Imported {job.processed} users "
+                    f"({job.result['upserted']} new, {job.result['matched']} updated)"
+                )
+            else:
+                await context.bot.send_message(OWNER_ID, f"⚠️ Import {job.status} after {job.processed} users")
+        finally:
+            os.remove(path)
+    
+    with database.maintenance():
+        admin_jobs.start(
+            "importusers",
+            lambda job: jobs.import_users(db, job, path, ADMIN_JOB_BATCH_SIZE),
+            on_finish=on_finish
+        )
+    await update.message.reply_text("📥 Import started, use /jobstatus to follow it")
+
+@timed("job_status")
+@requires(owner_only)
+async def job_status(update: Update, context: RequestContext):
+    job = admin_jobs.current
+    if job is None:
+        await update.message.reply_text("ℹ️ No maintenance jobs yet")
+        return
+    
+    progress = f"{job.processed}/{job.total}" if job.total is not None else str(job.processed)
+    lines = [
+        f"🛠 {job.name} #{job.id} ({job.status})",
+        f"Progress: {progress}",
+        f"Elapsed: {timedelta(seconds=int(job.elapsed))}",
+    ]
+    if job.eta is not None:
+        lines.append(f"ETA: {timedelta(seconds=int(job.eta))}")
+    if job.error:
+        lines.append(f"Error: {job.error}")
+    earlier = [previous for previous in admin_jobs.history if previous is not job]
+    if earlier:
+        lines.append("\nEarlier jobs:")
+        for previous in reversed(earlier):
+            lines.append(f"#{previous.id} {previous.name}: {previous.status}, {previous.processed} items")
+    await update.message.reply_text("\n".join(lines))
+
+@timed("cancel_job")
+@requires(owner_only)
+async def cancel_job(update: Update, context: RequestContext):
+    if await admin_jobs.cancel():
+        await update.message.reply_text("🛑 Maintenance job cancelled")
+    else:
+        await update.message.reply_text("ℹ️ No maintenance job is running")
+
+@timed("add_fchannel")
+@requires(owner_only)
+async def add_fchannel(update: Update, context: RequestContext):
     args = context.args
     if not args:
         await update.message.reply_text("Usage: /addfchannel @channel_username")
         return
     
     channel = args[0].lstrip('@')
-    if channel not in FORCE_SUB_CHANNELS:
-        FORCE_SUB_CHANNELS.append(channel)
-        force_sub_col.update_one(
-            {"_id": "force_sub_data"},
-            {"$set": {"channels": FORCE_SUB_CHANNELS}}
-        )
+    if channel not in settings_store.current.force_sub_channels:
+        await settings_store.add("force_sub_channels", channel)
         await update.message.reply_text(f"✅ Force-sub channel added: @{channel}")
     else:
         await update.message.reply_text("⚠️ Channel already in force-sub list")
 
-async def add_fgroup(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != OWNER_ID:
-        await update.message.reply_text("❌ Owner only command!")
-        return
-    
+@timed("add_fgroup")
+@requires(owner_only)
+async def add_fgroup(update: Update, context: RequestContext):
     args = context.args
     if not args:
         await update.message.reply_text("Usage: /addfgroup @group_username")
         return
     
     group = args[0].lstrip('@')
-    if group not in FORCE_SUB_GROUPS:
-        FORCE_SUB_GROUPS.append(group)
-        force_sub_col.update_one(
-            {"_id": "force_sub_data"},
-            {"$set": {"groups": FORCE_SUB_GROUPS}}
-        )
+    if group not in settings_store.current.force_sub_groups:
+        await settings_store.add("force_sub_groups", group)
         await update.message.reply_text(f"✅ Force-sub group added: @{group}")
     else:
         await update.message.reply_text("⚠️ Group already in force-sub list")
 
-async def remove_fchannel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != OWNER_ID:
-        await update.message.reply_text("❌ Owner only command!")
-        return
-    
+@timed("remove_fchannel")
+@requires(owner_only)
+async def remove_fchannel(update: Update, context: RequestContext):
     args = context.args
     if not args:
         await update.message.reply_text("Usage: /removefchannel @channel_username")
         return
     
     channel = args[0].lstrip('@')
-    if channel in FORCE_SUB_CHANNELS:
-        FORCE_SUB_CHANNELS.remove(channel)
-        force_sub_col.update_one(
-            {"_id": "force_sub_data"},
-            {"$set": {"channels": FORCE_SUB_CHANNELS}}
-        )
+    if channel in settings_store.current.force_sub_channels:
+        await settings_store.remove("force_sub_channels", channel)
         await update.message.reply_text(f"✅ Force-sub channel removed: @{channel}")
     else:
         await update.message.reply_text("⚠️ Channel not in force-sub list")
 
-async def remove_fgroup(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != OWNER_ID:
-        await update.message.reply_text("❌ Owner only command!")
-        return
-    
+@timed("remove_fgroup")
+@requires(owner_only)
+async def remove_fgroup(update: Update, context: RequestContext):
     args = context.args
     if not args:
         await update.message.reply_text("Usage: /removefgroup @group_username")
         return
     
     group = args[0].lstrip('@')
-    if group in FORCE_SUB_GROUPS:
-        FORCE_SUB_GROUPS.remove(group)
-        force_sub_col.update_one(
-            {"_id": "force_sub_data"},
-            {"$set": {"groups": FORCE_SUB_GROUPS}}
-        )
+    if group in settings_store.current.force_sub_groups:
+        await settings_store.remove("force_sub_groups", group)
         await update.message.reply_text(f"✅ Force-sub group removed: @{group}")
     else:
         await update.message.reply_text("⚠️ Group not in force-sub list")
 
-async def set_verify_interval(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != OWNER_ID:
-        await update.message.reply_text("❌ Owner only command!")
-        return
-    
+@timed("set_verify_interval")
+@requires(owner_only)
+async def set_verify_interval(update: Update, context: RequestContext):
     args = context.args
     if not args or not args[0].isdigit():
         await update.message.reply_text("Usage: /setverifyinterval <hours>")
         return
     
-    global VERIFICATION_INTERVAL
-    VERIFICATION_INTERVAL = int(args[0])
-    os.environ["VERIFICATION_INTERVAL"] = str(VERIFICATION_INTERVAL)
-    await update.message.reply_text(f"✅ Verification interval set to {VERIFICATION_INTERVAL} hours")
+    settings = await settings_store.set(verification_interval=int(args[0]))
+    await update.message.reply_text(f"✅ Verification interval set to {settings.verification_interval} hours")
 
-async def set_shortener(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != OWNER_ID:
-        await update.message.reply_text("❌ Owner only command!")
-        return
-    
+@timed("set_shortener")
+@requires(owner_only)
+async def set_shortener(update: Update, context: RequestContext):
     args = context.args
     if len(args) < 2:
         await update.message.reply_text("Usage: /setshortener <api_url> <api_key>")
         return
     
-    global SHORTENER_API_URL, SHORTENER_API_KEY
-    SHORTENER_API_URL = args[0]
-    SHORTENER_API_KEY = args[1]
+    # Reconfigures the shortener here and, through the version poll, in every other worker
+    await settings_store.set(shortener_api_url=args[0], shortener_api_key=args[1])
     
     # Test the API
     test_url = "https://google.com"
     try:
-        short_url = await generate_short_url(test_url)
+        short_url = await shortener.shorten(test_url)
         await update.message.reply_text(
             f"✅ Shortener API configured successfully!\n"
             f"Test URL: {test_url}\n"
             f"Short URL: {short_url}"
         )
+        shortener.start_refill(context.bot.username)
     except Exception as e:
         await update.message.reply_text(f"❌ Error testing shortener API: {e}")
 
-# Additional commands
-async def premium(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Check force subscription
-    if not await check_force_sub(update, context, update.effective_user.id):
+@timed("cache_stats")
+@requires(owner_only)
+async def cache_stats(update: Update, context: RequestContext):
+    lines = []
+    for name, cache in (
+        ("User cache", user_cache),
+        ("Force-sub memberships", force_sub_checker.memberships),
+        ("Force-sub chats", force_sub_checker.chats),
+    ):
+        stats = cache.stats()
+        lines.append(
+            f"📊 {name}\n"
+            f"Entries: {stats['size']}/{stats['maxsize']}\n"
+            f"Hits: {stats['hits']}\n"
+            f"Misses: {stats['misses']}\n"
+            f"Hit ratio: {stats['hit_ratio']:.1%}"
+        )
+    await update.message.reply_text("\n\n".join(lines))
+
+@timed("queue_stats")
+@requires(owner_only)
+async def queue_stats(update: Update, context: RequestContext):
+    snapshot = context.application.update_processor.snapshot()
+    lines = []
+    for tier in TIERS:
+        stats = snapshot[tier]
+        lines.append(
+            f"⚡ {tier.capitalize()}\n"
+            f"Queued: {stats['depth']}\n"
+            f"Processed: {stats['processed']}\n"
+            f"Avg wait: {stats['avg_wait'] * 1000:.0f} ms\n"
+            f"Max wait: {stats['max_wait'] * 1000:.0f} ms"
+        )
+    await update.message.reply_text("\n\n".join(lines))
+
+@timed("api_stats")
+@requires(owner_only)
+async def api_stats(update: Update, context: RequestContext):
+    snapshot = outbound_limiter.snapshot()
+    if not snapshot:
+        await update.message.reply_text("ℹ️ No Bot API calls yet")
         return
     
+    lines = []
+    for endpoint, stats in snapshot.items():
+        errors = ", ".join(f"{name}: {count}" for name, count in stats["errors"].items()) or "none"
+        lines.append(
+            f"🌐 {endpoint}\n"
+            f"Calls: {stats['calls']} (retries: {stats['retries']})\n"
+            f"Avg: {stats['avg_time'] * 1000:.0f} ms, max: {stats['max_time'] * 1000:.0f} ms\n"
+            f"Errors: {errors}"
+        )
+    await update.message.reply_text("\n\n".join(lines))
+
+def format_usage(counters) -> str:
+    media = {name[len(MEDIA_PREFIX):]: count for name, count in counters.items() if name.startswith(MEDIA_PREFIX)}
+    media_line = ", ".join(f"{kind} {count}" for kind, count in sorted(media.items())) or "none"
+    conversion = counters[VERIFICATIONS] / counters[VERIFY_PROMPTS] if counters[VERIFY_PROMPTS] else 0.0
+    join_rate = counters[FORCE_SUB_JOINS] / counters[FORCE_SUB_PROMPTS] if counters[FORCE_SUB_PROMPTS] else 0.0
+    return (
+        f"Media forwarded: {sum(media.values())} ({media_line})\n"
+        f"Verifications: {counters[VERIFICATIONS]} of {counters[VERIFY_PROMPTS]} prompts ({conversion:.1%})\n"
+        f"Force-sub joins: {counters[FORCE_SUB_JOINS]} of {counters[FORCE_SUB_PROMPTS]} prompts ({join_rate:.1%})"
+    )
+
+@timed("stats")
+@requires(owner_only)
+async def stats(update: Update, context: RequestContext):
+    # One small document per day, no scan over the users
+    days = await analytics.days(7)
+    today, counters = days[0]
+    week = sum((day_counters for _, day_counters in days), Counter())
+    await update.message.reply_text(
+        f"📈 Today ({today})\n"
+        f"Active users: {counters[ACTIVE_USERS]}\n"
+        f"{format_usage(counters)}\n\n"
+        f"📅 Last 7 days\n"
+        f"Daily active users: {week[ACTIVE_USERS] / len(days):.0f} on average\n"
+        f"{format_usage(week)}"
+    )
+
+# Additional commands
+@timed("premium")
+@requires(force_subscribed)
+async def premium(update: Update, context: RequestContext):
     await update.message.reply_text(
         "🌟 *Save Restricted Content Bot Premium Features*\n\n"
         "💎 *Ad-Free Experience*\n"
@@ -532,33 +1009,236 @@ async def premium(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="Markdown"
     )
 
-async def batchsave(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Check force subscription
-    if not await check_force_sub(update, context, update.effective_user.id):
-        return
-    
-    # Check verification for non-owner
-    if update.effective_user.id != OWNER_ID and not await check_verification(update.effective_user.id):
-        await require_verification(update, context)
-        return
-    
-    await update.message.reply_text("📦 Batch save activated. Send multiple media to Save Restricted Content Bot now...")
+@timed("batchsave")
+@requires(force_subscribed, verified)
+async def batchsave(update: Update, context: RequestContext):
+    is_premium = await context.request.resolve("premium")
+    limit = media_batcher.start_session(update.effective_user.id, is_premium)
+    await update.message.reply_text(
+        "📦 Batch save activated. Send multiple media to Save Restricted Content Bot now...\n"
+        f"Up to {limit} media per batch, use /cancel to stop"
+    )
 
+@timed("logout")
 async def logout(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    users_col.delete_one({"_id": update.effective_user.id})
+    await db.users.delete(update.effective_user.id)
     await update.message.reply_text("✅ You've been logged out from Save Restricted Content Bot")
 
+@timed("cancel")
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await media_batcher.end_session(update.effective_user.id)
     await update.message.reply_text("❌ Current operation canceled in Save Restricted Content Bot")
 
-def main():
-    TOKEN = os.environ.get("TELEGRAM_TOKEN")
+def classify_update(update: object) -> str:
+    """Tier used for update scheduling, from cached data only so it never waits on the database"""
+    user_id = update_user_id(update)
+    if user_id == OWNER_ID:
+        return OWNER
+    # Premium users whose profile is not cached yet count as free until a handler loads it
+    user_data = user_cache.peek(user_id) if user_id is not None else MISSING
+    if user_data is not MISSING and user_data.get("premium", False):
+        return PREMIUM
+    return FREE
+
+def is_primary_worker() -> bool:
+    """The single process, or the worker that receives the owner's updates"""
+    return WORKER_INDEX is None or WORKER_INDEX == cluster.shard_for(OWNER_ID, WORKERS)
+
+async def warmup(application: Application):
+    """Preload what the first updates would otherwise fetch one by one"""
+    settings = settings_store.current
+    users, _ = await asyncio.gather(
+        startup.run("warm_users", db.users.warm(WARMUP_USERS)),
+        startup.run("warm_force_sub", force_sub_checker.warm(
+            application.bot, settings.force_sub_channels + settings.force_sub_groups
+        ))
+    )
+    logger.info(f"Warmup preloaded {users} users")
+
+async def begin_request(update: Update, context: RequestContext):
+    """First handler of every update: records activity, sets up context.request and applies the rate limit.
+
+    Updates of users over their rate limit are dropped here, before any
+    handler touches the database or the API. Media joining an album or a
+    /batchsave session already being collected is not charged, the batch
+    limit caps those; the album's first item and /batchsave are.
+    """
+    user = update.effective_user
+    if user is None:
+        return
+    user_activity.touch(user.id, user.username)
+    
+    tier = classify_update(update)
+    context.request = Request(context.bot, user.id, tier, REQUEST_RESOLVERS)
+    message = update.message
+    if message and media_file(message) and media_batcher.joins_batch(user.id, message.media_group_id):
+        return
+    if user_throttle.allow(tier, user.id):
+        return
+    if tier == FREE:
+        # The tier only knows cached profiles: look a possibly premium user up once, then the cache has it
+        try:
+            premium = await context.request.resolve("premium")
+        except DependencyUnavailable:
+            premium = False
+        if premium:
+            context.request.tier = tier = PREMIUM
+            if user_throttle.allow(tier, user.id):
+                return
+    
+    THROTTLED_UPDATES.labels(tier).inc()
+    # One notice per window, a flood of updates must not turn into a flood of replies
+    if user_throttle.should_notify(user.id):
+        if update.callback_query:
+            await update.callback_query.answer("⏳ Too many requests, please slow down")
+        elif message and media_file(message):
+            await message.reply_text(
+                "⏳ You're sending too fast, media sent right now is not saved\n"
+                "📦 Use /batchsave to send many files at once"
+            )
+        elif update.effective_message:
+            await update.effective_message.reply_text("⏳ You're sending too fast, please slow down a little")
+    raise ApplicationHandlerStop
+
+async def error_handler(update: object, context: RequestContext):
+    """Tell the user to retry when a dependency without a fallback is down, log everything else"""
+    error = context.error
+    if not isinstance(error, DependencyUnavailable):
+        logger.error("Exception while handling an update", exc_info=error)
+        return
     
-    # Create Application
-    application = Application.builder().token(TOKEN).build()
+    logger.warning(f"Update not handled, {error}")
+    if not isinstance(update, Update):
+        return
+    text = "⚠️ Save Restricted Content Bot is having a hiccup, please try again in a minute"
+    try:
+        if update.callback_query:
+            await update.callback_query.answer(text, show_alert=True)
+        elif update.effective_message:
+            await update.effective_message.reply_text(text)
+    except Exception as e:
+        logger.warning(f"Could not notify the user: {e}")
+
+async def send_renewal_reminder(bot, user_id: int, short_url: str):
+    try:
+        await bot.send_message(
+            user_id,
+            "⏰ Your verification expires soon. Renew it now to keep using Save Restricted Content Bot:\n\n"
+            f"🔗 [Click here to verify]({short_url})",
+            parse_mode="Markdown",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔓 Verify Now", url=short_url)]
+            ])
+        )
+    except Forbidden:
+        await db.users.mark_blocked([user_id])
+    except Exception as e:
+        logger.error(f"Renewal reminder to {user_id} failed: {e}")
+
+async def renewal_job(context: ContextTypes.DEFAULT_TYPE):
+    bot = context.bot
+    
+    async def notify(user_id, short_url):
+        await send_renewal_reminder(bot, user_id, short_url)
+    
+    with database.maintenance():
+        prepared = await housekeeping.prepare_renewals(
+            db, shortener, bot.username,
+            lead=timedelta(seconds=RENEWAL_LEAD),
+            token_ttl=timedelta(seconds=VERIFY_TOKEN_TTL),
+            notify=notify if RENEWAL_REMINDERS else None,
+            rate=REMINDER_RATE
+        )
+    if prepared:
+        logger.info(f"Prepared {prepared} renewal links")
+
+async def prune_job(context: ContextTypes.DEFAULT_TYPE):
+    with database.maintenance():
+        pruned = await housekeeping.prune_blocked(db, timedelta(days=PRUNE_BLOCKED_AFTER), ADMIN_JOB_BATCH_SIZE)
+    if pruned:
+        logger.info(f"Pruned {pruned} users that blocked the bot")
+
+def schedule_jobs(application: Application):
+    """Register the periodic housekeeping jobs, on one worker only"""
+    if application.job_queue is None:
+        logger.warning("Job queue unavailable, install python-telegram-bot[job-queue] for scheduled jobs")
+        return
+    application.job_queue.run_repeating(
+        renewal_job, interval=RENEWAL_SCAN_INTERVAL, first=RENEWAL_SCAN_INTERVAL, name="renewals"
+    )
+    if PRUNE_BLOCKED_AFTER:
+        application.job_queue.run_repeating(prune_job, interval=PRUNE_INTERVAL, first=PRUNE_INTERVAL, name="prune")
+
+async def post_init(application: Application):
+    loop_lag_monitor.start()
+    
+    async def load_settings():
+        await settings_store.load()
+        with database.maintenance():
+            await db.migrate(timedelta(hours=settings_store.current.verification_interval))
+    
+    # Database, Bot API and settings are independent, bring them up concurrently
+    stage = [
+        startup.run("database", db.ping()),
+        startup.run("settings", load_settings()),
+    ]
+    # Bot-wide one-off work happens once, where /broadcast and /broadcaststatus are handled
+    if is_primary_worker():
+        stage.append(startup.run("commands", application.bot.set_my_commands(COMMANDS)))
+    await asyncio.gather(*stage)
+    
+    with startup.phase("warmup"), database.maintenance():
+        await warmup(application)
+    settings_store.start()
+    analytics.start()
+    user_activity.start()
+    if is_primary_worker():
+        with database.maintenance():
+            await broadcaster.resume(application.bot)
+        schedule_jobs(application)
+    shortener.start_refill(application.bot.username)
+
+async def post_shutdown(application: Application):
+    await loop_lag_monitor.stop()
+    await settings_store.stop()
+    await admin_jobs.stop()
+    await broadcaster.stop()
+    # The activity flush counts active users into analytics, so analytics flushes last
+    await user_activity.stop()
+    await analytics.stop()
+    await shortener.close()
+    db.close()
+
+def build_application(token: str, base_url: str = None) -> Application:
+    """Create the Application with all handlers; ``base_url`` points the bot at another Bot API server"""
+    builder = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(PriorityUpdateProcessor(
+            classify_update,
+            workers=UPDATE_WORKERS,
+            max_pending=UPDATE_MAX_PENDING,
+            max_pending_per_user=UPDATE_MAX_PENDING_PER_USER
+        ))
+        .rate_limiter(outbound_limiter)
+        .context_types(ContextTypes(context=RequestContext))
+        .connection_pool_size(BOT_API_POOL_SIZE)
+        .pool_timeout(BOT_API_POOL_TIMEOUT)
+        .connect_timeout(BOT_API_CONNECT_TIMEOUT)
+        .read_timeout(BOT_API_READ_TIMEOUT)
+        .write_timeout(BOT_API_WRITE_TIMEOUT)
+        # getUpdates has its own connection; its read timeout is added to POLL_TIMEOUT
+        .get_updates_connect_timeout(BOT_API_CONNECT_TIMEOUT)
+        .get_updates_read_timeout(BOT_API_READ_TIMEOUT)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
     
-    # Load force sub data
-    application.create_task(load_force_sub_data())
+    # Activity tracking, the request context and the per-user rate limit come before every other handler
+    application.add_handler(TypeHandler(Update, begin_request), group=-1)
     
     # Add handlers
     application.add_handler(CommandHandler("start", start))
@@ -568,6 +1248,7 @@ def main():
     application.add_handler(CommandHandler("logout", logout))
     application.add_handler(CommandHandler("resetall", resetall))
     application.add_handler(CommandHandler("broadcast", broadcast))
+    application.add_handler(CommandHandler("broadcaststatus", broadcast_status))
     application.add_handler(CommandHandler("cancel", cancel))
     application.add_handler(CommandHandler("verify", verify_user))
     application.add_handler(CommandHandler("addfchannel", add_fchannel))
@@ -576,6 +1257,14 @@ def main():
     application.add_handler(CommandHandler("removefgroup", remove_fgroup))
     application.add_handler(CommandHandler("setverifyinterval", set_verify_interval))
     application.add_handler(CommandHandler("setshortener", set_shortener))
+    application.add_handler(CommandHandler("cachestats", cache_stats))
+    application.add_handler(CommandHandler("queuestats", queue_stats))
+    application.add_handler(CommandHandler("apistats", api_stats))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("exportusers", export_users))
+    application.add_handler(CommandHandler("importusers", import_users))
+    application.add_handler(CommandHandler("jobstatus", job_status))
+    application.add_handler(CommandHandler("canceljob", cancel_job))
     
     # Media handler (photos, videos, documents)
     application.add_handler(MessageHandler(
@@ -586,22 +1275,56 @@ def main():
     # Button handler
     application.add_handler(CallbackQueryHandler(button_handler))
     
-    # Set bot commands
-    application.bot.set_my_commands(COMMANDS)
+    application.add_error_handler(error_handler)
+    
+    return application
+
+def make_ingest_queue(index: int = None):
+    if not INGEST_QUEUE_PATH:
+        return None
+    path = INGEST_QUEUE_PATH
+    if index is not None:
+        root, ext = os.path.splitext(path)
+        path = f"{root}-{index}{ext}"
+    return IngestQueue(path, max_inflight=INGEST_MAX_INFLIGHT, retention=INGEST_RETENTION)
+
+def run_worker(index: int, port: int):
+    """Entry point of a worker process, fed by the ingress over a local port"""
+    global WORKER_INDEX
+    WORKER_INDEX = index
+    application = build_application(os.environ.get("TELEGRAM_TOKEN"))
+    asyncio.run(server.run(
+        application, port, worker=True, startup=startup, ingest=make_ingest_queue(index),
+        drain_timeout=DRAIN_TIMEOUT
+    ))
+
+def main():
+    TOKEN = os.environ.get("TELEGRAM_TOKEN")
     
     # Start bot
     PORT = int(os.environ.get("PORT", 8443))
     WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
     
-    if WEBHOOK_URL:
-        application.run_webhook(
-            listen="0.0.0.0",
-            port=PORT,
-            webhook_url=WEBHOOK_URL,
-            url_path=TOKEN
-        )
-    else:
-        application.run_polling()
+    if WORKERS > 1 and WEBHOOK_URL:
+        if MONGO_URI and MONGO_URI.startswith(database.MEMORY_URI_PREFIX):
+            logger.warning("Workers do not share the in-memory database, use MongoDB with WORKERS > 1")
+        worker_ports = [WORKER_BASE_PORT + index for index in range(WORKERS)]
+        asyncio.run(cluster.run_ingress(
+            TOKEN, PORT, WEBHOOK_URL, TOKEN, run_worker, worker_ports,
+            max_pending=INGRESS_MAX_PENDING
+        ))
+        return
+    if WORKERS > 1:
+        logger.warning("WORKERS > 1 needs WEBHOOK_URL, running a single polling process")
+    
+    application = build_application(TOKEN)
+    
+    # One listener on PORT serves the webhook (if any), /metrics and the health check
+    ingest = make_ingest_queue() if WEBHOOK_URL else None
+    asyncio.run(server.run(
+        application, PORT, webhook_url=WEBHOOK_URL, url_path=TOKEN, startup=startup, ingest=ingest,
+        poll_timeout=POLL_TIMEOUT, poll_interval=POLL_INTERVAL, drain_timeout=DRAIN_TIMEOUT
+    ))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import time
+
+from telegram.error import Forbidden, RetryAfter
+
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_PREFIX = "📢 Broadcast from Save Restricted Content Bot:\n\n"
+
+# Users flagged as having blocked the bot are skipped
+ACTIVE_USERS = {"blocked": {"$ne": True}}
+
+SENT = "sent"
+FAILED = "failed"
+BLOCKED = "blocked"
+
+
+class Broadcaster:
+    """Runs broadcasts as background jobs, persisting a cursor after every batch.
+
+    A job interrupted by a restart resumes from its last completed batch, so
+    users in the batch that was in flight may receive the message twice.
+    """
+
+    MAX_RETRIES = 3
+
+    def __init__(self, db, rate: float = 25.0, concurrency: int = 10, batch_size: int = 500):
+        self.db = db
+        # Telegram allows ~30 messages/s overall, the bot's outbound limiter already paces each chat
+        self.global_bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self._task = None
+        self._job_id = None
+        self._run_started = None
+        self._run_base = 0
+        self._run_processed = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self, bot, text: str) -> dict:
+        if self.running:
+            raise RuntimeError("A broadcast is already running")
+        total = await self.db.users.count(ACTIVE_USERS)
+        job = await self.db.broadcasts.create(text, total)
+        self._task = asyncio.create_task(self._run_jobs(bot, [job]))
+        return job
+
+    async def resume(self, bot):
+        """Continue broadcasts that were still running when the process stopped"""
+        if self.running:
+            return
+        jobs = await self.db.broadcasts.running()
+        if jobs:
+            logger.info(f"Resuming {len(jobs)} interrupted broadcast(s)")
+            self._task = asyncio.create_task(self._run_jobs(bot, jobs))
+
+    async def stop(self):
+        # The job stays "running" in the database and is resumed on the next start
+        if self.running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run_jobs(self, bot, jobs: list):
+        for job in jobs:
+            await self._run(bot, job)
+        self._job_id = None
+
+    async def _run(self, bot, job: dict):
+        self._job_id = job["_id"]
+        self._run_started = time.monotonic()
+        self._run_base = job["sent"] + job["failed"] + job["blocked"]
+        self._run_processed = 0
+        logger.info(f"Broadcast {job['_id']} started from cursor {job['cursor']}")
+
+        try:
+            async for batch in self.db.users.id_batches(
+                self.batch_size, start_after=job["cursor"], filter=ACTIVE_USERS
+            ):
+                results = await self._send_batch(bot, job["text"], batch)
+                blocked = [user_id for user_id, result in zip(batch, results) if result == BLOCKED]
+                await self.db.users.mark_blocked(blocked)
+                await self.db.broadcasts.save_progress(
+                    job["_id"],
+                    batch[-1],
+                    sent=results.count(SENT),
+                    failed=results.count(FAILED),
+                    blocked=len(blocked)
+                )
+            await self.db.broadcasts.finish(job["_id"], "done")
+            logger.info(f"Broadcast {job['_id']} finished")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast {job['_id']} failed: {e}")
+            await self.db.broadcasts.finish(job["_id"], "failed")
+
+    async def _send_batch(self, bot, text: str, batch: list) -> list:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send(user_id):
+            async with semaphore:
+                result = await self._send(bot, text, user_id)
+                self._run_processed += 1
+                return result
+
+        return await asyncio.gather(*(send(user_id) for user_id in batch))
+
+    async def _send(self, bot, text: str, user_id: int) -> str:
+        for _ in range(self.MAX_RETRIES + 1):
+            await self.global_bucket.acquire()
+            try:
+                await bot.send_message(chat_id=user_id, text=BROADCAST_PREFIX + text)
+                return SENT
+            except RetryAfter as e:
+                # Flood control applies to the whole bot, so every sender backs off
+                logger.warning(f"Broadcast flood wait: {e.retry_after}s")
+                self.global_bucket.pause(e.retry_after)
+            except Forbidden:
+                return BLOCKED
+            except Exception as e:
+                logger.error(f"Broadcast error to {user_id}: {e}")
+                return FAILED
+        return FAILED
+
+    async def status(self):
+        """Latest job with live progress and, while running, an ETA in seconds"""
+        job = await self.db.broadcasts.latest()
+        if not job:
+            return None
+
+        done = job["sent"] + job["failed"] + job["blocked"]
+        status = dict(job, processed=done, eta=None)
+        if self.running and job["_id"] == self._job_id:
+            # Persisted counters lag by up to one batch, the in-memory counter does not
+            status["processed"] = max(done, self._run_base + self._run_processed)
+            elapsed = time.monotonic() - self._run_started
+            if self._run_processed and elapsed > 0:
+                rate = self._run_processed / elapsed
+                status["eta"] = max(job["total"] - status["processed"], 0) / rate
+        return status
@@ -0,0 +1,94 @@
+import time
+from collections import OrderedDict
+
+# Returned by TTLCache.get when a key is absent, so cached None values stay distinguishable
+MISSING = object()
+
+
+class TTLCache:
+    """Bounded LRU mapping whose entries expire after a time-to-live.
+
+    Expired entries are kept for another ``stale_ttl`` seconds, invisible to
+    ``get`` and ``peek`` but still returned by ``stale``, for callers that
+    prefer an old value to none while the source is unavailable.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300.0, clock=time.monotonic, stale_ttl: float = 0.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._clock = clock
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=MISSING):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        value, expires_at = entry
+        now = self._clock()
+        if expires_at <= now:
+            if expires_at + self.stale_ttl <= now:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key, default=MISSING):
+        """Like get() but without touching LRU order or the hit/miss counters"""
+        entry = self._data.get(key)
+        if entry is None or entry[1] <= self._clock():
+            return default
+        return entry[0]
+
+    def stale(self, key, default=MISSING):
+        """Like peek() but also returns entries expired less than ``stale_ttl`` seconds ago"""
+        entry = self._data.get(key)
+        if entry is None or entry[1] + self.stale_ttl <= self._clock():
+            return default
+        return entry[0]
+
+    def set(self, key, value, ttl: float = None):
+        self._data[key] = (value, self._clock() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def replace(self, key, value):
+        """Swap the value of a fresh or stale entry and keep its expiry, False if there is none"""
+        entry = self._data.get(key)
+        if entry is None or entry[1] + self.stale_ttl <= self._clock():
+            return False
+        self._data[key] = (value, entry[1])
+        return True
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def remove_if(self, predicate):
+        """Drop every entry whose key matches, O(n) so keep it off the hot path"""
+        for key in [key for key in self._data if predicate(key)]:
+            del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
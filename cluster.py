@@ -0,0 +1,317 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+
+import httpx
+import tornado.httpserver
+import tornado.web
+from telegram import Bot, Update
+
+import metrics
+from metrics import INGRESS_FORWARDED, INGRESS_QUEUE_DEPTH, INGRESS_REJECTED
+from server import HealthHandler, parse_updates, webhook_endpoint
+
+logger = logging.getLogger(__name__)
+
+
+def shard_key(data: dict) -> int:
+    """Id of the user an update belongs to, read from the raw payload without building an Update"""
+    for key, payload in data.items():
+        if key == "update_id" or not isinstance(payload, dict):
+            continue
+        user = payload.get("from") or payload.get("user")
+        if isinstance(user, dict) and "id" in user:
+            return user["id"]
+        # Channel posts and the like have no user, keep each chat on one worker instead
+        chat = payload.get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return data.get("update_id", 0)
+
+
+def shard_for(key: int, workers: int) -> int:
+    return int(key) % workers
+
+
+class WorkerLink:
+    """Ordered delivery of updates to one worker process.
+
+    A single sender drains the queue in order and posts it in batches, and a
+    failed post is retried before anything newer is sent, so every user's
+    updates reach their worker in the order Telegram delivered them.
+    """
+
+    def __init__(self, index: int, url: str, client: httpx.AsyncClient, max_pending: int = 1000,
+                 batch_size: int = 100, max_retry_delay: float = 10.0):
+        self.index = index
+        self.url = url
+        self.client = client
+        self.batch_size = batch_size
+        self.max_retry_delay = max_retry_delay
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self._sending = 0
+        self._task = None
+        self._forwarded = INGRESS_FORWARDED.labels(str(index))
+        self._rejected = INGRESS_REJECTED.labels(str(index))
+        INGRESS_QUEUE_DEPTH.labels(str(index)).set_function(lambda: self.pending)
+
+    @property
+    def pending(self) -> int:
+        return self.queue.qsize() + self._sending
+
+    def submit(self, data: dict) -> bool:
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            self._rejected.inc()
+            return False
+        return True
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            self._sending = len(batch)
+            await self._post(batch)
+            self._sending = 0
+            self._forwarded.inc(len(batch))
+
+    async def _post(self, batch: list):
+        delay = 0.5
+        while True:
+            try:
+                response = await self.client.post(f"{self.url}/shard", json=batch)
+            except httpx.TransportError as e:
+                response = None
+                error = repr(e)
+            else:
+                if response.status_code < 400:
+                    return
+                error = f"HTTP {response.status_code}"
+            if response is not None and response.status_code < 500:
+                # Rejected, not unavailable: retrying would block the shard forever
+                if len(batch) > 1:
+                    # Resend one by one so only the offending update is lost
+                    for data in batch:
+                        await self._post([data])
+                else:
+                    logger.error(f"Worker {self.index} rejected update {batch[0].get('update_id')} ({error}), dropped")
+                return
+            # Workers restart in a few seconds, hold the batch (and everything behind it) until then
+            logger.warning(f"Worker {self.index} unavailable ({error}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+
+    async def stop(self, timeout: float = 10.0):
+        """Give queued updates a chance to reach the worker, then stop sending"""
+        if self._task is None:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.pending and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        if self.pending:
+            logger.warning(f"Dropping {self.pending} updates queued for worker {self.index}")
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+
+class Ingress:
+    """Accepts webhook updates and shards them over the worker processes by user id"""
+
+    def __init__(self, worker_urls: list, max_pending: int = 1000, batch_size: int = 100):
+        self.client = httpx.AsyncClient(timeout=10)
+        self.links = [
+            WorkerLink(index, url, self.client, max_pending=max_pending, batch_size=batch_size)
+            for index, url in enumerate(worker_urls)
+        ]
+
+    def submit(self, data: dict) -> bool:
+        return self.links[shard_for(shard_key(data), len(self.links))].submit(data)
+
+    def start(self):
+        for link in self.links:
+            link.start()
+
+    async def readiness(self) -> list:
+        """Whether each worker reports ready on its /readyz"""
+        async def check(link):
+            try:
+                response = await self.client.get(f"{link.url}/readyz", timeout=2)
+                return response.status_code == 200
+            except httpx.HTTPError:
+                return False
+        return await asyncio.gather(*(check(link) for link in self.links))
+
+    async def scrape(self) -> list:
+        """Each worker's /metrics text, None for workers that did not answer"""
+        async def fetch(link):
+            try:
+                response = await self.client.get(f"{link.url}/metrics", timeout=2)
+                response.raise_for_status()
+                return response.text
+            except httpx.HTTPError:
+                return None
+        return await asyncio.gather(*(fetch(link) for link in self.links))
+
+    async def stop(self, timeout: float = 10.0):
+        await asyncio.gather(*(link.stop(timeout) for link in self.links))
+        await self.client.aclose()
+
+
+class IngressHandler(tornado.web.RequestHandler):
+    def initialize(self, ingress):
+        self.ingress = ingress
+
+    def post(self):
+        try:
+            data, = parse_updates(self.request.body)
+        except Exception as e:
+            logger.error(f"Invalid webhook payload: {e}")
+            raise tornado.web.HTTPError(400)
+
+        if not self.ingress.submit(data):
+            # Telegram redelivers updates that were not acknowledged
+            raise tornado.web.HTTPError(503)
+
+
+class IngressReadyHandler(tornado.web.RequestHandler):
+    """Ready once every worker is"""
+
+    def initialize(self, ingress):
+        self.ingress = ingress
+
+    async def get(self):
+        workers = await self.ingress.readiness()
+        if not all(workers):
+            self.set_status(503)
+        self.write({"ready": all(workers), "workers": workers})
+
+
+class IngressMetricsHandler(tornado.web.RequestHandler):
+    """The ingress's metrics and every worker's, labelled with the process they come from"""
+
+    def initialize(self, ingress):
+        self.ingress = ingress
+
+    async def get(self):
+        body, _ = metrics.render()
+        expositions = {"ingress": body.decode()}
+        for link, text in zip(self.ingress.links, await self.ingress.scrape()):
+            if text is None:
+                logger.warning(f"Worker {link.index} did not answer the metrics scrape")
+                continue
+            expositions[f"worker-{link.index}"] = text
+        body, content_type = metrics.render_merged(expositions)
+        self.set_header("Content-Type", content_type)
+        self.write(body)
+
+
+class WorkerPool:
+    """One process per shard, restarted if it dies"""
+
+    def __init__(self, target, ports: list, check_interval: float = 5.0):
+        self.target = target
+        self.ports = ports
+        self.check_interval = check_interval
+        # Spawn rather than fork: the parent already holds a MongoClient and an event loop
+        self._context = multiprocessing.get_context("spawn")
+        self.processes = [None] * len(ports)
+        self._task = None
+
+    def _spawn(self, index: int):
+        process = self._context.Process(
+            target=self.target,
+            args=(index, self.ports[index]),
+            name=f"bot-worker-{index}"
+        )
+        process.start()
+        self.processes[index] = process
+        logger.info(f"Started worker {index} (pid {process.pid}) on port {self.ports[index]}")
+
+    def start(self):
+        for index in range(len(self.ports)):
+            self._spawn(index)
+        self._task = asyncio.create_task(self._supervise())
+
+    async def _supervise(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.error(f"Worker {index} exited with code {process.exitcode}, restarting")
+                    self._spawn(index)
+
+    async def stop(self, timeout: float = 30.0):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        # SIGTERM lets each worker finish running updates and shut down cleanly
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for index, process in enumerate(self.processes):
+            await asyncio.to_thread(process.join, timeout)
+            if process.is_alive():
+                logger.warning(f"Worker {index} did not stop in time, killing it")
+                process.kill()
+
+
+def make_app(ingress: Ingress, url_path: str) -> tornado.web.Application:
+    return tornado.web.Application([
+        (r"/", HealthHandler),
+        (r"/readyz", IngressReadyHandler, {"ingress": ingress}),
+        (r"/metrics", IngressMetricsHandler, {"ingress": ingress}),
+        (rf"/{url_path}/?", IngressHandler, {"ingress": ingress}),
+    ])
+
+
+async def run_ingress(token: str, port: int, webhook_url: str, url_path: str, target, worker_ports: list,
+                      max_pending: int = 1000):
+    """Run the webhook ingress on ``port`` and one bot worker per entry of ``worker_ports``.
+
+    ``target(index, port)`` runs a worker, it is called in a fresh process and
+    must be importable. Updates of one user always go to the same worker, so
+    per-user ordering, caches and batch sessions stay local to one process.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    pool = WorkerPool(target, worker_ports)
+    pool.start()
+    ingress = Ingress([f"http://127.0.0.1:{worker_port}" for worker_port in worker_ports],
+                      max_pending=max_pending)
+    ingress.start()
+
+    http_server = tornado.httpserver.HTTPServer(make_app(ingress, url_path))
+    http_server.listen(port, address="0.0.0.0")
+    logger.info(f"Ingress listening on port {port}, {len(worker_ports)} workers")
+
+    async with Bot(token) as bot:
+        await bot.set_webhook(url=webhook_endpoint(webhook_url, url_path), allowed_updates=Update.ALL_TYPES)
+
+    try:
+        await stop.wait()
+    finally:
+        logger.info("Shutting down")
+        http_server.stop()
+        # Deliver what was already acknowledged to Telegram before the workers go away
+        await ingress.stop()
+        await pool.stop()
@@ -0,0 +1,947 @@
+import asyncio
+import contextlib
+import contextvars
+import copy
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+
+from pymongo import DeleteMany, DeleteOne, InsertOne, MongoClient, UpdateMany, UpdateOne
+from pymongo.errors import ConnectionFailure, DuplicateKeyError, ExecutionTimeout, WTimeoutError
+
+from cache import MISSING, TTLCache
+from metrics import DEPENDENCY_FALLBACKS, MONGO_ERRORS, MONGO_LATENCY
+from resilience import DependencyUnavailable
+
+logger = logging.getLogger(__name__)
+
+MEMORY_URI_PREFIX = "memory://"
+
+# Bumped whenever Database.migrate() learns a new step
+SCHEMA_VERSION = 1
+
+
+# Collection backends
+#
+# Both backends expose the same small async API so the repositories below
+# never care whether they talk to a real MongoDB or to the in-memory store.
+#
+# bulk_write takes operations in the shell's bulkWrite form, e.g.
+# {"update_one": {"filter": {...}, "update": {...}, "upsert": True}}, and
+# returns a summary dict of inserted/matched/upserted/deleted counts.
+
+def _bulk_request(operation: dict):
+    (kind, spec), = operation.items()
+    if kind == "insert_one":
+        return InsertOne(spec["document"])
+    if kind == "update_one":
+        return UpdateOne(spec["filter"], spec["update"], upsert=spec.get("upsert", False))
+    if kind == "update_many":
+        return UpdateMany(spec["filter"], spec["update"], upsert=spec.get("upsert", False))
+    if kind == "delete_one":
+        return DeleteOne(spec["filter"])
+    if kind == "delete_many":
+        return DeleteMany(spec["filter"])
+    raise ValueError(f"Unsupported bulk operation: {kind}")
+
+
+class MongoCollection:
+    """Runs blocking pymongo calls on a bounded thread pool"""
+
+    def __init__(self, collection, executor: ThreadPoolExecutor):
+        self._col = collection
+        self._executor = executor
+
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(fn, *args, **kwargs))
+
+    async def find_one(self, filter: dict, projection=None):
+        return await self._run(self._col.find_one, filter, projection)
+
+    async def find(self, filter: dict = None, projection=None, sort=None, limit: int = 0) -> list:
+        def fetch():
+            return list(self._col.find(filter or {}, projection, sort=sort, limit=limit))
+        return await self._run(fetch)
+
+    async def insert_one(self, document: dict):
+        result = await self._run(self._col.insert_one, document)
+        return result.inserted_id
+
+    async def update_one(self, filter: dict, update: dict, upsert: bool = False) -> int:
+        result = await self._run(self._col.update_one, filter, update, upsert=upsert)
+        return result.matched_count
+
+    async def update_many(self, filter: dict, update: dict) -> int:
+        result = await self._run(self._col.update_many, filter, update)
+        return result.matched_count
+
+    async def delete_one(self, filter: dict) -> int:
+        result = await self._run(self._col.delete_one, filter)
+        return result.deleted_count
+
+    async def delete_many(self, filter: dict) -> int:
+        result = await self._run(self._col.delete_many, filter)
+        return result.deleted_count
+
+    async def count_documents(self, filter: dict) -> int:
+        return await self._run(self._col.count_documents, filter)
+
+    async def bulk_write(self, operations: list) -> dict:
+        if not operations:
+            return {"inserted": 0, "matched": 0, "upserted": 0, "deleted": 0}
+        requests = [_bulk_request(operation) for operation in operations]
+        result = await self._run(self._col.bulk_write, requests, ordered=False)
+        return {
+            "inserted": result.inserted_count,
+            "matched": result.matched_count,
+            "upserted": result.upserted_count,
+            "deleted": result.deleted_count
+        }
+
+    async def create_index(self, keys: list, unique: bool = False, expire_after_seconds: int = None):
+        options = {"unique": unique}
+        if expire_after_seconds is not None:
+            options["expireAfterSeconds"] = expire_after_seconds
+        return await self._run(self._col.create_index, keys, **options)
+
+
+def _get_path(doc: dict, path: str):
+    for part in path.split("."):
+        if not isinstance(doc, dict) or part not in doc:
+            return None, False
+        doc = doc[part]
+    return doc, True
+
+
+def _set_path(doc: dict, path: str, value):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _unset_path(doc: dict, path: str):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+def _match_value(value, exists: bool, condition) -> bool:
+    if not isinstance(condition, dict) or not any(k.startswith("$") for k in condition):
+        return exists and value == condition
+
+    for op, operand in condition.items():
+        if op == "$exists":
+            if exists != bool(operand):
+                return False
+        elif op == "$ne":
+            if exists and value == operand:
+                return False
+        elif op == "$in":
+            if not exists or value not in operand:
+                return False
+        elif op == "$nin":
+            if exists and value in operand:
+                return False
+        elif op in ("$gt", "$gte", "$lt", "$lte"):
+            if not exists or value is None:
+                return False
+            try:
+                if op == "$gt" and not value > operand:
+                    return False
+                if op == "$gte" and not value >= operand:
+                    return False
+                if op == "$lt" and not value < operand:
+                    return False
+                if op == "$lte" and not value <= operand:
+                    return False
+            except TypeError:
+                return False
+        else:
+            raise ValueError(f"Unsupported query operator: {op}")
+    return True
+
+
+def _matches(doc: dict, filter: dict) -> bool:
+    for key, condition in filter.items():
+        if key == "$or":
+            if not any(_matches(doc, sub) for sub in condition):
+                return False
+            continue
+        value, exists = _get_path(doc, key)
+        if not _match_value(value, exists, condition):
+            return False
+    return True
+
+
+def _project(doc: dict, projection):
+    if doc is None:
+        return None
+    doc = copy.deepcopy(doc)
+    if not projection:
+        return doc
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    include = {k for k, v in projection.items() if v and k != "_id"}
+    if include:
+        projected = {}
+        for path in include:
+            value, exists = _get_path(doc, path)
+            if exists:
+                _set_path(projected, path, value)
+        if projection.get("_id", 1):
+            projected["_id"] = doc["_id"]
+        return projected
+    for path, flag in projection.items():
+        if not flag:
+            _unset_path(doc, path)
+    return doc
+
+
+def _apply_update(doc: dict, update: dict, inserting: bool):
+    for op, fields in update.items():
+        if op == "$set":
+            for path, value in fields.items():
+                _set_path(doc, path, copy.deepcopy(value))
+        elif op == "$setOnInsert":
+            if inserting:
+                for path, value in fields.items():
+                    _set_path(doc, path, copy.deepcopy(value))
+        elif op == "$unset":
+            for path in fields:
+                _unset_path(doc, path)
+        elif op == "$inc":
+            for path, amount in fields.items():
+                current, _ = _get_path(doc, path)
+                _set_path(doc, path, (current or 0) + amount)
+        elif op == "$addToSet":
+            for path, value in fields.items():
+                current, exists = _get_path(doc, path)
+                current = list(current) if exists and current is not None else []
+                if value not in current:
+                    current.append(copy.deepcopy(value))
+                _set_path(doc, path, current)
+        elif op == "$pull":
+            for path, value in fields.items():
+                current, exists = _get_path(doc, path)
+                if exists and isinstance(current, list):
+                    _set_path(doc, path, [item for item in current if item != value])
+        elif op == "$max":
+            for path, value in fields.items():
+                current, exists = _get_path(doc, path)
+                if not exists or current is None or value > current:
+                    _set_path(doc, path, value)
+        else:
+            raise ValueError(f"Unsupported update operator: {op}")
+
+
+class MemoryCollection:
+    """In-process stand-in for a MongoDB collection, used for local runs and load tests"""
+
+    def __init__(self):
+        self._docs = {}
+        self._next_id = 1
+        self._unique_fields = []
+        self._ttl_fields = {}
+
+    def _expire(self):
+        # MongoDB removes expired documents in the background, here it happens on access
+        now = datetime.utcnow()
+        for field, seconds in self._ttl_fields.items():
+            cutoff = now - timedelta(seconds=seconds)
+            expired = [
+                doc_id for doc_id, doc in self._docs.items()
+                if isinstance(doc.get(field), datetime) and doc[field] <= cutoff
+            ]
+            for doc_id in expired:
+                del self._docs[doc_id]
+
+    def _candidates(self, filter: dict):
+        if self._ttl_fields:
+            self._expire()
+        # Fast path for the "_id" equality lookups that make up most traffic
+        doc_id = filter.get("_id")
+        if doc_id is not None and not isinstance(doc_id, dict):
+            doc = self._docs.get(doc_id)
+            return [doc] if doc is not None and _matches(doc, filter) else []
+        return [doc for doc in self._docs.values() if _matches(doc, filter)]
+
+    async def find_one(self, filter: dict, projection=None):
+        matches = self._candidates(filter or {})
+        return _project(matches[0], projection) if matches else None
+
+    async def find(self, filter: dict = None, projection=None, sort=None, limit: int = 0) -> list:
+        matches = self._candidates(filter or {})
+        for key, direction in reversed(sort or []):
+            matches.sort(
+                key=lambda d: (_get_path(d, key)[0] is not None, _get_path(d, key)[0]),
+                reverse=direction < 0
+            )
+        if limit:
+            matches = matches[:limit]
+        return [_project(doc, projection) for doc in matches]
+
+    async def insert_one(self, document: dict):
+        document = copy.deepcopy(document)
+        if "_id" not in document:
+            document["_id"] = self._next_id
+            self._next_id += 1
+        if document["_id"] in self._docs:
+            raise DuplicateKeyError(f"Duplicate _id: {document['_id']}")
+        for field in self._unique_fields:
+            value, exists = _get_path(document, field)
+            if exists and any(_get_path(doc, field) == (value, True) for doc in self._docs.values()):
+                raise DuplicateKeyError(f"Duplicate {field}: {value}")
+        self._docs[document["_id"]] = document
+        return document["_id"]
+
+    async def update_one(self, filter: dict, update: dict, upsert: bool = False) -> int:
+        matches = self._candidates(filter)
+        if matches:
+            _apply_update(matches[0], update, inserting=False)
+            return 1
+        if upsert:
+            document = {
+                key: value for key, value in filter.items()
+                if not key.startswith("$") and not isinstance(value, dict)
+            }
+            _apply_update(document, update, inserting=True)
+            await self.insert_one(document)
+        return 0
+
+    async def update_many(self, filter: dict, update: dict) -> int:
+        matches = self._candidates(filter)
+        for doc in matches:
+            _apply_update(doc, update, inserting=False)
+        return len(matches)
+
+    async def delete_one(self, filter: dict) -> int:
+        matches = self._candidates(filter)
+        if not matches:
+            return 0
+        del self._docs[matches[0]["_id"]]
+        return 1
+
+    async def delete_many(self, filter: dict) -> int:
+        matches = self._candidates(filter)
+        for doc in matches:
+            del self._docs[doc["_id"]]
+        return len(matches)
+
+    async def count_documents(self, filter: dict) -> int:
+        return len(self._candidates(filter))
+
+    async def bulk_write(self, operations: list) -> dict:
+        summary = {"inserted": 0, "matched": 0, "upserted": 0, "deleted": 0}
+        for operation in operations:
+            (kind, spec), = operation.items()
+            if kind == "insert_one":
+                await self.insert_one(spec["document"])
+                summary["inserted"] += 1
+            elif kind in ("update_one", "update_many"):
+                if kind == "update_one":
+                    matched = await self.update_one(spec["filter"], spec["update"], upsert=spec.get("upsert", False))
+                else:
+                    matched = await self.update_many(spec["filter"], spec["update"])
+                summary["matched"] += matched
+                if not matched and spec.get("upsert"):
+                    summary["upserted"] += 1
+            elif kind == "delete_one":
+                summary["deleted"] += await self.delete_one(spec["filter"])
+            elif kind == "delete_many":
+                summary["deleted"] += await self.delete_many(spec["filter"])
+            else:
+                raise ValueError(f"Unsupported bulk operation: {kind}")
+        return summary
+
+    async def create_index(self, keys: list, unique: bool = False, expire_after_seconds: int = None):
+        fields = [key for key, _ in keys]
+        if unique and len(fields) == 1 and fields[0] not in self._unique_fields:
+            self._unique_fields.append(fields[0])
+        if expire_after_seconds is not None:
+            self._ttl_fields[fields[0]] = expire_after_seconds
+        return "_".join(f"{key}_{direction}" for key, direction in keys)
+
+
+def is_outage(error: Exception) -> bool:
+    """Errors that mean the database is unreachable or overloaded, not that the operation was refused"""
+    return isinstance(error, (ConnectionFailure, ExecutionTimeout, WTimeoutError))
+
+
+# Set for the tasks doing background or owner maintenance work, see maintenance()
+_maintenance = contextvars.ContextVar("maintenance", default=False)
+
+
+@contextlib.contextmanager
+def maintenance():
+    """Run the enclosed database operations, and those of tasks created meanwhile, as maintenance.
+
+    Maintenance work (migrations, admin jobs, broadcasts, housekeeping) scans
+    and writes whole collections, so it goes through the maintenance
+    dependency and its longer timeout instead of the one guarding updates;
+    a slow scan neither fails nor opens the circuit users depend on.
+    """
+    token = _maintenance.set(True)
+    try:
+        yield
+    finally:
+        _maintenance.reset(token)
+
+
+class InstrumentedCollection:
+    """Wraps a backend collection and records per-operation latency and errors.
+
+    With a ``dependency`` every operation goes through its timeout and
+    circuit breaker, so an unavailable database raises DependencyUnavailable.
+    Inside maintenance() ``maintenance_dependency`` is used instead, and
+    without one those operations are not guarded.
+    """
+
+    # Index builds run once at startup and may legitimately take long on a big collection
+    UNGUARDED = ("create_index",)
+
+    def __init__(self, name: str, collection, dependency=None, maintenance_dependency=None):
+        self.name = name
+        self._col = collection
+        self._dependency = dependency
+        self._maintenance_dependency = maintenance_dependency
+
+    def __getattr__(self, operation: str):
+        method = getattr(self._col, operation)
+        latency = MONGO_LATENCY.labels(self.name, operation)
+        dependency = self._maintenance_dependency if _maintenance.get() else self._dependency
+        if dependency is not None and operation not in self.UNGUARDED:
+            method = partial(dependency.call, method)
+
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            except Exception:
+                MONGO_ERRORS.labels(self.name, operation).inc()
+                raise
+            finally:
+                latency.observe(time.perf_counter() - started)
+
+        return timed
+
+
+async def delete_in_batches(collection, batch_size: int = 1000):
+    """Empty a collection in bounded deletes by _id, yielding the number removed by each"""
+    while True:
+        batch = await collection.find({}, {"_id": 1}, limit=batch_size)
+        if not batch:
+            return
+        yield await collection.delete_many({"_id": {"$in": [doc["_id"] for doc in batch]}})
+
+
+# Repositories
+
+# Fields a user document starts with
+USER_DEFAULTS = {
+    "username": None,
+    "channel": None,
+    "premium": False,
+    "last_verified": None,
+    "verified_until": None
+}
+
+def profile_verified(user_data) -> bool:
+    """Premium, or verified until a time still in the future"""
+    if not user_data:
+        return False
+    if user_data.get("premium", False):
+        return True
+    verified_until = user_data.get("verified_until")
+    return verified_until is not None and datetime.utcnow() < verified_until
+
+class UserRepository:
+    def __init__(self, collection, cache: TTLCache = None):
+        self.col = collection
+        # Profiles handed out from the cache are shared, callers must treat them as read-only
+        self.cache = cache
+        self._delete_listeners = []
+
+    def on_delete(self, listener):
+        """Call ``listener(user_ids)`` after users are deleted, with None once all of them are"""
+        self._delete_listeners.append(listener)
+
+    def _deleted(self, user_ids):
+        for listener in self._delete_listeners:
+            listener(user_ids)
+
+    async def get(self, user_id: int):
+        if self.cache is not None:
+            user_data = self.cache.get(user_id)
+            if user_data is not MISSING:
+                return user_data
+
+        try:
+            user_data = await self.col.find_one({"_id": user_id})
+        except DependencyUnavailable as e:
+            # An expired profile beats no answer while the database is out
+            user_data = self.cache.stale(user_id) if self.cache is not None else MISSING
+            if user_data is MISSING:
+                raise
+            DEPENDENCY_FALLBACKS.labels(e.dependency, "stale_profile").inc()
+            return user_data
+        if user_data is not None and self.cache is not None:
+            self.cache.set(user_id, user_data)
+        return user_data
+
+    def _write_through(self, user_id: int, set_fields: dict = None, unset_fields=()):
+        if self.cache is None:
+            return
+        fresh = self.cache.peek(user_id) is not MISSING
+        user_data = self.cache.stale(user_id)
+        if user_data is MISSING:
+            return
+        user_data = dict(user_data, **(set_fields or {}))
+        for field in unset_fields:
+            user_data.pop(field, None)
+        if fresh:
+            self.cache.set(user_id, user_data)
+        else:
+            # A copy kept for outages stays stale, but must not contradict this write
+            self.cache.replace(user_id, user_data)
+
+    async def touch_many(self, activity: dict) -> dict:
+        """Upsert ``{user_id: fields}`` in one bulk write, creating missing users with the defaults"""
+        operations = [
+            {"update_one": {
+                "filter": {"_id": user_id},
+                "update": {
+                    "$set": fields,
+                    "$setOnInsert": {key: value for key, value in USER_DEFAULTS.items() if key not in fields},
+                    # Any update from a user means they unblocked the bot
+                    "$unset": {"blocked": "", "blocked_at": ""}
+                },
+                "upsert": True
+            }}
+            for user_id, fields in activity.items()
+        ]
+        summary = await self.col.bulk_write(operations)
+        for user_id, fields in activity.items():
+            self._write_through(user_id, fields, unset_fields=("blocked", "blocked_at"))
+        return summary
+
+    async def mark_active(self, user_ids: list, day: str) -> int:
+        """Record ``day`` as the users' last active day, returns how many were not active on it yet"""
+        return await self.col.update_many(
+            {"_id": {"$in": user_ids}, "last_active_day": {"$ne": day}},
+            {"$set": {"last_active_day": day}}
+        )
+
+    async def set_channel(self, user_id: int, channel: str):
+        # Upsert: the user's first activity may still be waiting in the write-behind buffer
+        await self.col.update_one({"_id": user_id}, {"$set": {"channel": channel}}, upsert=True)
+        self._write_through(user_id, {"channel": channel})
+
+    async def ensure_indexes(self):
+        # Range scans for expiring verifications; the per-user check is an _id lookup
+        await self.col.create_index([("verified_until", 1)])
+
+    async def mark_verified(self, user_id: int, interval: timedelta):
+        now = datetime.utcnow()
+        fields = {"last_verified": now, "verified_until": now + interval}
+        await self.col.update_one({"_id": user_id}, {"$set": fields, "$unset": {"renewal_link": ""}}, upsert=True)
+        self._write_through(user_id, fields, unset_fields=("renewal_link",))
+
+    async def expiring(self, before: datetime, batch_size: int = 500) -> list:
+        """Users whose verification lapses before ``before`` and have no renewal link yet, soonest first"""
+        return await self.col.find(
+            {
+                "verified_until": {"$gt": datetime.utcnow(), "$lte": before},
+                "renewal_link": {"$exists": False},
+                "premium": {"$ne": True},
+                "blocked": {"$ne": True}
+            },
+            {"verified_until": 1},
+            sort=[("verified_until", 1)],
+            limit=batch_size
+        )
+
+    async def set_renewal_link(self, user_id: int, url: str, expires_at: datetime):
+        link = {"url": url, "expires_at": expires_at}
+        await self.col.update_one({"_id": user_id}, {"$set": {"renewal_link": link}})
+        self._write_through(user_id, {"renewal_link": link})
+
+    async def migrate_verification(self, interval: timedelta, batch_size: int = 500) -> int:
+        """Derive verified_until from last_verified and drop tokens stored on user documents"""
+        migrated = 0
+        while True:
+            # Every update takes the document out of the filter, so no paging is needed
+            batch = await self.col.find(
+                {"verified_until": {"$exists": False}}, {"last_verified": 1}, limit=batch_size
+            )
+            if not batch:
+                break
+            operations = []
+            for doc in batch:
+                last_verified = doc.get("last_verified")
+                verified_until = last_verified + interval if last_verified else None
+                operations.append({"update_one": {
+                    "filter": {"_id": doc["_id"]},
+                    "update": {"$set": {"verified_until": verified_until}}
+                }})
+            await self.col.bulk_write(operations)
+            migrated += len(batch)
+        await self.col.update_many({"verify_token": {"$exists": True}}, {"$unset": {"verify_token": ""}})
+        if self.cache is not None:
+            self.cache.clear()
+        return migrated
+
+    async def delete(self, user_id: int):
+        await self.col.delete_one({"_id": user_id})
+        if self.cache is not None:
+            self.cache.pop(user_id)
+        self._deleted([user_id])
+
+    def forget_all(self):
+        """Drop cached and pending state after the collection was emptied"""
+        if self.cache is not None:
+            self.cache.clear()
+        self._deleted(None)
+
+    async def count(self, filter: dict = None) -> int:
+        return await self.col.count_documents(filter or {})
+
+    async def mark_blocked(self, user_ids: list):
+        """Flag users that blocked the bot so broadcasts skip them"""
+        if not user_ids:
+            return
+        fields = {"blocked": True, "blocked_at": datetime.utcnow()}
+        await self.col.update_many({"_id": {"$in": user_ids}}, {"$set": fields})
+        for user_id in user_ids:
+            self._write_through(user_id, fields)
+
+    async def batches(self, batch_size: int = 500, start_after=None, filter: dict = None, projection=None):
+        """Yield lists of user documents in _id order, paging on _id so no cursor is held open"""
+        last_id = start_after
+        while True:
+            query = dict(filter or {})
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            batch = await self.col.find(query, projection, sort=[("_id", 1)], limit=batch_size)
+            if not batch:
+                return
+            yield batch
+            last_id = batch[-1]["_id"]
+
+    async def id_batches(self, batch_size: int = 500, start_after=None, filter: dict = None):
+        async for batch in self.batches(batch_size, start_after, filter, projection={"_id": 1}):
+            yield [doc["_id"] for doc in batch]
+
+    async def delete_batch(self, user_ids: list) -> int:
+        deleted = await self.col.delete_many({"_id": {"$in": user_ids}})
+        if self.cache is not None:
+            for user_id in user_ids:
+                self.cache.pop(user_id)
+        self._deleted(user_ids)
+        return deleted
+
+    async def bulk_upsert(self, documents: list) -> dict:
+        """Insert or overwrite the fields of whole user documents in one round-trip"""
+        operations = [
+            {"update_one": {
+                "filter": {"_id": doc["_id"]},
+                "update": {"$set": {key: value for key, value in doc.items() if key != "_id"}},
+                "upsert": True
+            }}
+            for doc in documents
+        ]
+        summary = await self.col.bulk_write(operations)
+        if self.cache is not None:
+            for doc in documents:
+                self.cache.pop(doc["_id"])
+        return summary
+
+    async def warm(self, limit: int = 1000) -> int:
+        """Preload the most recently verified users into the cache, returns how many were loaded"""
+        if self.cache is None or not limit:
+            return 0
+        users = await self.col.find(
+            {"verified_until": {"$gt": datetime.utcnow()}},
+            sort=[("verified_until", -1)],
+            limit=limit
+        )
+        for user_data in users:
+            self.cache.set(user_data["_id"], user_data)
+        return len(users)
+
+
+class VerifyTokenRepository:
+    """Outstanding verification tokens, removed by MongoDB once they expire.
+
+    The token is the document _id, so redeeming one is a unique index lookup.
+    """
+
+    def __init__(self, collection):
+        self.col = collection
+
+    async def ensure_indexes(self):
+        await self.col.create_index([("expires_at", 1)], expire_after_seconds=0)
+
+    async def issue(self, token: str, user_id: int, ttl: timedelta):
+        now = datetime.utcnow()
+        await self.col.insert_one({
+            "_id": token,
+            "user_id": user_id,
+            "created_at": now,
+            "expires_at": now + ttl
+        })
+
+    async def redeem(self, token: str, user_id: int) -> bool:
+        """Consume the token if it belongs to the user and has not expired"""
+        # The TTL monitor only runs about once a minute, so check expiry here as well
+        deleted = await self.col.delete_one({
+            "_id": token,
+            "user_id": user_id,
+            "expires_at": {"$gt": datetime.utcnow()}
+        })
+        return deleted == 1
+
+
+class DeliveryRepository:
+    """Which file went to which chat recently, entries expire through a TTL index"""
+
+    def __init__(self, collection):
+        self.col = collection
+
+    async def ensure_indexes(self):
+        await self.col.create_index([("expires_at", 1)], expire_after_seconds=0)
+
+    async def claim(self, key: str, fields: dict, ttl: timedelta) -> bool:
+        """Record a delivery unless one is already recorded for ``key``, atomically across workers"""
+        now = datetime.utcnow()
+        document = dict(fields, created_at=now, expires_at=now + ttl)
+        try:
+            await self.col.insert_one(dict(document, _id=key))
+            return True
+        except DuplicateKeyError:
+            pass
+        # An expired entry the TTL monitor has not removed yet does not count: take
+        # it over, or insert again if it disappeared meanwhile. A live entry makes
+        # the upsert collide on _id.
+        try:
+            await self.col.update_one(
+                {"_id": key, "expires_at": {"$lte": now}},
+                {"$set": document},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def release(self, key: str):
+        await self.col.delete_one({"_id": key})
+
+
+class AnalyticsRepository:
+    """One pre-aggregated document of counters per UTC day, _id is the date"""
+
+    def __init__(self, collection):
+        self.col = collection
+
+    async def increment(self, buckets: dict):
+        """Apply ``{bucket: {counter: amount}}`` as one $inc per bucket in a single round-trip"""
+        await self.col.bulk_write([
+            {"update_one": {"filter": {"_id": bucket}, "update": {"$inc": counters}, "upsert": True}}
+            for bucket, counters in buckets.items()
+        ])
+
+    async def days(self, buckets: list) -> dict:
+        documents = await self.col.find({"_id": {"$in": buckets}})
+        return {doc.pop("_id"): doc for doc in documents}
+
+
+class BroadcastRepository:
+    def __init__(self, collection):
+        self.col = collection
+
+    async def create(self, text: str, total: int) -> dict:
+        now = datetime.utcnow()
+        job = {
+            "_id": f"bc-{now.strftime('%Y%m%d%H%M%S%f')}",
+            "text": text,
+            "status": "running",
+            "cursor": None,
+            "total": total,
+            "sent": 0,
+            "failed": 0,
+            "blocked": 0,
+            "started_at": now,
+            "updated_at": now,
+            "finished_at": None
+        }
+        await self.col.insert_one(job)
+        return job
+
+    async def latest(self):
+        jobs = await self.col.find({}, sort=[("started_at", -1)], limit=1)
+        return jobs[0] if jobs else None
+
+    async def running(self) -> list:
+        return await self.col.find({"status": "running"}, sort=[("started_at", 1)])
+
+    async def save_progress(self, job_id: str, cursor, sent: int, failed: int, blocked: int):
+        await self.col.update_one(
+            {"_id": job_id},
+            {
+                "$set": {"cursor": cursor, "updated_at": datetime.utcnow()},
+                "$inc": {"sent": sent, "failed": failed, "blocked": blocked}
+            }
+        )
+
+    async def finish(self, job_id: str, status: str = "done"):
+        now = datetime.utcnow()
+        await self.col.update_one(
+            {"_id": job_id},
+            {"$set": {"status": status, "updated_at": now, "finished_at": now}}
+        )
+
+
+class SettingsRepository:
+    """Bot-wide settings in one versioned document.
+
+    Every write increments ``version`` in the same atomic update, so readers
+    can tell whether anything changed by fetching that single field.
+    """
+
+    CONFIG_ID = "config"
+    # Pre-config layout, migrated into the config document on first load
+    LEGACY_FORCE_SUB_ID = "force_sub_data"
+    SCHEMA_ID = "schema"
+
+    def __init__(self, collection):
+        self.col = collection
+
+    async def get_config(self) -> dict:
+        data = await self.col.find_one({"_id": self.CONFIG_ID})
+        if data is None:
+            data = await self._migrate_legacy()
+        return data
+
+    async def config_version(self) -> int:
+        data = await self.col.find_one({"_id": self.CONFIG_ID}, {"version": 1})
+        return data.get("version", 0) if data else 0
+
+    async def update_config(self, update: dict):
+        """Apply update operators to the config document and bump its version"""
+        update = dict(update)
+        update["$inc"] = dict(update.get("$inc", {}), version=1)
+        await self.col.update_one({"_id": self.CONFIG_ID}, update, upsert=True)
+
+    async def schema_version(self) -> int:
+        data = await self.col.find_one({"_id": self.SCHEMA_ID})
+        return data.get("version", 0) if data else 0
+
+    async def set_schema_version(self, version: int):
+        await self.col.update_one({"_id": self.SCHEMA_ID}, {"$max": {"version": version}}, upsert=True)
+
+    async def _migrate_legacy(self) -> dict:
+        force_sub = await self.col.find_one({"_id": self.LEGACY_FORCE_SUB_ID}) or {}
+        fields = {
+            "force_sub_channels": force_sub.get("channels", []),
+            "force_sub_groups": force_sub.get("groups", []),
+            "version": 1
+        }
+        # $setOnInsert keeps this safe when several workers start at once
+        await self.col.update_one({"_id": self.CONFIG_ID}, {"$setOnInsert": fields}, upsert=True)
+        return await self.col.find_one({"_id": self.CONFIG_ID})
+
+
+class Database:
+    def __init__(self, get_backend, client=None, executor=None, user_cache: TTLCache = None, dependency=None,
+                 maintenance_dependency=None):
+        def get_collection(name):
+            return InstrumentedCollection(name, get_backend(name), dependency, maintenance_dependency)
+
+        self.users = UserRepository(get_collection("users"), cache=user_cache)
+        self.settings = SettingsRepository(get_collection("force_sub"))
+        self.broadcasts = BroadcastRepository(get_collection("broadcasts"))
+        self.verify_tokens = VerifyTokenRepository(get_collection("verify_tokens"))
+        self.deliveries = DeliveryRepository(get_collection("deliveries"))
+        self.analytics = AnalyticsRepository(get_collection("analytics"))
+        self.channels_col = get_collection("channels")
+        self._client = client
+        self._executor = executor
+
+    async def migrate(self, verification_interval: timedelta):
+        """Create indexes and upgrade stored data to SCHEMA_VERSION, safe to run on every start"""
+        await self.users.ensure_indexes()
+        await self.verify_tokens.ensure_indexes()
+        await self.deliveries.ensure_indexes()
+        version = await self.settings.schema_version()
+        if version >= SCHEMA_VERSION:
+            return
+        if version < 1:
+            migrated = await self.users.migrate_verification(verification_interval)
+            logger.info(f"Migrated {migrated} users to verified_until")
+        await self.settings.set_schema_version(SCHEMA_VERSION)
+
+    async def ping(self):
+        """Open the first pooled connection, so the first update does not pay for it"""
+        if self._client is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._executor, self._client.admin.command, "ping")
+
+    def _reset_collections(self) -> list:
+        return [self.users.col, self.verify_tokens.col, self.deliveries.col, self.channels_col]
+
+    async def count_for_reset(self) -> int:
+        counts = await asyncio.gather(*(col.count_documents({}) for col in self._reset_collections()))
+        return sum(counts)
+
+    async def reset_all(self, batch_size: int = 1000):
+        """Delete users, tokens, deliveries and channels in batches, yielding the number removed by each"""
+        try:
+            for collection in self._reset_collections():
+                async for deleted in delete_in_batches(collection, batch_size):
+                    yield deleted
+        finally:
+            # Also when cancelled or failed half-way, the users deleted so far must not be served from cache
+            self.users.forget_all()
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        if self._client:
+            self._client.close()
+
+
+def connect(uri: str, db_name: str, pool_size: int = 10, user_cache: TTLCache = None,
+            dependency=None, maintenance_dependency=None) -> Database:
+    """Build the data-access layer, "memory://" selects the in-process backend.
+
+    ``dependency`` (a resilience.Dependency) puts a timeout and a circuit
+    breaker in front of every database operation, ``maintenance_dependency``
+    in front of those run inside maintenance().
+    """
+    if uri and uri.startswith(MEMORY_URI_PREFIX):
+        logger.info("Using in-memory database backend")
+        return Database(
+            lambda name: MemoryCollection(), user_cache=user_cache, dependency=dependency,
+            maintenance_dependency=maintenance_dependency
+        )
+
+    # The executor and the pymongo pool share one bound so threads never wait on sockets.
+    # connect=False defers connecting to the first operation (Database.ping during warmup),
+    # which also keeps the ingress process of a multi-worker setup from connecting at all
+    client = MongoClient(uri, maxPoolSize=pool_size, connect=False)
+    executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="mongo")
+    db = client[db_name]
+    return Database(
+        lambda name: MongoCollection(db[name], executor),
+        client=client,
+        executor=executor,
+        user_cache=user_cache,
+        dependency=dependency,
+        maintenance_dependency=maintenance_dependency
+    )
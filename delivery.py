@@ -0,0 +1,97 @@
+import logging
+from datetime import timedelta
+
+from cache import MISSING, TTLCache
+from metrics import DEPENDENCY_FALLBACKS
+from resilience import DependencyUnavailable
+
+logger = logging.getLogger(__name__)
+
+PHOTO = "photo"
+VIDEO = "video"
+DOCUMENT = "document"
+
+
+def media_file(message):
+    """(kind, file_id, file_unique_id) of the media in a message, None if it has none"""
+    if message is None:
+        return None
+    if message.photo:
+        photo = message.photo[-1]
+        return PHOTO, photo.file_id, photo.file_unique_id
+    if message.video:
+        return VIDEO, message.video.file_id, message.video.file_unique_id
+    if message.document:
+        return DOCUMENT, message.document.file_id, message.document.file_unique_id
+    return None
+
+
+async def send_file(bot, chat_id: int, kind: str, file_id: str, caption: str = None, caption_entities=None):
+    """Send a file Telegram already has by its file_id, no upload and no "Forwarded from" header"""
+    options = {"caption": caption, "caption_entities": caption_entities or None}
+    if kind == PHOTO:
+        return await bot.send_photo(chat_id, photo=file_id, **options)
+    if kind == VIDEO:
+        return await bot.send_video(chat_id, video=file_id, **options)
+    return await bot.send_document(chat_id, document=file_id, **options)
+
+
+class DeliveryLedger:
+    """Suppresses sending the same file to the same chat twice within ``window`` seconds.
+
+    Deliveries are claimed in the database before sending (an insert on a
+    unique key, so concurrent workers agree) and released again if the send
+    fails. Keys already known to be taken are answered from memory, and
+    file_ids are remembered by file_unique_id so "Send to me" can resend a
+    file without the original message.
+    """
+
+    def __init__(self, repository, window: float = 3600, maxsize: int = 50000, file_ttl: float = 86400):
+        self.repository = repository
+        self.window = window
+        self.recent = TTLCache(maxsize=maxsize, ttl=max(window, 1))
+        self.files = TTLCache(maxsize=maxsize, ttl=file_ttl)
+
+    @staticmethod
+    def _key(item: str, chat) -> str:
+        return f"{item}:{chat}"
+
+    def remember(self, message):
+        """Keep the file of a message and its caption by file_unique_id, returns media_file(message)"""
+        media = media_file(message)
+        if media:
+            kind, file_id, file_unique_id = media
+            self.files.set(file_unique_id, (kind, file_id, message.caption, message.caption_entities))
+        return media
+
+    def lookup(self, file_unique_id: str):
+        """(kind, file_id, caption, caption_entities) of a file seen recently, or None"""
+        file = self.files.get(file_unique_id)
+        return None if file is MISSING else file
+
+    async def claim(self, item: str, chat, **fields) -> bool:
+        """True if ``item`` may be sent to ``chat`` now, False if it was sent within the window"""
+        if not self.window:
+            return True
+        key = self._key(item, chat)
+        if self.recent.peek(key) is not MISSING:
+            return False
+        try:
+            claimed = await self.repository.claim(key, fields, timedelta(seconds=self.window))
+        except DependencyUnavailable as e:
+            # Best effort until the database is back: only this process remembers the send
+            DEPENDENCY_FALLBACKS.labels(e.dependency, "local_dedup").inc()
+            claimed = True
+        self.recent.set(key, True)
+        return claimed
+
+    async def release(self, item: str, chat):
+        """Forget a claim whose send failed, so the user can retry right away"""
+        if not self.window:
+            return
+        key = self._key(item, chat)
+        self.recent.pop(key)
+        try:
+            await self.repository.release(key)
+        except DependencyUnavailable as e:
+            logger.warning(f"Claim {key} kept until it expires: {e}")
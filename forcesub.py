@@ -0,0 +1,108 @@
+import asyncio
+import logging
+
+from cache import MISSING, TTLCache
+from metrics import DEPENDENCY_FALLBACKS
+from resilience import DependencyUnavailable
+
+logger = logging.getLogger(__name__)
+
+LEFT_STATUSES = ('left', 'kicked')
+
+
+class ForceSubChecker:
+    """Caches force-sub membership per (user, chat) and join-button metadata per chat.
+
+    With a ``dependency`` the Bot API lookups get its timeout and circuit
+    breaker. While it is unavailable a membership known within the last
+    ``stale_ttl`` seconds is used, otherwise ``fail_open`` decides whether
+    the user counts as joined; neither answer is cached.
+    """
+
+    def __init__(self, positive_ttl: float = 600, negative_ttl: float = 30,
+                 chat_ttl: float = 3600, maxsize: int = 50000,
+                 dependency=None, stale_ttl: float = 0.0, fail_open: bool = False):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.memberships = TTLCache(maxsize=maxsize, ttl=positive_ttl, stale_ttl=stale_ttl)
+        self.chats = TTLCache(maxsize=256, ttl=chat_ttl)
+        self.dependency = dependency
+        self.fail_open = fail_open
+
+    async def _call(self, fn, **kwargs):
+        if self.dependency is None:
+            return await fn(**kwargs)
+        return await self.dependency.call(fn, **kwargs)
+
+    async def _is_member(self, bot, chat: str, user_id: int) -> bool:
+        key = (user_id, chat)
+        cached = self.memberships.get(key)
+        if cached is not MISSING:
+            return cached
+
+        try:
+            member = await self._call(bot.get_chat_member, chat_id=chat, user_id=user_id)
+        except DependencyUnavailable as e:
+            stale = self.memberships.stale(key)
+            if stale is not MISSING:
+                DEPENDENCY_FALLBACKS.labels(e.dependency, "stale_membership").inc()
+                return stale
+            if self.fail_open:
+                DEPENDENCY_FALLBACKS.labels(e.dependency, "force_sub_fail_open").inc()
+            else:
+                logger.error(f"Force sub check error: {e}")
+            return self.fail_open
+        except Exception as e:
+            # Errors are not cached, the next update retries the lookup
+            logger.error(f"Force sub check error: {e}")
+            return False
+
+        joined = member.status not in LEFT_STATUSES
+        self.memberships.set(key, joined, ttl=self.positive_ttl if joined else self.negative_ttl)
+        return joined
+
+    async def missing(self, bot, user_id: int, chats: list) -> list:
+        """Return the chats the user has not joined, looking them up concurrently"""
+        if not chats:
+            return []
+        results = await asyncio.gather(*(self._is_member(bot, chat, user_id) for chat in chats))
+        return [chat for chat, joined in zip(chats, results) if not joined]
+
+    async def _chat_info(self, bot, chat: str):
+        info = self.chats.get(chat)
+        if info is not MISSING:
+            return info
+        try:
+            resolved = await self._call(bot.get_chat, chat_id=chat)
+            info = (resolved.title, resolved.username)
+        except DependencyUnavailable:
+            # Plain join buttons for now, without caching them for an hour
+            return None
+        except Exception:
+            info = None
+        self.chats.set(chat, info)
+        return info
+
+    async def join_links(self, bot, chats: list, fallback_label: str) -> list:
+        """Return (label, url) pairs for the join buttons of the given chats"""
+        infos = await asyncio.gather(*(self._chat_info(bot, chat) for chat in chats))
+        links = []
+        for chat, info in zip(chats, infos):
+            if info:
+                title, username = info
+                links.append((f"Join {title}", f"https://t.me/{username}"))
+            else:
+                links.append((fallback_label, f"https://t.me/{chat}"))
+        return links
+
+    async def warm(self, bot, chats: list):
+        """Resolve join-button metadata ahead of the first user who needs it"""
+        await asyncio.gather(*(self._chat_info(bot, chat) for chat in chats))
+
+    def invalidate_user(self, user_id: int, chats: list):
+        for chat in chats:
+            self.memberships.pop((user_id, chat))
+
+    def invalidate_chat(self, chat: str):
+        self.memberships.remove_if(lambda key: key[1] == chat)
+        self.chats.pop(chat)
@@ -0,0 +1,55 @@
+import asyncio
+import logging
+import secrets
+from datetime import datetime, timedelta
+
+from shortener import verification_url
+
+logger = logging.getLogger(__name__)
+
+
+async def prepare_renewals(db, shortener, bot_username: str, lead: timedelta, token_ttl: timedelta,
+                           batch_size: int = 100, notify=None, rate: float = 5.0) -> int:
+    """Store a fresh verification link on every user whose verification lapses within ``lead``.
+
+    The link's token stays valid ``token_ttl`` past the expiry, so the prompt
+    a lapsed user gets is served from the profile without a shortener call.
+    Without a configured shortener the links are the long ones.
+    ``notify(user_id, url)`` is awaited for each user at most ``rate`` times a
+    second when given. Returns the number of links prepared.
+    """
+    prepared = 0
+    while True:
+        # Every user handled gets a link and drops out of the scan, so no paging is needed
+        batch = await db.users.expiring(datetime.utcnow() + lead, batch_size)
+        if not batch:
+            return prepared
+        for user in batch:
+            token = secrets.token_urlsafe(16)
+            long_url = verification_url(bot_username, token)
+            if not shortener.configured:
+                # Without a shortener the long link is the link
+                short_url = long_url
+            else:
+                short_url = await shortener.shorten(long_url)
+                if short_url == long_url:
+                    # Shortener unavailable, the next run picks these users up again
+                    logger.warning(f"Shortener unavailable, prepared {prepared} renewal links this run")
+                    return prepared
+            expires_at = user["verified_until"] + token_ttl
+            await db.verify_tokens.issue(token, user["_id"], expires_at - datetime.utcnow())
+            await db.users.set_renewal_link(user["_id"], short_url, expires_at)
+            prepared += 1
+            if notify is not None:
+                await notify(user["_id"], short_url)
+                await asyncio.sleep(1 / rate)
+
+
+async def prune_blocked(db, older_than: timedelta, batch_size: int = 500) -> int:
+    """Delete users that blocked the bot more than ``older_than`` ago, returns how many"""
+    cutoff = datetime.utcnow() - older_than
+    pruned = 0
+    # Users flagged before blocked_at was recorded are kept
+    async for user_ids in db.users.id_batches(batch_size, filter={"blocked": True, "blocked_at": {"$lte": cutoff}}):
+        pruned += await db.users.delete_batch(user_ids)
+    return pruned
@@ -0,0 +1,226 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import Update
+
+from metrics import DURABLE_QUEUE_AGE, DURABLE_QUEUE_DEPTH, DURABLE_QUEUE_DUPLICATES
+
+logger = logging.getLogger(__name__)
+
+PENDING = 0
+CLAIMED = 1
+DONE = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS updates (
+    update_id INTEGER PRIMARY KEY,
+    payload TEXT NOT NULL,
+    received_at REAL NOT NULL,
+    status INTEGER NOT NULL DEFAULT 0,
+    done_at REAL
+);
+CREATE INDEX IF NOT EXISTS updates_status ON updates (status, update_id);
+"""
+
+
+class UpdateLog:
+    """Received updates in a SQLite table in WAL mode, every statement runs on one dedicated thread"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest")
+        self._db = None
+
+    def _run(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _open(self) -> int:
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # Survives the process being killed, only an OS crash can lose the last commits
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        with self._db:
+            # Claimed by a process that did not finish them: hand them out again
+            return self._db.execute(
+                "UPDATE updates SET status = ? WHERE status = ?", (PENDING, CLAIMED)
+            ).rowcount
+
+    def _append(self, rows: list) -> int:
+        with self._db:
+            return self._db.executemany(
+                "INSERT OR IGNORE INTO updates (update_id, payload, received_at) VALUES (?, ?, ?)", rows
+            ).rowcount
+
+    def _claim(self, limit: int) -> list:
+        with self._db:
+            rows = self._db.execute(
+                "SELECT update_id, payload FROM updates WHERE status = ? ORDER BY update_id LIMIT ?",
+                (PENDING, limit)
+            ).fetchall()
+            self._db.executemany(
+                "UPDATE updates SET status = ? WHERE update_id = ?", [(CLAIMED, row[0]) for row in rows]
+            )
+        return rows
+
+    def _finish(self, update_ids: list, now: float):
+        with self._db:
+            self._db.executemany(
+                "UPDATE updates SET status = ?, done_at = ? WHERE update_id = ?",
+                [(DONE, now, update_id) for update_id in update_ids]
+            )
+
+    def _prune(self, before: float) -> int:
+        with self._db:
+            return self._db.execute(
+                "DELETE FROM updates WHERE status = ? AND done_at < ?", (DONE, before)
+            ).rowcount
+
+    def _backlog(self) -> tuple:
+        return self._db.execute(
+            "SELECT COUNT(*), MIN(received_at) FROM updates WHERE status < ?", (DONE,)
+        ).fetchone()
+
+    async def open(self) -> int:
+        return await self._run(self._open)
+
+    async def append(self, rows: list) -> int:
+        return await self._run(self._append, rows)
+
+    async def claim(self, limit: int) -> list:
+        return await self._run(self._claim, limit)
+
+    async def finish(self, update_ids: list):
+        await self._run(self._finish, update_ids, time.time())
+
+    async def prune(self, before: float) -> int:
+        return await self._run(self._prune, before)
+
+    async def backlog(self) -> tuple:
+        return await self._run(self._backlog)
+
+    async def close(self):
+        if self._db is not None:
+            await self._run(self._db.close)
+            self._db = None
+        self._executor.shutdown(wait=True)
+
+
+class IngestQueue:
+    """Durable, at-least-once ingestion: updates are committed to disk before they are acknowledged.
+
+    The webhook returns as soon as ``append`` committed, whatever the
+    handlers are doing. A consumer claims stored updates in update_id order
+    and runs them through the application's update processor, at most
+    ``max_inflight`` at a time, and marks them done once their handlers
+    returned. After a crash or restart, claimed updates that never finished
+    are processed again. update_id is the primary key, so a redelivery of an
+    update that is already stored is ignored; finished updates are kept for
+    ``retention`` seconds for that purpose.
+    """
+
+    def __init__(self, path: str, max_inflight: int = 100, batch_size: int = 100, retention: float = 3600,
+                 report_interval: float = 1.0):
+        self.log = UpdateLog(path)
+        self.max_inflight = max_inflight
+        self.batch_size = batch_size
+        self.retention = retention
+        self.report_interval = report_interval
+        self._inflight = {}
+        self._finished = []
+        self._wake = asyncio.Event()
+        self._consumer = None
+        self._reporter = None
+
+    async def open(self):
+        requeued = await self.log.open()
+        if requeued:
+            logger.warning(f"Processing {requeued} updates again that were in flight when the bot stopped")
+        await self._report()
+
+    async def append(self, payloads: list) -> int:
+        """Store raw updates durably, returns how many were new"""
+        now = time.time()
+        rows = [(payload["update_id"], json.dumps(payload), now) for payload in payloads]
+        inserted = await self.log.append(rows)
+        if inserted < len(rows):
+            DURABLE_QUEUE_DUPLICATES.inc(len(rows) - inserted)
+        self._wake.set()
+        return inserted
+
+    def start(self, application):
+        if self._consumer is None:
+            self._consumer = asyncio.create_task(self._consume(application))
+            self._reporter = asyncio.create_task(self._maintain())
+
+    async def _consume(self, application):
+        while True:
+            self._wake.clear()
+            free = self.max_inflight - len(self._inflight)
+            rows = await self.log.claim(min(free, self.batch_size)) if free > 0 else []
+            if not rows:
+                # New updates and finished ones both wake the consumer up
+                await self._wake.wait()
+                continue
+            for update_id, payload in rows:
+                self._inflight[update_id] = asyncio.create_task(self._process(application, update_id, payload))
+
+    async def _process(self, application, update_id: int, payload: str):
+        try:
+            update = Update.de_json(json.loads(payload), application.bot)
+            # Through the update processor, so priorities and per-user ordering still apply
+            await application.update_processor.process_update(update, application.process_update(update))
+        except Exception as e:
+            # Handler errors were already reported by process_update; do not retry a poison update forever
+            logger.error(f"Failed to process queued update {update_id}: {e}")
+        finally:
+            self._inflight.pop(update_id, None)
+            self._finished.append(update_id)
+            self._wake.set()
+
+    async def _flush_finished(self):
+        if self._finished:
+            finished, self._finished = self._finished, []
+            await self.log.finish(finished)
+
+    async def _report(self):
+        depth, oldest = await self.log.backlog()
+        DURABLE_QUEUE_DEPTH.set(depth)
+        DURABLE_QUEUE_AGE.set(time.time() - oldest if oldest else 0)
+
+    async def _maintain(self):
+        last_prune = 0.0
+        while True:
+            await asyncio.sleep(self.report_interval)
+            try:
+                await self._flush_finished()
+                await self._report()
+                if time.monotonic() - last_prune > 60:
+                    last_prune = time.monotonic()
+                    await self.log.prune(time.time() - self.retention)
+            except Exception as e:
+                logger.error(f"Durable queue maintenance failed: {e}")
+
+    async def stop(self, timeout: float = 10.0):
+        """Stop claiming, give running updates ``timeout`` seconds to finish, then record what finished"""
+        for task in (self._consumer, self._reporter):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._consumer = self._reporter = None
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self._inflight and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        if self._inflight:
+            logger.warning(f"{len(self._inflight)} queued updates still running, they are processed again on restart")
+        await self._flush_finished()
+        await self.log.close()
@@ -0,0 +1,138 @@
+import asyncio
+import gzip
+import itertools
+import logging
+import time
+from collections import deque
+
+import bson
+
+logger = logging.getLogger(__name__)
+
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# Export format: gzip-compressed concatenated BSON documents, the same layout
+# mongodump writes, so a backup can also be loaded with mongorestore
+EXPORT_SUFFIX = ".bson.gz"
+
+
+class AdminJob:
+    def __init__(self, job_id: int, name: str, total: int = None):
+        self.id = job_id
+        self.name = name
+        self.total = total
+        self.processed = 0
+        self.status = RUNNING
+        self.result = None
+        self.error = None
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self._task = None
+
+    def advance(self, count: int):
+        self.processed += count
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def eta(self):
+        """Seconds left at the current pace, None when it cannot be estimated"""
+        if self.status != RUNNING or not self.total or not self.processed:
+            return None
+        rate = self.processed / self.elapsed
+        return max(self.total - self.processed, 0) / rate
+
+
+class AdminJobRunner:
+    """Runs owner maintenance jobs one at a time as cancellable background tasks.
+
+    A job is a coroutine function taking the AdminJob, it reports progress
+    with ``job.advance()`` and returns a result that ``on_finish`` receives
+    along with the job once it ended, however it ended.
+    """
+
+    def __init__(self, history: int = 10):
+        self.current = None
+        self.history = deque(maxlen=history)
+        self._ids = itertools.count(1)
+
+    @property
+    def running(self) -> bool:
+        return self.current is not None and self.current.status == RUNNING
+
+    def start(self, name: str, fn, total: int = None, on_finish=None) -> AdminJob:
+        if self.running:
+            raise RuntimeError(f"Job {self.current.name} is still running")
+        job = AdminJob(next(self._ids), name, total)
+        job._task = asyncio.create_task(self._run(job, fn, on_finish))
+        self.current = job
+        self.history.append(job)
+        return job
+
+    async def _run(self, job: AdminJob, fn, on_finish):
+        try:
+            job.result = await fn(job)
+            job.status = DONE
+        except asyncio.CancelledError:
+            job.status = CANCELLED
+        except Exception as e:
+            logger.error(f"Admin job {job.name} failed: {e}")
+            job.status = FAILED
+            job.error = str(e)
+        finally:
+            job.finished_at = time.monotonic()
+        logger.info(f"Admin job {job.name} {job.status} after {job.elapsed:.1f}s ({job.processed} items)")
+        if on_finish is not None:
+            try:
+                await on_finish(job)
+            except Exception as e:
+                logger.error(f"Admin job {job.name} notification failed: {e}")
+
+    async def cancel(self) -> bool:
+        if not self.running:
+            return False
+        task = self.current._task
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return True
+
+    async def stop(self):
+        await self.cancel()
+
+
+async def reset_all(db, job: AdminJob, batch_size: int = 1000) -> int:
+    async for deleted in db.reset_all(batch_size):
+        job.advance(deleted)
+    return job.processed
+
+
+async def export_users(db, job: AdminJob, path: str, batch_size: int = 1000) -> int:
+    """Stream every user document into ``path``, one batch in memory at a time"""
+    with gzip.open(path, "wb") as f:
+        async for batch in db.users.batches(batch_size):
+            data = b"".join(bson.encode(doc) for doc in batch)
+            # Compression is CPU work, keep it off the event loop
+            await asyncio.to_thread(f.write, data)
+            job.advance(len(batch))
+    return job.processed
+
+
+async def import_users(db, job: AdminJob, path: str, batch_size: int = 1000) -> dict:
+    """Upsert users from an export file in bulk writes, existing users are overwritten field by field"""
+    summary = {"matched": 0, "upserted": 0}
+    with gzip.open(path, "rb") as f:
+        documents = bson.decode_file_iter(f)
+        while True:
+            batch = await asyncio.to_thread(lambda: list(itertools.islice(documents, batch_size)))
+            if not batch:
+                break
+            result = await db.users.bulk_upsert(batch)
+            summary["matched"] += result["matched"]
+            summary["upserted"] += result["upserted"]
+            job.advance(len(batch))
+    return summary
@@ -0,0 +1,225 @@
+import asyncio
+import functools
+import logging
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, Metric
+from prometheus_client.parser import text_string_to_metric_families
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+logger = logging.getLogger(__name__)
+
+# Buckets tuned for chat-bot latencies: most work is a few ms, API/DB round-trips tens to hundreds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HANDLER_LATENCY = Histogram(
+    "bot_handler_duration_seconds", "Time spent in bot handlers and checks",
+    ["handler"], buckets=LATENCY_BUCKETS
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Exceptions raised by bot handlers and checks", ["handler"]
+)
+MONGO_LATENCY = Histogram(
+    "bot_mongo_operation_duration_seconds", "Database operation latency",
+    ["collection", "operation"], buckets=LATENCY_BUCKETS
+)
+MONGO_ERRORS = Counter(
+    "bot_mongo_operation_errors_total", "Failed database operations", ["collection", "operation"]
+)
+BOT_API_LATENCY = Histogram(
+    "bot_api_request_duration_seconds", "Bot API request latency per attempt",
+    ["endpoint"], buckets=LATENCY_BUCKETS
+)
+BOT_API_ERRORS = Counter(
+    "bot_api_request_errors_total", "Failed Bot API request attempts", ["endpoint", "code"]
+)
+UPDATE_WAIT = Histogram(
+    "bot_update_queue_wait_seconds", "Time updates wait for a worker", ["tier"],
+    buckets=LATENCY_BUCKETS
+)
+UPDATE_QUEUE_DEPTH = Gauge("bot_update_queue_depth", "Updates waiting for a worker", ["tier"])
+INGRESS_FORWARDED = Counter(
+    "bot_ingress_forwarded_updates_total", "Webhook updates handed to a worker process", ["worker"]
+)
+INGRESS_REJECTED = Counter(
+    "bot_ingress_rejected_updates_total", "Webhook updates refused because a worker queue was full", ["worker"]
+)
+INGRESS_QUEUE_DEPTH = Gauge(
+    "bot_ingress_queue_depth", "Updates accepted by the ingress but not yet delivered to a worker", ["worker"]
+)
+DURABLE_QUEUE_DEPTH = Gauge(
+    "bot_durable_queue_depth", "Updates stored in the durable ingestion queue and not processed yet"
+)
+DURABLE_QUEUE_AGE = Gauge(
+    "bot_durable_queue_oldest_age_seconds", "Age of the oldest unprocessed update in the durable queue"
+)
+DURABLE_QUEUE_DUPLICATES = Counter(
+    "bot_durable_queue_duplicates_total", "Redelivered updates ignored because their update_id was already queued"
+)
+THROTTLED_UPDATES = Counter(
+    "bot_throttled_updates_total", "Updates dropped by the per-user rate limit", ["tier"]
+)
+DUPLICATE_DELIVERIES = Counter(
+    "bot_duplicate_deliveries_total", "Forwards skipped because the same file already went to the chat",
+    ["destination"]
+)
+DEPENDENCY_FALLBACKS = Counter(
+    "bot_dependency_fallbacks_total", "Answers given by a fallback because a dependency was unavailable",
+    ["dependency", "fallback"]
+)
+STARTUP_PHASE = Gauge("bot_startup_phase_seconds", "Duration of each startup phase", ["phase"])
+READY = Gauge("bot_ready", "1 once startup finished and updates are being processed")
+EVENT_LOOP_LAG = Histogram(
+    "bot_event_loop_lag_seconds", "How late the event loop wakes up a sleeping task",
+    buckets=LATENCY_BUCKETS
+)
+
+
+def error_code(error: Exception) -> str:
+    """Low-cardinality label for a Bot API failure"""
+    if isinstance(error, RetryAfter):
+        return "429"
+    if isinstance(error, Forbidden):
+        return "403"
+    if isinstance(error, BadRequest):
+        return "400"
+    if isinstance(error, TimedOut):
+        return "timeout"
+    if isinstance(error, NetworkError):
+        return "network"
+    return type(error).__name__
+
+
+def timed(name: str):
+    """Decorator recording the latency and errors of an async function under ``name``"""
+    def decorator(fn):
+        latency = HANDLER_LATENCY.labels(name)
+        errors = HANDLER_ERRORS.labels(name)
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                latency.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+class CacheCollector:
+    """Exports hit/miss counters and sizes of TTLCache instances at scrape time"""
+
+    def __init__(self, caches: dict):
+        self.caches = caches
+
+    def collect(self):
+        hits = CounterMetricFamily("bot_cache_hits", "Cache hits", labels=["cache"])
+        misses = CounterMetricFamily("bot_cache_misses", "Cache misses", labels=["cache"])
+        size = GaugeMetricFamily("bot_cache_entries", "Entries held by the cache", labels=["cache"])
+        ratio = GaugeMetricFamily("bot_cache_hit_ratio", "Hits / lookups since start", labels=["cache"])
+        for name, cache in self.caches.items():
+            stats = cache.stats()
+            hits.add_metric([name], stats["hits"])
+            misses.add_metric([name], stats["misses"])
+            size.add_metric([name], stats["size"])
+            ratio.add_metric([name], stats["hit_ratio"])
+        yield hits
+        yield misses
+        yield size
+        yield ratio
+
+
+def register_caches(caches: dict):
+    REGISTRY.register(CacheCollector(caches))
+
+
+class BreakerCollector:
+    """Exports the state of circuit breakers at scrape time, 1 for the current state of each"""
+
+    def __init__(self, breakers: dict):
+        self.breakers = breakers
+
+    def collect(self):
+        state = GaugeMetricFamily(
+            "bot_dependency_circuit_state", "Circuit breaker state per dependency", labels=["dependency", "state"]
+        )
+        for name, breaker in self.breakers.items():
+            current = breaker.state
+            for candidate in (breaker.CLOSED, breaker.HALF_OPEN, breaker.OPEN):
+                state.add_metric([name, candidate], 1 if candidate == current else 0)
+        yield state
+
+
+def register_breakers(breakers: dict):
+    REGISTRY.register(BreakerCollector(breakers))
+
+
+def render():
+    """Current metrics in the Prometheus text format, as (body, content type)"""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+class FamiliesCollector:
+    """Serves metric families that were already collected, e.g. parsed from other processes"""
+
+    def __init__(self, families):
+        self.families = families
+
+    def collect(self):
+        return self.families
+
+
+def render_merged(expositions: dict):
+    """Merge ``{process: text}`` expositions into one, as (body, content type).
+
+    Every sample gets a ``process`` label naming where it came from, so the
+    same metric of several processes ends up in one family.
+    """
+    families = {}
+    for process, text in expositions.items():
+        for family in text_string_to_metric_families(text):
+            merged = families.get(family.name)
+            if merged is None:
+                merged = families[family.name] = Metric(family.name, family.documentation, family.type, family.unit)
+            for sample in family.samples:
+                merged.samples.append(sample._replace(labels=dict(sample.labels, process=process)))
+    registry = CollectorRegistry(auto_describe=False)
+    registry.register(FamiliesCollector(list(families.values())))
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+class LoopLagMonitor:
+    """Measures event-loop lag: how much later than requested a short sleep returns"""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - started - self.interval
+            EVENT_LOOP_LAG.observe(max(lag, 0.0))
+            if lag > 1.0:
+                logger.warning(f"Event loop lag: {lag:.2f}s")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
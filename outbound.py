@@ -0,0 +1,170 @@
+import asyncio
+import contextlib
+import logging
+import time
+from collections import Counter
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+from telegram.ext import BaseRateLimiter
+
+from metrics import BOT_API_ERRORS, BOT_API_LATENCY, error_code
+from ratelimit import KeyedRateLimiter, TokenBucket
+from resilience import LocalWait, local_wait
+from scheduler import released_worker
+
+logger = logging.getLogger(__name__)
+
+# Endpoints that post into a chat and count against Telegram's per-chat limits
+MESSAGE_ENDPOINT_PREFIXES = ("send", "forward", "copy")
+
+# Safe to repeat after a timeout and to share between identical concurrent calls
+IDEMPOTENT_ENDPOINTS = {
+    "getMe",
+    "getChat",
+    "getChatMember",
+    "getChatAdministrators",
+    "getFile",
+    "getMyCommands",
+    "setMyCommands",
+    "setWebhook",
+    "deleteWebhook",
+    "getWebhookInfo",
+}
+
+
+def is_outage(error: Exception) -> bool:
+    """Errors that mean the Bot API is unreachable or too slow; BadRequest subclasses NetworkError but is an answer"""
+    return isinstance(error, NetworkError) and not isinstance(error, BadRequest)
+
+
+class EndpointStats:
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.latency = BOT_API_LATENCY.labels(endpoint)
+        self.calls = 0
+        self.retries = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.errors = Counter()
+
+    def record(self, duration: float, error: Exception = None):
+        self.calls += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        self.latency.observe(duration)
+        if error is not None:
+            self.errors[type(error).__name__] += 1
+            BOT_API_ERRORS.labels(self.endpoint, error_code(error)).inc()
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """Single gate for every Bot API call made through the Application's bot.
+
+    Enforces a global request rate plus per-chat message rates (private chats
+    and groups/channels have different limits), waits out RetryAfter, retries
+    transient network failures with exponential backoff and shares the result
+    of identical concurrent read calls. Timeouts are only retried for
+    idempotent endpoints, since a timed out send may still have been delivered.
+    """
+
+    def __init__(self, global_rate: float = 30.0, private_rate: float = 1.0, private_burst: float = 3,
+                 group_rate: float = 20 / 60, group_burst: float = 3, max_retries: int = 3,
+                 backoff: float = 0.5):
+        self.global_bucket = TokenBucket(global_rate)
+        self.private_chats = KeyedRateLimiter(private_rate, private_burst)
+        self.group_chats = KeyedRateLimiter(group_rate, group_burst)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.stats = {}
+        self._inflight = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, endpoint: str, data: dict):
+        chat_id = data.get("chat_id")
+        if chat_id is None or not endpoint.startswith(MESSAGE_ENDPOINT_PREFIXES):
+            return None
+        # Private chats have positive ids, groups and channels negative ids or @usernames
+        if isinstance(chat_id, int) and chat_id > 0:
+            return self.private_chats.bucket(chat_id)
+        return self.group_chats.bucket(chat_id)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        # A dependency call around this request must not score time spent in our buckets
+        caller_wait = local_wait()
+        if endpoint not in IDEMPOTENT_ENDPOINTS:
+            return await self._call(callback, args, kwargs, endpoint, data, caller_wait)
+
+        # Coalesce identical concurrent reads (e.g. the same get_chat_member from a burst of updates)
+        key = (endpoint, repr(sorted(data.items(), key=lambda item: item[0])))
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            shared_wait = LocalWait()
+            task = asyncio.ensure_future(self._call(callback, args, kwargs, endpoint, data, shared_wait))
+            self._inflight[key] = task, shared_wait
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            task, shared_wait = inflight
+        if caller_wait is not None:
+            caller_wait.share(shared_wait)
+        return await asyncio.shield(task)
+
+    async def _call(self, callback, args, kwargs, endpoint: str, data: dict, wait: LocalWait = None):
+        stats = self.stats.get(endpoint)
+        if stats is None:
+            stats = self.stats[endpoint] = EndpointStats(endpoint)
+        chat_bucket = self._chat_bucket(endpoint, data)
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                stats.retries += 1
+            with wait if wait is not None else contextlib.nullcontext():
+                await self.global_bucket.acquire()
+                if chat_bucket is not None and not chat_bucket.try_acquire():
+                    # Waiting on one chat's limit is not work, other users' updates may run meanwhile
+                    async with released_worker():
+                        await chat_bucket.acquire()
+
+            started = time.monotonic()
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                stats.record(time.monotonic() - started, e)
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"{endpoint}: flood wait {e.retry_after}s")
+                # Hold back just this chat for chat-scoped calls, everything otherwise
+                (chat_bucket or self.global_bucket).pause(e.retry_after)
+            except BadRequest as e:
+                stats.record(time.monotonic() - started, e)
+                raise
+            except NetworkError as e:
+                stats.record(time.monotonic() - started, e)
+                retryable = not isinstance(e, TimedOut) or endpoint in IDEMPOTENT_ENDPOINTS
+                if not retryable or attempt == self.max_retries:
+                    raise
+                logger.warning(f"{endpoint}: {e}, retrying")
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+            except Exception as e:
+                stats.record(time.monotonic() - started, e)
+                raise
+            else:
+                stats.record(time.monotonic() - started)
+                return result
+
+    def snapshot(self) -> dict:
+        """Per-endpoint call counts, latency and errors"""
+        return {
+            endpoint: {
+                "calls": stats.calls,
+                "retries": stats.retries,
+                "avg_time": stats.total_time / stats.calls if stats.calls else 0.0,
+                "max_time": stats.max_time,
+                "errors": dict(stats.errors)
+            }
+            for endpoint, stats in sorted(self.stats.items())
+        }
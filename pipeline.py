@@ -0,0 +1,63 @@
+import functools
+
+from telegram.ext import CallbackContext
+
+from scheduler import OWNER
+
+
+class Request:
+    """What the handlers of one update know about its user, every fact is looked up at most once.
+
+    The pipeline builds it from cached data only (user and tier), so it costs
+    no I/O; ``resolve`` runs the named resolver the first time a guard or a
+    handler asks for that fact and returns the same result afterwards.
+    Resolvers are ``async def resolver(request)`` and may resolve other facts.
+    """
+
+    def __init__(self, bot, user_id: int, tier: str, resolvers: dict):
+        self.bot = bot
+        self.user_id = user_id
+        self.tier = tier
+        self._resolvers = resolvers
+        self._resolved = {}
+
+    @property
+    def is_owner(self) -> bool:
+        return self.tier == OWNER
+
+    async def resolve(self, name: str):
+        if name not in self._resolved:
+            self._resolved[name] = await self._resolvers[name](self)
+        return self._resolved[name]
+
+    def forget(self, name: str):
+        """Look ``name`` up again on the next ``resolve``, after the underlying data changed"""
+        self._resolved.pop(name, None)
+
+
+class RequestContext(CallbackContext):
+    """CallbackContext carrying the update's Request, None for updates without a user and for jobs"""
+
+    def __init__(self, application, chat_id: int = None, user_id: int = None):
+        super().__init__(application, chat_id=chat_id, user_id=user_id)
+        self.request = None
+
+
+def requires(*guards):
+    """Run the handler only when every guard passes, checked in order.
+
+    A guard is ``async def guard(update, context) -> bool`` and tells the
+    user why when it fails; the remaining guards and the handler are skipped.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            if context.request is None:
+                return
+            for guard in guards:
+                if not await guard(update, context):
+                    return
+            return await handler(update, context)
+        wrapper.requirements = guards
+        return wrapper
+    return decorator
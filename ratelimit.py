@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+from cache import MISSING, TTLCache
+
+
+class TokenBucket:
+    """Token bucket refilled at ``rate`` tokens per second, holding at most ``capacity``"""
+
+    def __init__(self, rate: float, capacity: float = None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        now = self._clock()
+        if now < self._paused_until:
+            return False
+        self._refill(now)
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    def wait_time(self, tokens: float = 1) -> float:
+        """Seconds until ``tokens`` can be taken, ignoring other waiters"""
+        now = self._clock()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._refill(now)
+        if self._tokens >= tokens:
+            return 0.0
+        return (tokens - self._tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1):
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.wait_time(tokens))
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for a while, e.g. after a RetryAfter from Telegram"""
+        self._paused_until = max(self._paused_until, self._clock() + seconds)
+        self._tokens = 0.0
+
+
+class KeyedRateLimiter:
+    """One TokenBucket per key (chat, user, ...), idle buckets are evicted once they would be full"""
+
+    # Idle buckets live at least this long so a RetryAfter pause is not forgotten early
+    MIN_IDLE_TTL = 300.0
+
+    def __init__(self, rate: float, capacity: float = None, maxsize: int = 100000):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._buckets = TTLCache(maxsize=maxsize, ttl=max(self.capacity / rate, self.MIN_IDLE_TTL))
+
+    def bucket(self, key) -> TokenBucket:
+        bucket = self._buckets.peek(key)
+        if bucket is MISSING:
+            bucket = TokenBucket(self.rate, self.capacity)
+        # Refresh the TTL on every use so only idle buckets expire
+        self._buckets.set(key, bucket)
+        return bucket
+
+    def try_acquire(self, key, tokens: float = 1) -> bool:
+        return self.bucket(key).try_acquire(tokens)
+
+
+class UserThrottle:
+    """Per-user token buckets with limits per tier, plus a flag to warn each user once per window.
+
+    ``limits`` maps a tier to ``(rate, burst)``; tiers without an entry are
+    never throttled.
+    """
+
+    def __init__(self, limits: dict, notice_interval: float = 30, maxsize: int = 100000):
+        self.limiters = {
+            tier: KeyedRateLimiter(rate, burst, maxsize=maxsize)
+            for tier, (rate, burst) in limits.items()
+        }
+        self.notices = TTLCache(maxsize=maxsize, ttl=notice_interval)
+
+    def allow(self, tier: str, user_id: int) -> bool:
+        limiter = self.limiters.get(tier)
+        return limiter is None or limiter.try_acquire(user_id)
+
+    def should_notify(self, user_id: int) -> bool:
+        """True the first time a user is throttled within the notice interval"""
+        if self.notices.peek(user_id) is not MISSING:
+            return False
+        self.notices.set(user_id, True)
+        return True
@@ -0,0 +1,190 @@
+import asyncio
+import contextvars
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# LocalWait of the Dependency call the current task is running, see Dependency.call
+_local_wait = contextvars.ContextVar("dependency_local_wait", default=None)
+
+
+class CircuitBreaker:
+    """Stops calling a dependency after repeated failures or slow calls.
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    rejects calls for ``reset_timeout`` seconds, then lets a single probe
+    through; the probe's outcome closes or re-opens it.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 slow_call_threshold: float = None, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call_threshold = slow_call_threshold
+        self._clock = clock
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._probe_in_flight = False
+        return self._state
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self, duration: float = None):
+        if self.slow_call_threshold is not None and duration is not None \
+                and duration > self.slow_call_threshold:
+            logger.warning(f"{self.name}: slow call ({duration:.2f}s)")
+            self.record_failure()
+            return
+        if self._state != self.CLOSED:
+            logger.info(f"{self.name}: circuit closed")
+        self._state = self.CLOSED
+        self._failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self._failures += 1
+        self._probe_in_flight = False
+        if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self._state != self.OPEN:
+                logger.warning(f"{self.name}: circuit opened after {self._failures} failure(s)")
+            self._state = self.OPEN
+            self._opened_at = self._clock()
+
+    def abandon(self):
+        """A call ended without an outcome (it was cancelled), another probe may go through"""
+        self._probe_in_flight = False
+
+    def reset(self):
+        self._state = self.CLOSED
+        self._failures = 0
+        self._probe_in_flight = False
+
+
+class LocalWait:
+    """Time a dependency call spends queueing locally (e.g. in a rate limiter) instead of on the service.
+
+    Used as a context manager around each wait. A call that piggybacks on
+    another one's request ``share``s that request's LocalWait, so the
+    waiting it still sees counts as its own.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.total = 0.0
+        self._since = None
+        self._shared = []
+
+    def __enter__(self):
+        self._since = self.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.total += self.clock() - self._since
+        self._since = None
+
+    def share(self, other: "LocalWait"):
+        self._shared.append((other, other.seconds()))
+
+    def seconds(self) -> float:
+        waited = self.total
+        if self._since is not None:
+            waited += self.clock() - self._since
+        return waited + sum(other.seconds() - base for other, base in self._shared)
+
+
+def local_wait():
+    """LocalWait of the dependency call in progress, None outside of one"""
+    return _local_wait.get()
+
+
+class DependencyUnavailable(Exception):
+    """A dependency failed, timed out or is behind an open circuit; callers may fall back"""
+
+    def __init__(self, dependency: str, message: str):
+        super().__init__(f"{dependency}: {message}")
+        self.dependency = dependency
+
+
+class Dependency:
+    """Timeouts and a circuit breaker around every call to one external service.
+
+    ``call`` raises DependencyUnavailable when the breaker is open (without
+    calling), when the call takes longer than ``timeout`` seconds, or when it
+    raises an exception ``is_failure`` accepts; other exceptions, e.g. a
+    duplicate key or a bad request, are the service answering and pass
+    through unchanged. Calls slower than half the timeout count as failures
+    too, so a brownout opens the circuit before every caller waits it out.
+    Time the call reports as local_wait() is neither timed nor scored, a
+    congested local queue is not the service being slow.
+    """
+
+    def __init__(self, name: str, timeout: float, is_failure=lambda e: True,
+                 failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.timeout = timeout
+        self.is_failure = is_failure
+        self.breaker = CircuitBreaker(
+            name, failure_threshold=failure_threshold, reset_timeout=reset_timeout,
+            slow_call_threshold=timeout / 2
+        )
+
+    async def call(self, fn, *args, **kwargs):
+        if not self.breaker.allow():
+            raise DependencyUnavailable(self.name, "circuit open")
+        started = time.monotonic()
+        wait = LocalWait()
+        token = _local_wait.set(wait)
+        try:
+            # The task copies the context, so the call reports its local waits to ``wait``
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+        finally:
+            _local_wait.reset(token)
+
+        def elapsed():
+            return time.monotonic() - started - wait.seconds()
+
+        try:
+            while not task.done():
+                remaining = self.timeout - elapsed()
+                if remaining <= 0:
+                    break
+                await asyncio.wait({task}, timeout=remaining)
+        except asyncio.CancelledError:
+            task.cancel()
+            self.breaker.abandon()
+            raise
+        if not task.done():
+            task.cancel()
+            await asyncio.wait({task})
+            self.breaker.record_failure()
+            raise DependencyUnavailable(self.name, f"timed out after {self.timeout}s")
+        try:
+            result = task.result()
+        except Exception as e:
+            if not self.is_failure(e):
+                self.breaker.record_success()
+                raise
+            self.breaker.record_failure()
+            raise DependencyUnavailable(self.name, repr(e)) from e
+        self.breaker.record_success(elapsed())
+        return result
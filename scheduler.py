@@ -0,0 +1,304 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import logging
+import time
+from collections import OrderedDict, deque
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import UPDATE_QUEUE_DEPTH, UPDATE_WAIT
+
+logger = logging.getLogger(__name__)
+
+OWNER = "owner"
+PREMIUM = "premium"
+FREE = "free"
+TIERS = (OWNER, PREMIUM, FREE)
+
+DEFAULT_WEIGHTS = {OWNER: 8, PREMIUM: 4, FREE: 1}
+
+# Distinguishes "no runnable user" from the None key used for updates without a user
+MISSING_USER = object()
+
+# (processor, slot) of the update the current task is processing
+_current_slot = contextvars.ContextVar("update_slot", default=None)
+
+
+def update_user_id(update: object):
+    if isinstance(update, Update) and update.effective_user:
+        return update.effective_user.id
+    return None
+
+
+class Waiter:
+    __slots__ = ("user_key", "future")
+
+    def __init__(self, user_key, future):
+        self.user_key = user_key
+        self.future = future
+
+
+class UserGate:
+    """Admission of one user's updates, ``holders`` counts those admitted or waiting"""
+
+    __slots__ = ("semaphore", "holders")
+
+    def __init__(self, limit: int):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.holders = 0
+
+
+class Slot:
+    """A running update; ``held`` is False while it has lent its worker out"""
+
+    __slots__ = ("user_key", "held", "task")
+
+    def __init__(self, user_key):
+        self.user_key = user_key
+        self.held = True
+        # Tasks a handler spawns inherit the context, only the update's own task may lend the worker
+        self.task = asyncio.current_task()
+
+
+@contextlib.asynccontextmanager
+async def released_worker():
+    """Lend the current update's worker to other users while it waits on something that is not work.
+
+    The user keeps their place, so their next update still waits for this
+    one; afterwards the update gets a worker back ahead of new updates.
+    Outside of an update processed by PriorityUpdateProcessor it does nothing.
+    """
+    current = _current_slot.get()
+    if current is None or current[1].task is not asyncio.current_task() or not current[1].held:
+        yield
+        return
+    processor, slot = current
+    processor._release(slot)
+    try:
+        yield
+    finally:
+        await processor._reclaim(slot)
+
+
+class TierStats:
+    def __init__(self):
+        self.processed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float):
+        self.processed += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+
+class PriorityUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates from weighted per-tier queues with bounded concurrency.
+
+    ``classify`` maps an update to a tier and must be cheap, it runs before any
+    handler. Inside a tier users are served round-robin and a user never has
+    more than one update running, so one user flooding the bot only ever
+    occupies a single worker and waits behind everyone else's turn.
+
+    At most ``max_pending`` updates are admitted to the queues, and at most
+    ``max_pending_per_user`` of them from one user; a user's further updates
+    wait in arrival order without taking admission from anyone else.
+    """
+
+    def __init__(self, classify, workers: int = 8, max_pending: int = 1000, weights: dict = None,
+                 max_pending_per_user: int = 20):
+        # The base semaphore caps updates admitted (running + queued); ``workers`` caps running ones
+        super().__init__(max_concurrent_updates=max_pending)
+        self.classify = classify
+        self.workers = workers
+        self.max_pending_per_user = max_pending_per_user
+        self._gates = {}
+        self._gated = 0
+        self.weights = dict(weights or DEFAULT_WEIGHTS)
+        self._queues = {tier: OrderedDict() for tier in TIERS}
+        self._credits = {tier: 0 for tier in TIERS}
+        self._running = 0
+        self._running_users = set()
+        # Updates that lent their worker out and want it back, served before the tier queues
+        self._resuming = deque()
+        self._lent = 0
+        self.stats = {tier: TierStats() for tier in TIERS}
+        for tier in TIERS:
+            UPDATE_QUEUE_DEPTH.labels(tier).set_function(functools.partial(self.queue_depth, tier))
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def queue_depth(self, tier: str) -> int:
+        return sum(len(waiters) for waiters in self._queues[tier].values())
+
+    @property
+    def pending(self) -> int:
+        """Updates running or waiting for a worker"""
+        return self._running + self._lent + self._gated + sum(self.queue_depth(tier) for tier in TIERS)
+
+    def _runnable_user(self, tier: str):
+        for user_key in self._queues[tier]:
+            if user_key is None or user_key not in self._running_users:
+                return user_key
+        return MISSING_USER
+
+    def _pick(self):
+        # Smooth weighted round-robin over the tiers that have something runnable
+        candidates = {}
+        for tier in TIERS:
+            user_key = self._runnable_user(tier)
+            if user_key is not MISSING_USER:
+                candidates[tier] = user_key
+        if not candidates:
+            return None
+
+        total = 0
+        for tier in candidates:
+            self._credits[tier] += self.weights[tier]
+            total += self.weights[tier]
+        tier = max(candidates, key=lambda t: self._credits[t])
+        self._credits[tier] -= total
+
+        user_key = candidates[tier]
+        waiters = self._queues[tier].pop(user_key)
+        waiter = waiters.popleft()
+        if waiters:
+            # Back of the line, so other users of this tier get their turn first
+            self._queues[tier][user_key] = waiters
+        return waiter
+
+    def _grant_next(self):
+        while self._running < self.workers and self._resuming:
+            slot, future = self._resuming.popleft()
+            self._running += 1
+            self._lent -= 1
+            slot.held = True
+            future.set_result(None)
+        while self._running < self.workers:
+            waiter = self._pick()
+            if waiter is None:
+                return
+            self._start(waiter.user_key)
+            waiter.future.set_result(None)
+
+    def _start(self, user_key):
+        self._running += 1
+        if user_key is not None:
+            self._running_users.add(user_key)
+
+    def _finish(self, slot: Slot):
+        if slot.held:
+            self._running -= 1
+        self._running_users.discard(slot.user_key)
+        self._grant_next()
+
+    def _release(self, slot: Slot):
+        slot.held = False
+        self._running -= 1
+        self._lent += 1
+        self._grant_next()
+
+    async def _reclaim(self, slot: Slot):
+        future = asyncio.get_running_loop().create_future()
+        self._resuming.append((slot, future))
+        self._grant_next()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if not future.done():
+                self._resuming.remove((slot, future))
+                self._lent -= 1
+            raise
+
+    async def process_update(self, update: object, coroutine):
+        # The base class admits updates in arrival order, so without the per-user gate
+        # one user's flood would hold every admission and starve the tier queues
+        user_key = update_user_id(update)
+        if user_key is None:
+            await super().process_update(update, coroutine)
+            return
+        gate = self._gates.get(user_key)
+        if gate is None:
+            gate = self._gates[user_key] = UserGate(self.max_pending_per_user)
+        gate.holders += 1
+        try:
+            self._gated += 1
+            try:
+                await gate.semaphore.acquire()
+            finally:
+                self._gated -= 1
+            try:
+                await super().process_update(update, coroutine)
+            finally:
+                gate.semaphore.release()
+        except asyncio.CancelledError:
+            coroutine.close()
+            raise
+        finally:
+            gate.holders -= 1
+            if not gate.holders:
+                del self._gates[user_key]
+
+    async def do_process_update(self, update: object, coroutine):
+        try:
+            tier = self.classify(update)
+        except Exception as e:
+            logger.error(f"Update classification error: {e}")
+            tier = FREE
+        user_key = update_user_id(update)
+        enqueued = time.monotonic()
+
+        waiter = Waiter(user_key, asyncio.get_running_loop().create_future())
+        self._queues[tier].setdefault(user_key, deque()).append(waiter)
+        self._grant_next()
+        slot = Slot(user_key)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._finish(slot)
+            else:
+                self._remove(tier, waiter)
+            coroutine.close()
+            raise
+
+        wait = time.monotonic() - enqueued
+        self.stats[tier].record(wait)
+        UPDATE_WAIT.labels(tier).observe(wait)
+        token = _current_slot.set((self, slot))
+        try:
+            await coroutine
+        finally:
+            _current_slot.reset(token)
+            self._finish(slot)
+
+    def _remove(self, tier: str, waiter):
+        waiters = self._queues[tier].get(waiter.user_key)
+        if waiters is None:
+            return
+        try:
+            waiters.remove(waiter)
+        except ValueError:
+            return
+        if not waiters:
+            del self._queues[tier][waiter.user_key]
+
+    def snapshot(self) -> dict:
+        """Per-tier queue depth and wait-time figures"""
+        return {
+            tier: {
+                "depth": self.queue_depth(tier),
+                "processed": stats.processed,
+                "avg_wait": stats.total_wait / stats.processed if stats.processed else 0.0,
+                "max_wait": stats.max_wait
+            }
+            for tier, stats in self.stats.items()
+        }
+
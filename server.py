@@ -0,0 +1,203 @@
+import asyncio
+import json
+import logging
+import signal
+
+import tornado.httpserver
+import tornado.web
+from telegram import Update
+
+import metrics
+from startup import StartupTracker
+
+logger = logging.getLogger(__name__)
+
+
+def parse_updates(body: bytes, batch: bool = False) -> list:
+    payloads = json.loads(body)
+    if not batch:
+        payloads = [payloads]
+    if not all(isinstance(data, dict) and "update_id" in data for data in payloads):
+        raise ValueError("update without update_id")
+    return payloads
+
+
+class WebhookHandler(tornado.web.RequestHandler):
+    # The ingress posts lists of updates, Telegram posts one at a time
+    batch = False
+
+    def initialize(self, bot_app, ingest=None):
+        self.bot_app = bot_app
+        self.ingest = ingest
+
+    async def post(self):
+        try:
+            payloads = parse_updates(self.request.body, self.batch)
+            if self.ingest is None:
+                updates = [Update.de_json(data, self.bot_app.bot) for data in payloads]
+        except Exception as e:
+            logger.error(f"Invalid update payload: {e}")
+            raise tornado.web.HTTPError(400)
+
+        if self.ingest is not None:
+            # Acknowledged as soon as it is on disk, a failed write answers 500 so the sender retries
+            await self.ingest.append(payloads)
+            return
+        for update in updates:
+            if update:
+                await self.bot_app.update_queue.put(update)
+
+
+class ShardHandler(WebhookHandler):
+    """Receives batches of raw updates from the ingress process, in delivery order"""
+
+    batch = True
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        body, content_type = metrics.render()
+        self.set_header("Content-Type", content_type)
+        self.write(body)
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write("OK")
+
+
+class ReadyHandler(tornado.web.RequestHandler):
+    """503 until startup and warmup are done, then 200; the body is the startup report"""
+
+    def initialize(self, startup):
+        self.startup = startup
+
+    def get(self):
+        if not self.startup.ready:
+            self.set_status(503)
+        self.write(self.startup.report())
+
+
+def make_app(application, url_path: str = None, shard: bool = False,
+             startup: StartupTracker = None, ingest=None) -> tornado.web.Application:
+    routes = [
+        (r"/", HealthHandler),
+        (r"/readyz", ReadyHandler, {"startup": startup or StartupTracker()}),
+        (r"/metrics", MetricsHandler),
+    ]
+    if url_path is not None:
+        routes.append((rf"/{url_path}/?", WebhookHandler, {"bot_app": application, "ingest": ingest}))
+    if shard:
+        routes.append((r"/shard", ShardHandler, {"bot_app": application, "ingest": ingest}))
+    return tornado.web.Application(routes)
+
+
+def webhook_endpoint(webhook_url: str, url_path: str) -> str:
+    """The URL Telegram should post to, WEBHOOK_URL may be given with or without the path"""
+    webhook_url = webhook_url.rstrip("/")
+    if webhook_url.endswith(f"/{url_path}"):
+        return webhook_url
+    return f"{webhook_url}/{url_path}"
+
+
+async def drain(application, timeout: float):
+    """Wait up to ``timeout`` seconds for updates already received to be handled"""
+    processor = application.update_processor
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    def pending():
+        return application.update_queue.qsize() + getattr(processor, "pending", 0)
+
+    if pending():
+        logger.info(f"Draining {pending()} updates")
+    while pending() and loop.time() < deadline:
+        await asyncio.sleep(0.1)
+    if pending():
+        logger.warning(f"{pending()} updates still running after {timeout}s")
+
+
+async def run(application, port: int, webhook_url: str = None, url_path: str = "", worker: bool = False,
+              startup: StartupTracker = None, ingest=None, poll_timeout: int = 10, poll_interval: float = 0.0,
+              drain_timeout: float = 25.0):
+    """Run the bot with one HTTP listener serving the webhook, /metrics and a health check.
+
+    Without a webhook URL updates are fetched by long polling and the listener
+    only serves /metrics and the health check. A ``worker`` takes its updates
+    from the ingress process on a local-only /shard endpoint instead, the
+    ingress owns the webhook.
+
+    The listener comes up first so liveness checks pass and webhook updates
+    that woke a sleeping instance are queued, they are processed once warmup
+    is done and /readyz turns 200.
+
+    With an ``ingest`` queue (webhook and worker mode), received updates are
+    acknowledged once they are stored on disk and consumed from there, so a
+    restart does not lose what was already acknowledged.
+
+    On SIGTERM intake stops first (listener, polling), then updates already
+    received get ``drain_timeout`` seconds to finish before the bot shuts down.
+    """
+    startup = startup or StartupTracker()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    if ingest is not None:
+        with startup.phase("ingest_queue"):
+            await ingest.open()
+    if worker:
+        app, address = make_app(application, shard=True, startup=startup, ingest=ingest), "127.0.0.1"
+    else:
+        path = url_path if webhook_url else None
+        app, address = make_app(application, path, startup=startup, ingest=ingest), "0.0.0.0"
+    http_server = tornado.httpserver.HTTPServer(app)
+    http_server.listen(port, address=address)
+    logger.info(f"Listening on port {port}")
+
+    # run_webhook/run_polling would call these hooks, so do the same here
+    with startup.phase("initialize"):
+        await application.initialize()
+    if application.post_init:
+        with startup.phase("post_init"):
+            await application.post_init(application)
+
+    if worker:
+        logger.info("Waiting for updates from the ingress")
+    elif webhook_url:
+        with startup.phase("set_webhook"):
+            await application.bot.set_webhook(
+                url=webhook_endpoint(webhook_url, url_path),
+                allowed_updates=Update.ALL_TYPES
+            )
+    else:
+        with startup.phase("start_polling"):
+            await application.bot.delete_webhook()
+            await application.updater.start_polling(
+                poll_interval=poll_interval,
+                timeout=poll_timeout,
+                allowed_updates=Update.ALL_TYPES
+            )
+    await application.start()
+    if ingest is not None:
+        ingest.start(application)
+    startup.mark_ready()
+
+    try:
+        await stop.wait()
+    finally:
+        logger.info("Shutting down")
+        http_server.stop()
+        if application.updater.running:
+            # Also confirms the last fetched offset, so Telegram does not send those updates again
+            await application.updater.stop()
+        if ingest is not None:
+            await ingest.stop(drain_timeout)
+        await drain(application, drain_timeout)
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
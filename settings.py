@@ -0,0 +1,106 @@
+import asyncio
+import logging
+from dataclasses import dataclass, fields, replace
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Config:
+    """Immutable snapshot of the bot-wide settings"""
+
+    force_sub_channels: tuple = ()
+    force_sub_groups: tuple = ()
+    verification_interval: int = 24  # in hours
+    shortener_api_url: str = ""
+    shortener_api_key: str = ""
+    # Bumped after users were deleted or overwritten in bulk, every worker then drops its cached profiles
+    user_cache_generation: int = 0
+    version: int = 0
+
+
+CONFIG_FIELDS = {field.name for field in fields(Config)}
+
+
+def config_from_document(data: dict, defaults: Config) -> Config:
+    """Build a snapshot from the stored document, fields never stored keep their defaults"""
+    values = {key: value for key, value in data.items() if key in CONFIG_FIELDS}
+    for key in ("force_sub_channels", "force_sub_groups"):
+        if key in values:
+            values[key] = tuple(values[key] or ())
+    return replace(defaults, **values)
+
+
+class SettingsStore:
+    """Holds the current Config and keeps it in sync with the database.
+
+    Handlers read ``current`` directly: it is replaced wholesale on reload,
+    never modified, so reads need no lock and no database round-trip. Owner
+    commands write through ``set``/``add``/``remove``, which bump the stored
+    version; every worker polls that version and reloads when it moves.
+    """
+
+    def __init__(self, repository, defaults: Config = None, interval: float = 5.0):
+        self.repository = repository
+        self.defaults = defaults or Config()
+        self.interval = interval
+        self.current = self.defaults
+        self._listeners = []
+        self._task = None
+
+    def on_change(self, listener):
+        """Call ``listener(old, new)`` whenever a reload produces a different snapshot"""
+        self._listeners.append(listener)
+
+    async def load(self) -> Config:
+        config = config_from_document(await self.repository.get_config(), self.defaults)
+        old, self.current = self.current, config
+        if config != old:
+            logger.info(f"Settings loaded (version {config.version})")
+            for listener in self._listeners:
+                listener(old, config)
+        return config
+
+    async def set(self, **values) -> Config:
+        await self.repository.update_config({"$set": values})
+        return await self.load()
+
+    async def add(self, field: str, value) -> Config:
+        await self.repository.update_config({"$addToSet": {field: value}})
+        return await self.load()
+
+    async def remove(self, field: str, value) -> Config:
+        await self.repository.update_config({"$pull": {field: value}})
+        return await self.load()
+
+    async def bump(self, field: str) -> Config:
+        await self.repository.update_config({"$inc": {field: 1}})
+        return await self.load()
+
+    async def check(self) -> bool:
+        """Reload if another worker changed the settings, returns True when it did"""
+        if await self.repository.config_version() == self.current.version:
+            return False
+        await self.load()
+        return True
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"Settings reload failed: {e}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
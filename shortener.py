@@ -0,0 +1,152 @@
+import abc
+import asyncio
+import logging
+import random
+import secrets
+import time
+from collections import deque
+
+import httpx
+
+from resilience import CircuitBreaker
+
+logger = logging.getLogger(__name__)
+
+
+# /start payload of verification links, followed by the token
+VERIFY_START_PREFIX = "verify_"
+
+
+def verification_url(bot_username: str, token: str) -> str:
+    return f"https://t.me/{bot_username}?start={VERIFY_START_PREFIX}{token}"
+
+
+class ShortenerProvider(abc.ABC):
+    """Interface for URL shortener backends"""
+
+    @abc.abstractmethod
+    async def shorten(self, long_url: str) -> str:
+        """Return the short URL, raise when the backend cannot shorten ``long_url``"""
+
+
+class TextApiProvider(ShortenerProvider):
+    """Shorteners speaking the common ``?api=KEY&url=URL&format=text`` API"""
+
+    def __init__(self, client: httpx.AsyncClient, api_url: str, api_key: str):
+        self.client = client
+        self.api_url = api_url
+        self.api_key = api_key
+
+    async def shorten(self, long_url: str) -> str:
+        params = {
+            "api": self.api_key,
+            "url": long_url,
+            "format": "text"  # Get plain text response
+        }
+        response = await self.client.get(self.api_url, params=params)
+        response.raise_for_status()
+
+        short_url = response.text.strip()
+        if not short_url.startswith("http"):
+            raise ValueError(f"Unexpected shortener response: {short_url[:100]}")
+        return short_url
+
+
+def fake_transport(latency: float = 0.0, fail_rate: float = 0.0) -> httpx.MockTransport:
+    """Local stand-in for a text-API shortener, for tests and load runs without network"""
+    counter = iter(range(1, 1 << 62))
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if latency:
+            await asyncio.sleep(latency)
+        if fail_rate and random.random() < fail_rate:
+            return httpx.Response(503, text="unavailable")
+        return httpx.Response(200, text=f"https://short.test/{next(counter):x}")
+
+    return httpx.MockTransport(handler)
+
+
+class ShortenerClient:
+    """Pooled async shortener client with a circuit breaker and a pool of ready-made verification links"""
+
+    def __init__(self, timeout: float = 5.0, max_connections: int = 10, link_pool_size: int = 20,
+                 breaker: CircuitBreaker = None, transport: httpx.AsyncBaseTransport = None):
+        self._http = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections
+            ),
+            transport=transport
+        )
+        # Calls slower than half the timeout count as failures so a browning-out provider trips too
+        self.breaker = breaker or CircuitBreaker(
+            "shortener", failure_threshold=5, reset_timeout=30.0, slow_call_threshold=timeout / 2
+        )
+        self.provider = None
+        self.link_pool_size = link_pool_size
+        self._links = deque()
+        self._refill_task = None
+
+    @property
+    def configured(self) -> bool:
+        return self.provider is not None
+
+    def configure(self, api_url: str, api_key: str):
+        if api_url and api_key:
+            self.provider = TextApiProvider(self._http, api_url, api_key)
+        else:
+            self.provider = None
+        # Links made with the previous provider are no longer wanted
+        self._links.clear()
+        self.breaker.reset()
+
+    async def shorten(self, long_url: str) -> str:
+        """Shorten a URL, falling back to the long URL when the provider is unavailable"""
+        if not self.provider:
+            logger.warning("Shortener API not configured")
+            return long_url
+        if not self.breaker.allow():
+            return long_url
+
+        started = time.monotonic()
+        try:
+            short_url = await self.provider.shorten(long_url)
+        except Exception as e:
+            self.breaker.record_failure()
+            logger.error(f"Shortener API error: {e}")
+            return long_url
+        self.breaker.record_success(time.monotonic() - started)
+        return short_url
+
+    async def verification_link(self, bot_username: str):
+        """Return a (token, url) pair, from the pre-generated pool when possible"""
+        if self._links:
+            token, short_url = self._links.popleft()
+        else:
+            token = secrets.token_urlsafe(16)
+            short_url = await self.shorten(verification_url(bot_username, token))
+        self.start_refill(bot_username)
+        return token, short_url
+
+    def start_refill(self, bot_username: str):
+        if self.provider and (self._refill_task is None or self._refill_task.done()):
+            self._refill_task = asyncio.create_task(self._refill(bot_username))
+
+    async def _refill(self, bot_username: str):
+        # Tokens are unguessable and only bound to a user when handed out, so idle links are harmless
+        while self.provider and len(self._links) < self.link_pool_size \
+                and self.breaker.state != CircuitBreaker.OPEN:
+            provider = self.provider
+            token = secrets.token_urlsafe(16)
+            long_url = verification_url(bot_username, token)
+            short_url = await self.shorten(long_url)
+            if short_url == long_url:
+                return
+            if provider is self.provider:
+                self._links.append((token, short_url))
+
+    async def close(self):
+        if self._refill_task and not self._refill_task.done():
+            self._refill_task.cancel()
+        await self._http.aclose()
@@ -0,0 +1,55 @@
+import contextlib
+import logging
+import time
+
+from metrics import READY, STARTUP_PHASE
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTracker:
+    """Times the startup phases and tells readiness apart from liveness.
+
+    The HTTP listener answers health checks as soon as it is up, readiness
+    only flips once warmup finished and updates are being processed, so the
+    first updates after a cold start see steady-state latency.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.phases = {}
+        self.ready = False
+        self.ready_after = None
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        started = self.clock()
+        try:
+            yield
+        finally:
+            duration = self.clock() - started
+            self.phases[name] = duration
+            STARTUP_PHASE.labels(name).set(duration)
+
+    async def run(self, name: str, awaitable):
+        """Await ``awaitable`` as a named phase, so concurrent phases can be timed with gather"""
+        with self.phase(name):
+            return await awaitable
+
+    def mark_ready(self):
+        self.ready = True
+        self.ready_after = self.clock() - self.started
+        READY.set(1)
+        logger.info(self.summary())
+
+    def summary(self) -> str:
+        phases = ", ".join(f"{name} {duration * 1000:.0f} ms" for name, duration in self.phases.items())
+        return f"Ready after {self.ready_after:.2f}s ({phases})"
+
+    def report(self) -> dict:
+        return {
+            "ready": self.ready,
+            "ready_after": self.ready_after,
+            "phases": dict(self.phases)
+        }